@@ -16,33 +16,70 @@ import yaml
 import os
 import re
 import ssl
-from secrets import token_hex
-from datetime import date
-from dateutil.relativedelta import relativedelta 
-
-from fastapi import FastAPI, Request
+import csv
+import json
+import logging
+import tempfile
+from time import perf_counter
+from typing import Any, AsyncIterator, List
+from datetime import date, timedelta
+
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from slowapi.errors import RateLimitExceeded
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, ValidationError
 import pandas as pd
-import mlflow
-import mysql.connector
-from mlflow import MlflowClient
-
-from model_monitoring import preprocess_features
 
-class CarDetails(BaseModel):
+from model_monitoring import preprocess_features, preprocess_car, encoder_cache
+from model_cache import ModelCache
+from batching import PredictionBatcher, QueueFullError
+from token_cache import TokenCache
+from token_writer import TokenWriter, generate_token, insert_tokens, token_row, row_expiry_date, TOKEN_VALIDITY_DAYS
+from prediction_cache import PredictionCache
+import database
+from database import get_connection
+import workers
+from workers import run_io, run_inference
+import metrics
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+class CarFeatures(BaseModel):
     """
     Data structure that stores information about an used car.
+
+    Surrounding spaces are removed from the categories when validating the
+    car, so that the prediction cache and the encoder see the same values.
+    The encoder is case sensitive, so the case is left as it is.
     """
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     state: str
     make: str
     model: str
     year: int
     mileage: float
+
+class CarDetails(CarFeatures):
+    """
+    Information about an used car sent to /predict, along with the
+    security token of the user.
+    """
     security_token: str
 
+class CarBatch(BaseModel):
+    """
+    A list of used cars sent to /predict_batch.
+
+    The cars are not validated as a whole so that a single invalid car,
+    even one that is not a JSON object, does not fail the whole batch.
+    """
+    security_token: str
+    cars: List[Any]
+
 class UserDetails(BaseModel):
     """
     Stores information about a user.
@@ -52,12 +89,6 @@ class UserDetails(BaseModel):
     email: str
 
 
-def generate_token() -> str:
-    """
-    Generates a random token.
-    """
-    return str(token_hex(32))
-
 def email_format_is_right(email_address: str) -> bool:
     """
     Checks if the provided email address follows the right format.
@@ -76,29 +107,79 @@ def email_format_is_right(email_address: str) -> bool:
 def check_token(token: str) -> bool:
     """
     Looks up the provided token in the database to make sure it is valid.
+
+    The expiry date of valid tokens is cached so that most requests do not
+    need to query the database.
     """
-    with mysql.connector.connect(user=os.environ["MYSQL_USER"], 
-                            password=os.environ["MYSQL_PWD"], 
-                            host=os.environ["MYSQL_HOST"], 
-                            database="iargus_api") as db:
-        with db.cursor() as c:
-            query = """SELECT creation_date FROM tokens WHERE token=%s""" 
-            vars = (token,)
-            c.execute(query, vars)
-            results = c.fetchall()
-
-            print(results)
-            if len(results) == 0:
-                # The token does not exist in the database
-                return False
-            
-
-            current_date = date.today()
-            days_elapsed = current_date - results[0][-1]
-            if days_elapsed.days > 180:
-                return False
-        
+    expiry_date = token_cache.get(token)
+    CACHE_LOOKUPS.inc(cache="token", result="hit" if expiry_date is not None else "miss")
+    if expiry_date is None:
+        # Tokens issued recently may not be stored yet
+        pending_row = token_writer.pending(token)
+        if pending_row is not None:
+            expiry_date = row_expiry_date(pending_row)
+    if expiry_date is None:
+        with timed("token_db_lookup"), get_connection("iargus_api") as db:
+            with db.cursor() as c:
+                query = """SELECT creation_date FROM tokens WHERE token=%s"""
+                vars = (token,)
+                c.execute(query, vars)
+                results = c.fetchall()
+
+        if len(results) == 0:
+            # The token does not exist in the database
+            return False
+
+        expiry_date = results[0][-1] + timedelta(days=TOKEN_VALIDITY_DAYS)
+        token_cache.put(token, expiry_date)
+
+    return date.today() <= expiry_date
+
+
+def store_token(user_details: UserDetails, token: str):
+    """
+    Queues a new token and the details of the user it was generated for
+    to be stored in the database. The token is valid right away in this
+    worker, and in the others once its batch is stored. It stops being
+    valid if its batch cannot be stored.
+    """
+    row = token_row(user_details.first_name, user_details.surname, user_details.email, token)
+    token_cache.put(token, row_expiry_date(row))
+    token_writer.add(row).add_done_callback(lambda future: forget_unstored_token(token, future))
+
+
+def forget_unstored_token(token: str, future):
+    """
+    Removes a token from the cache once its batch failed to be stored.
+    """
+    if future.cancelled() or future.exception() is None:
+        return
+    token_cache.invalidate(token)
+    logger.error("A token was handed out but could not be stored, it is no longer valid")
+
+
+def write_tokens(rows: list):
+    """
+    Stores a batch of token rows queued by store_token in the database.
+    """
+    with get_connection("iargus_api") as db:
+        insert_tokens(db, rows)
+        db.commit()
+
+
+def revoke_token(token: str) -> bool:
+    """
+    Deletes a token from the database and from the cache. Returns False if
+    the token did not exist.
+    """
+    token_cache.invalidate(token)
+    if token_writer.discard(token):
         return True
+    with get_connection("iargus_api") as db:
+        with db.cursor() as c:
+            c.execute("""DELETE FROM tokens WHERE token=%s""", (token,))
+            db.commit()
+            return c.rowcount > 0
 
 
 
@@ -106,6 +187,153 @@ app = FastAPI()
 limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+model_cache = ModelCache(model_name="iargus", encoder_cache=encoder_cache)
+token_cache = TokenCache()
+token_writer = TokenWriter(write_tokens)
+prediction_cache = PredictionCache()
+
+REQUESTS_IN_PROGRESS = metrics.gauge("iargus_requests_in_progress", "Number of requests being processed")
+REQUEST_DURATION = metrics.histogram("iargus_request_duration_seconds", "Time spent processing each request",
+                                     ["path", "status"])
+CACHE_LOOKUPS = metrics.counter("iargus_cache_lookups", "Lookups in the caches of the API", ["cache", "result"])
+CACHE_HIT_RATIO = metrics.gauge("iargus_cache_hit_ratio", "Share of the lookups answered by each cache", ["cache"])
+
+
+def cache_hit_ratio(cache: str) -> float:
+    """
+    Returns the share of lookups in the given cache that were hits.
+    """
+    hits = CACHE_LOOKUPS.value(cache=cache, result="hit")
+    lookups = hits + CACHE_LOOKUPS.value(cache=cache, result="miss")
+    return hits / lookups if lookups else 0
+
+
+CACHE_HIT_RATIO.set_function(lambda: cache_hit_ratio("token"), cache="token")
+CACHE_HIT_RATIO.set_function(lambda: cache_hit_ratio("prediction"), cache="prediction")
+
+
+def predict_rows(features, loaded_model):
+    """
+    Runs the given model on a batch of features encoded with its lookup
+    tables. Returns the predicted price of each row.
+    """
+    with timed("model_predict"):
+        preds = loaded_model.predict(features)
+    return [float(pred[0]) for pred in preds]
+
+
+async def predict_rows_async(features, loaded_model):
+    """
+    Runs predict_rows on the inference pool.
+    """
+    return await run_inference(predict_rows, features, loaded_model)
+
+
+batcher = PredictionBatcher(predict_rows_async)
+metrics.gauge("iargus_batch_queue_rows", "Number of rows waiting to be batched").set_function(
+    lambda: batcher.status()["queued_rows"])
+batch_chunk_size = 1000
+predict_rate_limit = "10/minute"
+# Set once startup() has loaded the model and opened the database pool
+startup_complete = False
+# Car predicted at startup to warm the prediction path up
+WARMUP_CAR = CarFeatures(state="", make="", model="", year=2000, mileage=0)
+# Uploads bigger than this are spooled to disk
+UPLOAD_SPOOL_MAX_SIZE = 10 * 1024 * 1024
+
+
+async def predict_stream(rows: AsyncIterator[dict], loaded_model) -> AsyncIterator[str]:
+    """
+    Predicts the price of each car in rows, chunk by chunk, and yields
+    the results as JSON lines as soon as they are computed.
+
+    Invalid cars are reported on their own line instead of failing the
+    whole stream.
+    """
+    chunk = []
+    index = 0
+    async for row in rows:
+        chunk.append((index, row))
+        index += 1
+        if len(chunk) >= batch_chunk_size:
+            for line in await run_inference(predict_chunk, chunk, loaded_model):
+                yield line
+            chunk = []
+    if len(chunk) > 0:
+        for line in await run_inference(predict_chunk, chunk, loaded_model):
+            yield line
+
+
+def predict_chunk(chunk: list, loaded_model) -> List[str]:
+    """
+    Validates and predicts a chunk of (index, row) pairs. Returns one JSON
+    line per row, in the order of the rows.
+    """
+    results = {}
+    valid_cars = []
+    for index, row in chunk:
+        try:
+            valid_cars.append((index, CarFeatures(**row)))
+        except ValidationError as e:
+            error = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+            results[index] = {"index": index, "error": error}
+        except TypeError:
+            results[index] = {"index": index, "error": "Each car must be a JSON object"}
+
+    if len(valid_cars) > 0:
+        car_data = pd.DataFrame([car.model_dump() for _, car in valid_cars])
+        try:
+            features = preprocess_features(car_data, sparse=True, lookup=loaded_model.lookup)
+            with timed("model_predict"):
+                preds = loaded_model.predict(features)
+            for (index, _), pred in zip(valid_cars, preds):
+                results[index] = {"index": index, "predicted_price": float(pred[0])}
+        except Exception as e:
+            for index, _ in valid_cars:
+                results[index] = {"index": index, "error": f"Prediction failed: {e}"}
+
+    return [json.dumps(results[index]) + "\n" for index, _ in chunk]
+
+
+async def spool_body(request: Request):
+    """
+    Copies the request body to a temporary file as it is received.
+
+    The body has to be fully received before the response starts being
+    streamed, and spooling it keeps large uploads out of memory.
+    """
+    body_file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+    async for data in request.stream():
+        body_file.write(data)
+    body_file.seek(0)
+    return body_file
+
+
+async def iter_uploaded_rows(body_file, content_type: str) -> AsyncIterator[dict]:
+    """
+    Parses an uploaded NDJSON or CSV file into one dict per car. Lines that
+    cannot be parsed are passed on as they are so that they are reported
+    as invalid.
+    """
+    header = None
+    try:
+        for line in body_file:
+            line = line.decode("utf-8").strip()
+            if not line:
+                continue
+            if "csv" in content_type:
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = [column.strip() for column in values]
+                    continue
+                yield dict(zip(header, values))
+            else:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    yield {"unparsable_line": line}
+    finally:
+        body_file.close()
 
 
 @app.on_event("startup")
@@ -119,15 +347,42 @@ async def startup():
         config = yaml.safe_load(config_file)
         ssl_cert_filepath = config["security"]["ssl_certificate_path"]
         ssl_key_filepath = config["security"]["ssl_key_path"]
-
-    # Making sure the database that stores the tokens is available
-    # (an exception will be raised otherwise)
-    db = mysql.connector.connect(user=os.environ["MYSQL_USER"], 
-                            password=os.environ["MYSQL_PWD"], 
-                            host=os.environ["MYSQL_HOST"], 
-                            database="iargus_api")
- 
-    
+        model_cache.refresh_interval = config["api"]["model_refresh_interval"]
+        model_cache.backend = config["api"]["inference_backend"]
+        model_cache.precision = config["api"]["model_precision"]["precision"]
+        model_cache.max_mape_increase = config["api"]["model_precision"]["max_mape_increase"]
+        model_cache.mape_threshold = config["monitoring"]["MAPE_threshold"]
+        model_cache.marker_path = config["api"]["model_version_marker"]
+        model_cache.marker_poll_interval = config["api"]["model_marker_poll_interval"]
+        # Warm-up predictions are made at the size of single cars, of the
+        # batches of concurrent requests and of the chunks of batch uploads
+        model_cache.warmup_batch_sizes = sorted({1, config["api"]["batching"]["max_batch_size"],
+                                                 config["api"]["batch_chunk_size"]})
+        batching_config = config["api"]["batching"]
+        batcher.max_batch_size = batching_config["max_batch_size"]
+        batcher.max_wait_ms = batching_config["max_wait_ms"]
+        batcher.max_queue_size = batching_config["max_queue_size"]
+        batcher.max_concurrent_batches = config["api"]["workers"]["inference"]
+        workers.configure(io_workers=config["api"]["workers"]["io"],
+                          inference_workers=config["api"]["workers"]["inference"])
+        global batch_chunk_size, predict_rate_limit
+        batch_chunk_size = config["api"]["batch_chunk_size"]
+        predict_rate_limit = config["api"]["predict_rate_limit"]
+        database.configure(config["api"]["database"]["pool_size"])
+        token_cache.max_size = config["api"]["token_cache"]["max_size"]
+        token_cache.ttl = config["api"]["token_cache"]["ttl"]
+        token_writer.max_batch_size = config["api"]["token_writer"]["max_batch_size"]
+        token_writer.max_wait_ms = config["api"]["token_writer"]["max_wait_ms"]
+        global prediction_cache
+        prediction_cache = PredictionCache(**config["api"]["prediction_cache"])
+
+    # Opening the connections of the pool and making sure the database that
+    # stores the tokens is available (an exception will be raised otherwise)
+    def ping_database():
+        database.open_pool("iargus_api")
+        with get_connection("iargus_api") as db:
+            db.ping()
+    await run_io(ping_database)
 
     # Loading the SSL certificate and key
     # WARNING: this is a certificate for testing purpose only. In production,
@@ -135,6 +390,68 @@ async def startup():
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_context.load_cert_chain(ssl_cert_filepath, keyfile=ssl_key_filepath)
 
+    # Loading the model once so that requests do not have to fetch it from
+    # MLflow. If MLflow is unavailable, the background refresh will try again.
+    # New versions are then loaded and warmed up in the background before
+    # replacing the current one.
+    # Nothing is loaded if the master process already did before forking.
+    try:
+        await run_io(model_cache.refresh)
+        await run_io(encoder_cache.lookup)
+    except Exception as e:
+        logger.warning(f"The model could not be loaded at startup: {e}")
+    # When served by gunicorn.conf.py, the master process reloads the
+    # workers when a new version is registered
+    if os.environ.get("IARGUS_MODEL_RELOAD") != "master":
+        model_cache.start_background_refresh()
+    await batcher.start()
+    token_writer.start()
+    loaded_model = model_cache.get()
+    if loaded_model is not None:
+        # Going once through the whole prediction path starts the threads
+        # of the inference pool, so that the first request does not wait
+        with timed("startup_warmup"):
+            await batcher.submit(preprocess_car(WARMUP_CAR, loaded_model.lookup), loaded_model)
+    global startup_complete
+    startup_complete = True
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    Stops the background tasks started by startup().
+    """
+    global startup_complete
+    startup_complete = False
+    await batcher.stop()
+    # The tokens still queued are stored before exiting
+    await run_io(token_writer.stop)
+    model_cache.stop_background_refresh()
+    workers.shutdown()
+
+
+
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    """
+    Counts the requests in progress and measures the time spent on each
+    one, until its response starts being sent.
+    """
+    REQUESTS_IN_PROGRESS.inc()
+    start = perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_PROGRESS.dec()
+        # Using the route rather than the URL keeps the number of series
+        # bounded
+        route = request.scope.get("route")
+        REQUEST_DURATION.observe(perf_counter() - start,
+                                 path=route.path if route is not None else "unknown",
+                                 status=status_code)
 
 
 @app.get("/")
@@ -143,7 +460,7 @@ async def root(security_token: str):
     Returns a help message.
     """
 
-    if not check_token(security_token):
+    if not await run_io(check_token, security_token):
         message = """The provided token does not exist or has expired. Please get a new one using the /get_token endpoint"""
 
     else:
@@ -158,6 +475,45 @@ async def root(security_token: str):
 
     return {"message": message}
 
+@app.get("/status")
+async def status():
+    """
+    Returns the version of the model currently used by the API, the
+    time it was loaded at and statistics about the prediction batches.
+    """
+    status = model_cache.status()
+    status["batching"] = batcher.status()
+    status["prediction_cache"] = prediction_cache.status()
+    status["token_writer"] = token_writer.status()
+    return status
+
+@app.get("/health/live")
+async def health_live():
+    """
+    Tells whether the process is running, even if it is not ready to
+    serve predictions yet.
+    """
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def health_ready():
+    """
+    Tells whether the API is ready to serve predictions: startup is over
+    and a model has been loaded and warmed up. Answers with a 503 status
+    otherwise, so that load balancers do not send requests to it.
+    """
+    loaded_model = model_cache.get()
+    if not startup_complete or loaded_model is None:
+        raise HTTPException(status_code=503, detail="The API is not ready yet")
+    return {"status": "ready", "model_version": loaded_model.version}
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Returns the metrics of the API in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/get_token")
 @limiter.limit("10/minute")
 async def get_token(request: Request, user_details: UserDetails):
@@ -171,61 +527,132 @@ async def get_token(request: Request, user_details: UserDetails):
         return {"message": "The provided email address must follow the right format"}
     
     token = generate_token()
-    with mysql.connector.connect(user=os.environ["MYSQL_USER"], 
-                            password=os.environ["MYSQL_PWD"], 
-                            host=os.environ["MYSQL_HOST"], 
-                            database="iargus_api") as db:
-        with db.cursor() as c:
-            current_date = date.today()
-            expiration_date = current_date + relativedelta(months=6)
-            expiration_date = expiration_date.strftime("%Y-%m-%d")
-            query = """INSERT INTO tokens (first_name, surname, email, token, creation_date) VALUES (%s, %s, %s, %s, %s)""" 
-            query_vars = (user_details.first_name,
-                          user_details.surname,
-                          user_details.email,
-                          token,
-                          expiration_date)
-            c.execute(query, query_vars)
-            db.commit()
+    store_token(user_details, token)
     
     return {"message": "Here is your access token",
             "token": token}
 
 
+@app.delete("/token")
+async def delete_token(security_token: str):
+    """
+    Revokes the provided token. It cannot be used anymore afterwards.
+    """
+    if not await run_io(revoke_token, security_token):
+        return {"message": "The provided token does not exist"}
+    return {"message": "The token has been revoked"}
+
+
 
 @app.post("/predict")
-@limiter.limit("10/minute")
+@limiter.limit(lambda: predict_rate_limit)
 async def predict(request: Request, car_details: CarDetails):
     """
     Predicts the price of a second-hand car and returns the result.
     """
-    if not check_token(car_details.security_token):
+    if not await run_io(check_token, car_details.security_token):
         message = """The provided token does not exist or has expired. Please get a new one using the /get_token endpoint"""
         return {"message": message}
 
-    # Loading the model from MLflow
-    client = MlflowClient(tracking_uri=os.environ["MLFLOW_HOST"])
-    model_versions = client.search_model_versions(f"name='iargus'")
-    if len(model_versions) == 0:
+    # The model is kept in memory by model_cache. If none has been loaded
+    # yet, we check whether one has been registered since startup.
+    loaded_model = model_cache.get()
+    if loaded_model is None:
+        loaded_model = await run_io(model_cache.refresh)
+    if loaded_model is None:
         message = "No model has been trained yet for IArgus. Please try again later."
         return {"message": message}
 
-    last_version = model_versions[0].version
-    model_uri = f"models:/iargus/{last_version}"
-    model = mlflow.keras.load_model(model_uri)
+    # Cars that were already priced by this version of the model are
+    # answered from the cache
+    cache_key = prediction_cache.make_key(car_details, loaded_model.version)
+    cached_price = await run_io(prediction_cache.get, cache_key)
+    CACHE_LOOKUPS.inc(cache="prediction", result="hit" if cached_price is not None else "miss")
+    if cached_price is not None:
+        return {"predicted_price": cached_price,
+                "model_version": loaded_model.version}
 
     # Preparing the data
-    # Convertir en df et appeler preprocess_data
     # PENSER À AJOUTER UN CONTRÔLE DES VALEURS ICI
-    car_data_dict = {
-        "state": [car_details.state],
-        "make": [car_details.make],
-        "model": [car_details.model],
-        "year": [car_details.year],
-        "mileage": [car_details.mileage]
-    }
-    features = preprocess_features(pd.DataFrame(car_data_dict))
-    pred = model.predict(features)
-    print(pred)
-
-    return {"predicted_price": float(pred)}
\ No newline at end of file
+    # The features are encoded for loaded_model and only batched with rows
+    # encoded for it, even if a new version is loaded in the meantime
+    features = preprocess_car(car_details, loaded_model.lookup)
+
+    # The row is predicted along with those of concurrent requests
+    try:
+        predicted_price = await batcher.submit(features, loaded_model)
+    except QueueFullError:
+        raise HTTPException(status_code=503,
+                            detail="The API is receiving too many requests. Please try again later.")
+
+    await run_io(prediction_cache.put, cache_key, predicted_price)
+
+    return {"predicted_price": predicted_price,
+            "model_version": loaded_model.version}
+
+
+async def get_batch_model(security_token: str):
+    """
+    Checks the token sent with a batch and returns the model to use for the
+    whole batch, even if a new version is loaded in the meantime.
+
+    Returns a response with an error message instead if the batch cannot
+    be processed.
+    """
+    if not await run_io(check_token, security_token):
+        message = """The provided token does not exist or has expired. Please get a new one using the /get_token endpoint"""
+        return None, {"message": message}
+
+    loaded_model = model_cache.get()
+    if loaded_model is None:
+        loaded_model = await run_io(model_cache.refresh)
+    if loaded_model is None:
+        message = "No model has been trained yet for IArgus. Please try again later."
+        return None, {"message": message}
+    return loaded_model, None
+
+
+def stream_batch(rows: AsyncIterator[dict], loaded_model) -> StreamingResponse:
+    """
+    Streams the predictions made for rows as JSON lines.
+    """
+    return StreamingResponse(predict_stream(rows, loaded_model),
+                             media_type="application/x-ndjson",
+                             headers={"X-Model-Version": str(loaded_model.version)})
+
+
+@app.post("/predict_batch")
+@limiter.limit(lambda: predict_rate_limit)
+async def predict_batch(request: Request, car_batch: CarBatch):
+    """
+    Predicts the price of many second-hand cars at once.
+
+    Results are streamed back as JSON lines, each one containing the index
+    of the car in the batch and either its predicted price or an error.
+    """
+    loaded_model, error = await get_batch_model(car_batch.security_token)
+    if error is not None:
+        return error
+
+    async def rows():
+        for car in car_batch.cars:
+            yield car
+
+    return stream_batch(rows(), loaded_model)
+
+
+@app.post("/predict_batch/upload")
+@limiter.limit(lambda: predict_rate_limit)
+async def predict_batch_upload(request: Request, security_token: str):
+    """
+    Same as /predict_batch, but the cars are uploaded as NDJSON (one JSON
+    object per line) or as CSV (with a header line) when the content type
+    is text/csv.
+    """
+    loaded_model, error = await get_batch_model(security_token)
+    if error is not None:
+        return error
+
+    body_file = await spool_body(request)
+    content_type = request.headers.get("content-type", "")
+    return stream_batch(iter_uploaded_rows(body_file, content_type), loaded_model)
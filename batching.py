@@ -0,0 +1,185 @@
+"""
+Micro-batching of the predictions made by the API.
+
+Running the model on a single row costs almost as much as running it on a
+few dozen rows. The batcher collects the rows sent by concurrent requests
+for a few milliseconds, runs the model once on all of them and hands each
+request its own result.
+"""
+import asyncio
+import logging
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Sequence
+
+import numpy as np
+
+from metrics import histogram, STAGE_DURATION
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = histogram("iargus_batch_size_rows", "Number of rows in each batch run by the model",
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a row is submitted while the batcher queue is full.
+    """
+
+
+class PredictionBatcher:
+    """
+    Coalesces concurrent predictions into batches.
+
+    predict_fn is a coroutine function that receives a 2D array with one
+    row per request, along with the key the rows were submitted with, and
+    must return a sequence with one result per row. Rows submitted with
+    different keys, e.g. encoded for different versions of the model, are
+    never run in the same batch. A batch is run as soon as it contains max_batch_size rows or max_wait_ms
+    milliseconds after its first row arrived, whichever comes first. Up to
+    max_concurrent_batches batches run at the same time, the next batch
+    being collected in the meantime.
+    """
+    def __init__(self,
+                 predict_fn: Callable[[np.ndarray, Any], Awaitable[Sequence]],
+                 max_batch_size: int=32,
+                 max_wait_ms: float=5,
+                 max_queue_size: int=1024,
+                 max_concurrent_batches: int=1):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self.max_concurrent_batches = max_concurrent_batches
+        self._queue = None
+        self._worker = None
+        self._batch_slots = None
+        self._running_batches = set()
+
+        self.batches_count = 0
+        self.rows_count = 0
+        self.rejected_count = 0
+
+    async def start(self):
+        """
+        Starts the task that runs the batches. Must be called from the event
+        loop that will serve the requests.
+        """
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._batch_slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stops the batching task once the running batches are done. Rows
+        still in the queue, or in the batch being collected, are rejected.
+        """
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        await asyncio.gather(*self._running_batches, return_exceptions=True)
+        self._reject([self._queue.get_nowait() for _ in range(self._queue.qsize())])
+
+    def _reject(self, items: list):
+        """
+        Fails the requests of queued rows that will never be predicted.
+        """
+        for _, future, _, _ in items:
+            if not future.done():
+                future.set_exception(QueueFullError("The prediction queue has been shut down"))
+
+    async def submit(self, features: np.ndarray, key: Any=None):
+        """
+        Queues a single row of features and waits for its prediction. The
+        row is batched with the rows submitted with the same key, which is
+        passed on to predict_fn.
+
+        Raises QueueFullError if too many rows are already waiting.
+        """
+        if self._worker is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((features, future, perf_counter(), key))
+        except asyncio.QueueFull:
+            self.rejected_count += 1
+            raise QueueFullError("Too many predictions are waiting to be processed")
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Rows taken off the queue and not handed to a batch task yet
+            batch = []
+            try:
+                batch.append(await self._queue.get())
+                deadline = loop.time() + self.max_wait_ms / 1000
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Rows of different keys only meet while the model is being
+                # switched, so the window is simply split between them
+                groups = {}
+                for item in batch:
+                    groups.setdefault(item[3], []).append(item)
+                for key, group in groups.items():
+                    await self._batch_slots.acquire()
+                    task = asyncio.create_task(self._process(group, key))
+                    # Keeping a reference so that the task is not garbage collected
+                    self._running_batches.add(task)
+                    task.add_done_callback(self._running_batches.discard)
+                    batch = [item for item in batch if item[3] != key]
+            except asyncio.CancelledError:
+                # Stopped by stop(): the rows of the batch being collected
+                # are rejected like those still in the queue
+                self._reject(batch)
+                raise
+
+    async def _process(self, batch: list, key: Any):
+        batch_start = perf_counter()
+        for _, _, queued_at, _ in batch:
+            STAGE_DURATION.observe(batch_start - queued_at, stage="batch_queue_wait")
+        BATCH_SIZE.observe(len(batch))
+        try:
+            # Inside the try so that rows of different widths fail their own
+            # requests instead of the task, which would hold the slot forever
+            features = np.vstack([row for row, _, _, _ in batch])
+            results = await self.predict_fn(features, key)
+        except Exception as e:
+            logger.exception("Batched prediction failed")
+            for _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._batch_slots.release()
+
+        self.batches_count += 1
+        self.rows_count += len(batch)
+        for (_, future, _, _), result in zip(batch, results):
+            # The request may have been cancelled while waiting
+            if not future.done():
+                future.set_result(result)
+
+    def status(self) -> dict:
+        """
+        Returns counters describing the batches run so far.
+        """
+        return {"queued_rows": self._queue.qsize() if self._queue is not None else 0,
+                "batches": self.batches_count,
+                "rows": self.rows_count,
+                "rejected": self.rejected_count,
+                "mean_batch_size": self.rows_count / self.batches_count if self.batches_count else 0}
@@ -0,0 +1,65 @@
+"""
+Compares the cold start time and memory usage of the inference backends.
+
+Each backend is measured in a fresh process: the time and peak RSS include
+importing the API dependencies, loading the latest registered model and
+running a first prediction. MLFLOW_HOST must point to a tracking server
+where a version of iargus has been registered with its weights exported:
+    python benchmarks/backends.py
+"""
+import sys
+import json
+import argparse
+import resource
+import multiprocessing
+from time import perf_counter
+
+sys.path.append(".")
+
+
+def measure(backend: str, results):
+    """
+    Loads the model with the given backend and records how long it took and
+    the peak memory usage of the process.
+    """
+    start = perf_counter()
+    import numpy as np
+    from model_monitoring import encoder_cache
+    from model_cache import ModelCache
+
+    loaded_model = ModelCache(model_name="iargus", backend=backend).refresh()
+    n_features = sum(len(categories) for categories in encoder_cache.get().categories_) + 2
+    loaded_model.predict(np.zeros((1, n_features)))
+    results[backend] = {"cold_start_s": perf_counter() - start,
+                        # ru_maxrss is in kilobytes on Linux
+                        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                        "tensorflow_imported": "tensorflow" in sys.modules}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["keras", "numpy"])
+    parser.add_argument("--output", help="JSON file where the results are written")
+    args = parser.parse_args()
+
+    # Each backend runs in a fresh interpreter so that imports are not shared
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        results = manager.dict()
+        for backend in args.backends:
+            process = context.Process(target=measure, args=(backend, results))
+            process.start()
+            process.join()
+        results = dict(results)
+
+    for backend, result in results.items():
+        print(f"{backend:>6}: cold start {result['cold_start_s']:6.2f} s, "
+              f"peak RSS {result['peak_rss_mb']:7.1f} MB, "
+              f"TensorFlow imported: {result['tensorflow_imported']}")
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
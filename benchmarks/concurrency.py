@@ -0,0 +1,99 @@
+"""
+Measures the latency of /predict under concurrent load.
+
+Start the API first, with api.predict_rate_limit raised in config.yml so
+that the benchmark is not rate limited, e.g.:
+    uvicorn api:app --port 8000
+then run:
+    python benchmarks/concurrency.py --url http://localhost:8000 --token <token>
+
+Each level of concurrency runs that many clients in parallel, each one
+sending --requests requests one after the other. Run the benchmark on two
+commits to compare them.
+"""
+import sys
+import json
+import asyncio
+import argparse
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import httpx
+
+
+async def run_client(client: httpx.AsyncClient, payload: dict, requests_count: int, latencies: list, errors: list):
+    """
+    Sends requests_count requests to /predict one after the other and
+    records the latency of each one. Failed requests, including those whose
+    connection was closed, are counted as errors.
+    """
+    for _ in range(requests_count):
+        start = perf_counter()
+        try:
+            response = await client.post("/predict", json=payload)
+        except httpx.TransportError as e:
+            latencies.append(perf_counter() - start)
+            errors.append(type(e).__name__)
+            continue
+        latencies.append(perf_counter() - start)
+        if response.status_code != 200 or "predicted_price" not in response.json():
+            errors.append(response.status_code)
+
+
+async def run_level(url: str, payload: dict, concurrency: int, requests_count: int) -> dict:
+    """
+    Runs concurrency clients at the same time and summarizes their
+    latencies.
+    """
+    latencies = []
+    errors = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60, verify=False) as client:
+        start = perf_counter()
+        await asyncio.gather(*[run_client(client, payload, requests_count, latencies, errors)
+                               for _ in range(concurrency)])
+        elapsed = perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    return {"concurrency": concurrency,
+            "requests": len(latencies),
+            "errors": len(errors),
+            "throughput_rps": len(latencies) / elapsed,
+            "p50_ms": float(np.percentile(latencies_ms, 50)),
+            "p99_ms": float(np.percentile(latencies_ms, 99))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--token", required=True, help="A valid security token")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 128])
+    parser.add_argument("--requests", type=int, default=20, help="Requests sent by each client")
+    parser.add_argument("--output", help="JSON file where the results are written")
+    args = parser.parse_args()
+
+    testing_data = pd.read_csv("./test/testing_data.csv")
+    car = testing_data.iloc[0]
+    payload = {"state": car["state"].strip(),
+               "make": car["make"],
+               "model": car["model"],
+               "year": int(car["year"]),
+               "mileage": float(car["mileage"]),
+               "security_token": args.token}
+
+    results = []
+    for concurrency in args.concurrency:
+        result = asyncio.run(run_level(args.url, payload, concurrency, args.requests))
+        print(f"{concurrency:>4} clients: p50 {result['p50_ms']:8.1f} ms, "
+              f"p99 {result['p99_ms']:8.1f} ms, {result['throughput_rps']:8.1f} req/s, "
+              f"{result['errors']} errors")
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""
+Benchmarks of the hot paths of the API and of the monitoring script.
+
+The benchmarks run offline: MySQL is replaced by a local SQLite database
+filled with generated cars, and MLflow uses a tracking database stored in
+a temporary directory. Run them from the root of the repository:
+    python benchmarks/run_benchmarks.py --output results.json
+and compare two runs, e.g. made on two commits, with:
+    python benchmarks/run_benchmarks.py --output new.json --compare results.json
+
+Measured:
+- preprocess_features throughput on 1, 1k and 100k rows, and preprocess_car
+- get_data load time
+- end-to-end training time (train_model, registration included)
+- check_token cost, with and without the token cache
+- /predict latency and throughput through the FastAPI TestClient
+"""
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from datetime import date
+from time import perf_counter
+
+import numpy as np
+import yaml
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_DIR)
+sys.path.append(os.path.join(REPO_DIR, "benchmarks"))
+
+
+class SQLiteCursor:
+    """
+    Cursor of SQLiteConnection, usable as a context manager like the ones
+    of mysql.connector.
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cursor.close()
+
+    def execute(self, query: str, params=()):
+        # mysql.connector uses %s placeholders, SQLite uses ?
+        self._cursor.execute(query.replace("%s", "?"), params)
+
+    def executemany(self, query: str, params):
+        self._cursor.executemany(query.replace("%s", "?"), params)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size: int):
+        return self._cursor.fetchmany(size)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+
+class SQLiteConnection:
+    """
+    Stand-in for a mysql.connector connection, backed by SQLite.
+    """
+    unread_result = False
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def cursor(self, **kwargs):
+        return SQLiteCursor(self._db.cursor())
+
+    def commit(self):
+        self._db.commit()
+
+    def ping(self):
+        self._db.execute("SELECT 1")
+
+    def consume_results(self):
+        pass
+
+    def close(self):
+        self._db.close()
+
+
+def create_databases(workspace: str, rows: int) -> dict:
+    """
+    Creates the SQLite stand-ins of the two MySQL databases and returns
+    their paths. car_details is filled with generated cars.
+    """
+    from training_memory import generate_car_data
+
+    paths = {"iargus": os.path.join(workspace, "iargus.db"),
+             "iargus_api": os.path.join(workspace, "iargus_api.db")}
+
+    with sqlite3.connect(paths["iargus"]) as db:
+        db.execute("""CREATE TABLE car_details (id INTEGER PRIMARY KEY, state TEXT, model TEXT, make TEXT,
+                                                year INTEGER, mileage REAL, price REAL, date_added DATE)""")
+        db.execute("""CREATE INDEX idx_date_added ON car_details (date_added)""")
+        car_data = generate_car_data(rows)
+        car_data["date_added"] = date.today().isoformat()
+        db.executemany("""INSERT INTO car_details (state, model, make, year, mileage, price, date_added) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                       car_data[["state", "model", "make", "year", "mileage", "price", "date_added"]]
+                       .astype(object).to_numpy().tolist())
+
+    with sqlite3.connect(paths["iargus_api"]) as db:
+        db.execute("""CREATE TABLE tokens (id INTEGER PRIMARY KEY, first_name TEXT, surname TEXT, email TEXT,
+                                           token TEXT UNIQUE, creation_date DATE)""")
+        db.execute("""INSERT INTO tokens (first_name, surname, email, token, creation_date) VALUES (?, ?, ?, ?, ?)""",
+                   ("bench", "bench", "bench@mail.com", "bench_token", date.today().isoformat()))
+    return paths
+
+
+def create_workspace(predict_rate_limit: str) -> str:
+    """
+    Copies the files read by the API and the monitoring script to a
+    temporary directory, so that the benchmarks never modify the ones in
+    the repository (train_model rewrites config.yml).
+    """
+    workspace = tempfile.mkdtemp(prefix="iargus_bench_")
+    for filename in ["config.yml", "features_encoder.pkl", "cert.pem", "key.pem"]:
+        shutil.copy(os.path.join(REPO_DIR, filename), workspace)
+
+    config_path = os.path.join(workspace, "config.yml")
+    with open(config_path, "r") as config_file:
+        config = yaml.safe_load(config_file)
+    config["api"]["predict_rate_limit"] = predict_rate_limit
+    with open(config_path, "w") as config_file:
+        yaml.dump(config, config_file)
+    return workspace
+
+
+def summarize(durations: list) -> dict:
+    """
+    Returns the median, 99th percentile and mean of durations in
+    milliseconds.
+    """
+    durations_ms = np.array(durations) * 1000
+    return {"p50_ms": float(np.percentile(durations_ms, 50)),
+            "p99_ms": float(np.percentile(durations_ms, 99)),
+            "mean_ms": float(durations_ms.mean())}
+
+
+def bench_preprocessing(sizes: list, repeat: int) -> dict:
+    from training_memory import generate_car_data
+    from model_monitoring import preprocess_features, preprocess_car
+
+    results = {}
+    for size in sizes:
+        car_data = generate_car_data(size)
+        preprocess_features(car_data)
+        durations = []
+        for _ in range(repeat if size < 100000 else 3):
+            start = perf_counter()
+            preprocess_features(car_data, sparse=size > 1)
+            durations.append(perf_counter() - start)
+        results[f"{size}_rows"] = dict(summarize(durations), rows_per_s=size / float(np.median(durations)))
+
+    # Path used by /predict for a single car
+    car = generate_car_data(1).iloc[0]
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter()
+        preprocess_car(car)
+        durations.append(perf_counter() - start)
+    results["single_car"] = summarize(durations)
+    return results
+
+
+def bench_get_data() -> dict:
+    from model_monitoring import get_data
+
+    start = perf_counter()
+    car_data = get_data()
+    elapsed = perf_counter() - start
+    return {"rows": len(car_data), "seconds": elapsed, "rows_per_s": len(car_data) / elapsed}
+
+
+def bench_training(rows: int) -> dict:
+    from model_monitoring import load_records, train_model
+
+    start = perf_counter()
+    records = {name: values[:rows] for name, values in load_records().items()}
+    loading_time = perf_counter() - start
+    start = perf_counter()
+    mape = train_model(records)
+    return {"rows": len(records["price"]), "loading_s": loading_time, "training_s": perf_counter() - start,
+            "mape": float(mape)}
+
+
+def bench_check_token(repeat: int) -> dict:
+    import api
+
+    cold = []
+    warm = []
+    for _ in range(repeat):
+        api.token_cache.invalidate("bench_token")
+        start = perf_counter()
+        assert api.check_token("bench_token")
+        cold.append(perf_counter() - start)
+        start = perf_counter()
+        api.check_token("bench_token")
+        warm.append(perf_counter() - start)
+    return {"uncached": summarize(cold), "cached": summarize(warm)}
+
+
+def bench_predict(requests_count: int) -> dict:
+    from fastapi.testclient import TestClient
+    from training_memory import generate_car_data
+    import api
+
+    cars = generate_car_data(requests_count, seed=7)
+    with TestClient(api.app) as client:
+        durations = []
+        start = perf_counter()
+        for car in cars.itertuples():
+            payload = {"state": car.state, "make": car.make, "model": car.model,
+                       "year": int(car.year), "mileage": float(car.mileage),
+                       "security_token": "bench_token"}
+            request_start = perf_counter()
+            response = client.post("/predict", json=payload)
+            durations.append(perf_counter() - request_start)
+            assert "predicted_price" in response.json(), response.text
+        elapsed = perf_counter() - start
+    return dict(summarize(durations), requests=requests_count, throughput_rps=requests_count / elapsed)
+
+
+def compare(results: dict, reference_path: str):
+    """
+    Prints the ratio between the new results and those of a previous run.
+    """
+    with open(reference_path, "r") as reference_file:
+        reference = json.load(reference_file)["results"]
+
+    def walk(new, old, path):
+        for key, value in new.items():
+            if key not in old:
+                continue
+            if isinstance(value, dict):
+                walk(value, old[key], path + [key])
+            elif isinstance(value, (int, float)) and old[key]:
+                print(f"{'.'.join(path + [key]):<55} {old[key]:>12.3f} -> {value:>12.3f} ({value / old[key]:.2f}x)")
+    walk(results, reference, [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-rows", type=int, default=100000, help="Cars generated in the car_details stand-in")
+    parser.add_argument("--training-rows", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=200, help="Requests sent to /predict")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--output", help="JSON file where the results are written")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--keep-workspace", action="store_true")
+    args = parser.parse_args()
+
+    workspace = create_workspace(predict_rate_limit="1000000/minute")
+    db_paths = create_databases(workspace, args.db_rows)
+    os.environ.update({"MYSQL_HOST": "localhost", "MYSQL_USER": "bench", "MYSQL_PWD": "bench",
+                       "MLFLOW_HOST": f"sqlite:///{os.path.join(workspace, 'mlflow.db')}"})
+    os.environ["MLFLOW_TRACKING_URI"] = os.environ["MLFLOW_HOST"]
+    os.chdir(workspace)
+
+    # Every connection to MySQL goes to the SQLite stand-ins instead
+    import mysql.connector
+    import database
+    mysql.connector.connect = lambda database, **kwargs: SQLiteConnection(db_paths[database])
+
+    @contextmanager
+    def get_connection(database_name):
+        with SQLiteConnection(db_paths[database_name]) as db:
+            yield db
+    database.get_connection = get_connection
+    import api
+    api.get_connection = get_connection
+
+    results = {}
+    print("Benchmarking preprocess_features")
+    results["preprocess_features"] = bench_preprocessing([1, 1000, 100000], args.repeat)
+    print("Benchmarking get_data")
+    results["get_data"] = bench_get_data()
+    print("Benchmarking training")
+    results["training"] = bench_training(args.training_rows)
+    print("Benchmarking check_token")
+    results["check_token"] = bench_check_token(args.repeat)
+    print("Benchmarking /predict")
+    results["predict"] = bench_predict(args.requests)
+
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                            capture_output=True, text=True).stdout.strip()
+    output = {"commit": commit, "date": date.today().isoformat(), "results": results}
+    print(json.dumps(output, indent=2))
+    if args.output:
+        with open(os.path.join(REPO_DIR, args.output) if not os.path.isabs(args.output) else args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2)
+    if args.compare:
+        compare(results, os.path.join(REPO_DIR, args.compare) if not os.path.isabs(args.compare) else args.compare)
+    if not args.keep_workspace:
+        shutil.rmtree(workspace)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Serves the API offline, for benchmarks/concurrency.py.
+
+MySQL is replaced by the SQLite stand-ins of run_benchmarks.py and the
+model registered on MLflow by an untrained network with the architecture
+built by model_monitoring.build_model, so that the API can be load tested
+without any external service. Rate limiting is disabled.
+
+To compare two commits, check the older one out in a separate worktree and
+serve it on another port:
+    git worktree add /tmp/iargus_before <commit>
+    python benchmarks/standin_server.py --checkout /tmp/iargus_before --port 8001
+    python benchmarks/standin_server.py --port 8002
+    python benchmarks/concurrency.py --url http://localhost:8001 --token bench_token
+    python benchmarks/concurrency.py --url http://localhost:8002 --token bench_token
+"""
+import os
+import sys
+import shutil
+import pickle
+import argparse
+import tempfile
+from datetime import datetime
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkout", default=REPO_DIR, help="Checkout of the repository whose API is served")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--db-rows", type=int, default=1000, help="Cars generated in the car_details stand-in")
+    args = parser.parse_args()
+    checkout = os.path.abspath(args.checkout)
+
+    # The API reads its files from the working directory
+    workspace = tempfile.mkdtemp(prefix="iargus_standin_")
+    for filename in ["config.yml", "features_encoder.pkl", "cert.pem", "key.pem"]:
+        shutil.copy(os.path.join(checkout, filename), workspace)
+    os.chdir(workspace)
+    sys.path.insert(0, checkout)
+    sys.path.append(BENCHMARKS_DIR)
+
+    from run_benchmarks import SQLiteConnection, create_databases
+
+    db_paths = create_databases(workspace, args.db_rows)
+    os.environ.update({"MYSQL_HOST": "localhost", "MYSQL_USER": "bench", "MYSQL_PWD": "bench",
+                       "MLFLOW_HOST": f"sqlite:///{os.path.join(workspace, 'mlflow.db')}"})
+
+    # Every connection to MySQL goes to the SQLite stand-ins instead
+    import mysql.connector
+    import database
+    mysql.connector.connect = lambda database, **kwargs: SQLiteConnection(db_paths[database])
+    if hasattr(database, "open_pool"):
+        database.open_pool = lambda database_name: None
+    import api
+    api.get_connection = lambda database_name: SQLiteConnection(db_paths[database_name])
+
+    from tensorflow import keras
+    from model_cache import LoadedModel
+
+    with open("features_encoder.pkl", "rb") as encoder_file:
+        input_dim = sum(len(categories) for categories in pickle.load(encoder_file).categories_) + 2
+    model = keras.Sequential([keras.Input(shape=(input_dim,)),
+                              keras.layers.Dense(100, activation="relu"),
+                              keras.layers.Dense(50, activation="relu"),
+                              keras.layers.Dense(1)])
+
+    def refresh():
+        api.model_cache._current = LoadedModel("1", model, datetime.now())
+        return api.model_cache._current
+    api.model_cache.refresh = refresh
+    api.model_cache.start_background_refresh = lambda: None
+    api.limiter.enabled = False
+
+    import uvicorn
+    try:
+        uvicorn.run(api.app, host="127.0.0.1", port=args.port, log_level="warning")
+    finally:
+        shutil.rmtree(workspace)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
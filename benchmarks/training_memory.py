@@ -0,0 +1,100 @@
+"""
+Measures the peak memory used to preprocess the car data and train the
+model on it, with dense or sparse features.
+
+The data is generated from the categories known by the features encoder,
+so no database is needed:
+    python benchmarks/training_memory.py --rows 300000 3000000 --mode sparse --train
+
+Each measure runs in a fresh process so that peak RSS values are not
+shared between runs.
+"""
+import sys
+import json
+import argparse
+import resource
+import multiprocessing
+from time import perf_counter
+
+sys.path.append(".")
+
+
+def generate_car_data(rows: int, seed: int=42):
+    """
+    Generates random car details using the categories of the encoder.
+    """
+    import numpy as np
+    import pandas as pd
+    from model_monitoring import encoder_cache
+
+    rng = np.random.default_rng(seed)
+    states, makes, models = encoder_cache.get().categories_
+    return pd.DataFrame({"state": rng.choice(states, rows),
+                         "make": rng.choice(makes, rows),
+                         "model": rng.choice(models, rows),
+                         "year": rng.integers(1995, 2018, rows),
+                         "mileage": rng.uniform(0, 300000, rows),
+                         "price": rng.uniform(1000, 80000, rows)})
+
+
+def measure(rows: int, mode: str, train: bool, epochs: int, results):
+    """
+    Preprocesses (and optionally trains on) rows generated rows and records
+    the peak RSS of the process.
+    """
+    from model_monitoring import preprocess_features, build_model
+
+    car_data = generate_car_data(rows)
+    start = perf_counter()
+    X = preprocess_features(car_data, sparse=(mode == "sparse"))
+    y = car_data["price"].values
+    del car_data
+    preprocessing_time = perf_counter() - start
+
+    training_time = None
+    if train:
+        start = perf_counter()
+        model = build_model(X.shape[1])
+        model.fit(X, y, epochs=epochs, batch_size=100, verbose=0)
+        training_time = perf_counter() - start
+
+    results.append({"rows": rows,
+                    "mode": mode,
+                    "preprocessing_s": preprocessing_time,
+                    "training_s": training_time,
+                    # ru_maxrss is in kilobytes on Linux
+                    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[300000, 3000000])
+    parser.add_argument("--mode", choices=["dense", "sparse"], nargs="+", default=["sparse"])
+    parser.add_argument("--train", action="store_true", help="Also train the model on the features")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--output", help="JSON file where the results are written")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        results = manager.list()
+        for mode in args.mode:
+            for rows in args.rows:
+                process = context.Process(target=measure, args=(rows, mode, args.train, args.epochs, results))
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    print(f"{mode} run on {rows} rows failed (exit code {process.exitcode})")
+        results = list(results)
+
+    for result in results:
+        training = f", training {result['training_s']:.1f} s" if result["training_s"] is not None else ""
+        print(f"{result['mode']:>6}, {result['rows']:>8} rows: peak RSS {result['peak_rss_mb']:8.1f} MB, "
+              f"preprocessing {result['preprocessing_s']:.1f} s{training}")
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Lookup tables turning car categories into one-hot column indices.
+
+OneHotEncoder.transform validates its input and builds intermediate arrays
+on every call, which costs far more than the encoding itself when the API
+preprocesses a single car. The tables are built once from the categories_
+of the encoder and give the same columns: a category the encoder does not
+know gets no column, like with handle_unknown="ignore".
+"""
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+
+
+class CategoryLookup:
+    """
+    Maps the categories of each categorical feature to their index among
+    the categories known by the encoder, and to the one-hot column of the
+    features.
+
+    Single cars are looked up in dictionaries, batches in hash tables built
+    by pandas, which both return -1 for unknown categories.
+    """
+    def __init__(self, categories: Sequence[Sequence[str]]):
+        self.sizes = [len(feature_categories) for feature_categories in categories]
+        # Index of the first one-hot column of each categorical feature
+        self.offsets = np.cumsum([0] + self.sizes[:-1]).astype(np.int32)
+        self.n_categories = sum(self.sizes)
+        self._codes = [{category: code for code, category in enumerate(feature_categories)}
+                       for feature_categories in categories]
+        self._indexes = [pd.Index(feature_categories) for feature_categories in categories]
+
+    def encode_row(self, values: Sequence[str]) -> list:
+        """
+        Returns the code of each category of a single car, or -1 for
+        unknown categories.
+        """
+        return [codes.get(value, -1) for codes, value in zip(self._codes, values)]
+
+    def encode(self, columns: Sequence) -> np.ndarray:
+        """
+        Returns the codes of the categories of many cars, given as one array
+        of values per categorical feature, with one row per car.
+        """
+        return np.column_stack([index.get_indexer(np.asarray(values, dtype=object))
+                                for index, values in zip(self._indexes, columns)]).astype(np.int32)
+
+    def row_features(self, values: Sequence[str], numeric: Sequence[float]) -> np.ndarray:
+        """
+        Builds the dense features of a single car from its categories and
+        its year and mileage. Returns an array with a single row.
+        """
+        X = np.zeros((1, self.n_categories + len(numeric)))
+        for code, offset in zip(self.encode_row(values), self.offsets):
+            if code >= 0:
+                X[0, offset + code] = 1
+        X[0, self.n_categories:] = numeric
+        return X
+
+    def sparse_entries(self, codes: np.ndarray, numeric: np.ndarray) -> tuple:
+        """
+        Returns the row and column of each non-zero value of the sparse
+        features of many cars, sorted row by row then column by column,
+        and the values themselves.
+        """
+        n_rows = len(codes)
+        columns = np.empty((n_rows, codes.shape[1] + 2), dtype=np.int64)
+        columns[:, :-2] = codes + self.offsets
+        columns[:, -2:] = [self.n_categories, self.n_categories + 1]
+        values = np.ones(columns.shape, dtype=np.float32)
+        values[:, -2:] = numeric
+        # Unknown categories are left out, like the encoder does
+        known = np.ones(columns.shape, dtype=bool)
+        known[:, :-2] = codes >= 0
+        rows = np.broadcast_to(np.arange(n_rows)[:, None], columns.shape)
+        return rows[known], columns[known], values[known]
+
+    def sparse_features(self, codes: np.ndarray, numeric: np.ndarray) -> sp.csr_matrix:
+        """
+        Builds the sparse features of many cars from the codes returned by
+        encode and their year and mileage.
+        """
+        rows, columns, values = self.sparse_entries(codes, numeric)
+        return sp.csr_matrix((values, (rows, columns)), shape=(len(codes), self.n_categories + 2))
@@ -0,0 +1,115 @@
+"""
+Keras callbacks that let the monitoring script resume an interrupted
+training and stop a training that would run past its deadline.
+
+The model is saved at the end of every epoch along with a small state file
+holding the number of epochs done, the MLflow run the training is logged
+to and a key identifying the training. The next training with the same
+key picks up from the last saved epoch instead of starting over.
+
+Importing this module imports TensorFlow.
+"""
+import os
+import json
+import hashlib
+import logging
+from time import time
+from typing import Optional
+
+from tensorflow import keras
+
+
+logger = logging.getLogger(__name__)
+
+MODEL_FILENAME = "model.keras"
+STATE_FILENAME = "state.json"
+
+
+def training_key(kind: str, encoder_digest: str, last_training) -> str:
+    """
+    Returns a digest identifying a training: its kind, the encoder its
+    features are built with and the date of the last training it follows.
+
+    The data itself is not hashed: the replay sample of a fine-tuning is
+    drawn at random and rows keep being added between two runs, so the
+    interrupted training would never be resumed. None of the three values
+    changes until a training completes, and the encoder fixes the number
+    of features the saved model expects.
+    """
+    return hashlib.sha256(f"{kind}|{encoder_digest}|{last_training}".encode()).hexdigest()
+
+
+def load_checkpoint(checkpoint_dir: str, key: str) -> Optional[tuple]:
+    """
+    Returns the model saved in checkpoint_dir and the state saved with it
+    if they belong to the training identified by key, None otherwise.
+    """
+    state_path = os.path.join(checkpoint_dir, STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, "r") as state_file:
+        state = json.load(state_file)
+    if state["key"] != key:
+        logger.info("The checkpoint belongs to another training, it is ignored")
+        return None
+    model = keras.models.load_model(os.path.join(checkpoint_dir, MODEL_FILENAME))
+    return model, state
+
+
+def clear_checkpoint(checkpoint_dir: str):
+    """
+    Deletes the checkpoint once the training it belongs to is over.
+    """
+    for filename in [MODEL_FILENAME, STATE_FILENAME]:
+        path = os.path.join(checkpoint_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class EpochCheckpoint(keras.callbacks.Callback):
+    """
+    Saves the model and the training state at the end of every epoch.
+
+    Both files are written under a temporary name and then renamed, so an
+    interruption while saving leaves the previous checkpoint usable. The
+    state is renamed last: it is only replaced once the model it refers to
+    is in place.
+    """
+    def __init__(self, checkpoint_dir: str, key: str, run_id: str):
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.key = key
+        self.run_id = run_id
+
+    def on_epoch_end(self, epoch, logs=None):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        model_path = os.path.join(self.checkpoint_dir, MODEL_FILENAME)
+        # Keras checks the extension of the file name
+        self.model.save(model_path + ".tmp.keras")
+        os.replace(model_path + ".tmp.keras", model_path)
+        state_path = os.path.join(self.checkpoint_dir, STATE_FILENAME)
+        with open(state_path + ".tmp", "w") as state_file:
+            json.dump({"key": self.key, "epoch": epoch + 1, "run_id": self.run_id}, state_file)
+        os.replace(state_path + ".tmp", state_path)
+
+
+class Deadline(keras.callbacks.Callback):
+    """
+    Stops the training when the next epoch would not end before deadline,
+    a time.time() timestamp, judging by the duration of the last epoch.
+    """
+    def __init__(self, deadline: float):
+        super().__init__()
+        self.deadline = deadline
+        self.reached = False
+        self._epoch_start = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_duration = time() - self._epoch_start
+        if time() + epoch_duration > self.deadline:
+            logger.warning(f"Stopping the training after epoch {epoch + 1}, the next one would end after the deadline")
+            self.reached = True
+            self.model.stop_training = True
@@ -0,0 +1,65 @@
+"""
+Connections to the MySQL databases used by IArgus.
+
+Opening a MySQL connection costs several round trips, so connections are
+taken from a pool per database and given back once used.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from mysql.connector import pooling
+
+
+pool_size = 5
+_pools = {}
+_semaphores = {}
+_pools_lock = threading.Lock()
+
+
+def configure(size: int):
+    """
+    Sets the number of connections kept open per database. Must be called
+    before the first connection is requested.
+    """
+    global pool_size
+    pool_size = size
+
+
+def _get_pool(database: str):
+    with _pools_lock:
+        if database not in _pools:
+            # MYSQL username, password and host need to be set as environment variables
+            _pools[database] = pooling.MySQLConnectionPool(pool_name=f"{database}_pool",
+                                                           pool_size=pool_size,
+                                                           user=os.environ["MYSQL_USER"],
+                                                           password=os.environ["MYSQL_PWD"],
+                                                           host=os.environ["MYSQL_HOST"],
+                                                           database=database)
+            _semaphores[database] = threading.BoundedSemaphore(pool_size)
+        return _pools[database], _semaphores[database]
+
+
+def open_pool(database: str):
+    """
+    Creates the pool of the given database, which opens all its
+    connections, so that the first requests do not have to.
+    """
+    _get_pool(database)
+
+
+@contextmanager
+def get_connection(database: str):
+    """
+    Lends a connection to the given database for the duration of a with
+    block. If every connection is in use, waits for one to be given back
+    instead of failing like the pool itself would.
+    """
+    pool, semaphore = _get_pool(database)
+    with semaphore:
+        db = pool.get_connection()
+        try:
+            yield db
+        finally:
+            # Gives the connection back to the pool
+            db.close()
@@ -10,7 +10,8 @@ CREATE TABLE `car_details` (
   `mileage` float NOT NULL,
   `price` float NOT NULL,
   `date_added` date NOT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `idx_date_added` (`date_added`)
 ) ENGINE=InnoDB AUTO_INCREMENT=300001 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 CREATE DATABASE IF NOT EXISTS `iargus_api` /*!40100 DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci */ /*!80016 DEFAULT ENCRYPTION='N' */;
@@ -23,5 +24,6 @@ CREATE TABLE `tokens` (
   `email` varchar(100) NOT NULL,
   `token` varchar(64) NOT NULL,
   `creation_date` date NOT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `idx_token` (`token`)
 ) ENGINE=InnoDB AUTO_INCREMENT=300001 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
\ No newline at end of file
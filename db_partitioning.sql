@@ -0,0 +1,14 @@
+-- Optional: partitions car_details by month of date_added so that the
+-- monthly monitoring query only reads the partitions of the new records.
+-- Run it once after db_creation.sql, then set monitoring.partition_by_month
+-- to true in config.yml: model_monitoring.py will then create the
+-- partitions of the current and next month on each run.
+USE `iargus`;
+
+-- MySQL requires the partitioning column to be part of every unique key
+ALTER TABLE `car_details` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `date_added`);
+
+ALTER TABLE `car_details` PARTITION BY RANGE COLUMNS(`date_added`) (
+  PARTITION p_history VALUES LESS THAN ('2024-06-01'),
+  PARTITION p_future VALUES LESS THAN (MAXVALUE)
+);
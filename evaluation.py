@@ -0,0 +1,144 @@
+"""
+Cheap evaluation of the model on the records added since it was trained.
+
+Drift statistics compare the distribution of the new records with the one
+of the training records, using the population stability index (PSI) of
+each feature and of the price. They only need counts, so they are computed
+on all the new records in a few vectorized NumPy calls.
+
+The MAPE of the model is then estimated on a growing stratified sample of
+the new records, chunk by chunk, and the estimation stops as soon as the
+confidence interval of the estimate is entirely above or below the
+threshold.
+"""
+from statistics import NormalDist
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+
+def population_stability_index(expected_counts: np.ndarray, actual_counts: np.ndarray, epsilon: float=1e-4) -> float:
+    """
+    Returns the PSI between two distributions given as counts per bin.
+    Below 0.1, the distributions are usually considered the same.
+    """
+    expected = np.maximum(expected_counts / max(expected_counts.sum(), 1), epsilon)
+    actual = np.maximum(actual_counts / max(actual_counts.sum(), 1), epsilon)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def category_drift(reference_codes: np.ndarray, new_codes: np.ndarray, n_categories: int) -> float:
+    """
+    Returns the PSI of a categorical feature given as codes, unknown
+    categories (-1) being counted in their own bin.
+    """
+    reference_counts = np.bincount(reference_codes + 1, minlength=n_categories + 1)
+    new_counts = np.bincount(new_codes + 1, minlength=n_categories + 1)
+    return population_stability_index(reference_counts, new_counts)
+
+
+def numeric_drift(reference_values: np.ndarray, new_values: np.ndarray, bins: int=10) -> float:
+    """
+    Returns the PSI of a numeric feature, using bins that hold the same
+    number of reference values.
+    """
+    edges = np.unique(np.quantile(reference_values, np.linspace(0, 1, bins + 1)[1:-1]))
+    reference_counts = np.bincount(np.searchsorted(edges, reference_values, side="right"), minlength=len(edges) + 1)
+    new_counts = np.bincount(np.searchsorted(edges, new_values, side="right"), minlength=len(edges) + 1)
+    return population_stability_index(reference_counts, new_counts)
+
+
+def drift_statistics(reference: dict, new: dict, categorical_features: list, category_sizes: list,
+                     numeric_features: list) -> dict:
+    """
+    Computes the PSI of each feature between the reference records and the
+    new ones. Both are given as dicts holding the category codes under
+    "categories" (one column per categorical feature) and one array per
+    numeric feature.
+
+    Also returns the share of new records with an unknown category.
+    """
+    statistics = {}
+    for index, (feature, size) in enumerate(zip(categorical_features, category_sizes)):
+        statistics[f"{feature}_psi"] = category_drift(reference["categories"][:, index],
+                                                      new["categories"][:, index], size)
+    for feature in numeric_features:
+        statistics[f"{feature}_psi"] = numeric_drift(np.asarray(reference[feature]), np.asarray(new[feature]))
+    statistics["unknown_categories_share"] = float(np.mean((new["categories"] < 0).any(axis=1))) if len(new["categories"]) else 0.0
+    return statistics
+
+
+def stratified_order(strata: np.ndarray, seed: int=42) -> np.ndarray:
+    """
+    Returns an order of the records such that any number of records taken
+    from the start contains each stratum (given as non-negative integers)
+    in about the same proportion as the whole set of records.
+
+    Records are shuffled, ranked within their stratum and sorted by their
+    rank divided by the size of their stratum.
+    """
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(strata))
+    shuffled_strata = strata[order]
+    by_stratum = np.argsort(shuffled_strata, kind="stable")
+    sorted_strata = shuffled_strata[by_stratum]
+    # Position of the first record of each stratum once sorted
+    stratum_starts = np.searchsorted(sorted_strata, sorted_strata, side="left")
+    ranks = np.empty(len(strata))
+    ranks[by_stratum] = np.arange(len(strata)) - stratum_starts
+    positions = (ranks + rng.random(len(strata))) / np.bincount(shuffled_strata)[shuffled_strata]
+    return order[np.argsort(positions, kind="stable")]
+
+
+class SequentialEstimate:
+    """
+    Running mean of absolute percentage errors with a normal confidence
+    interval.
+    """
+    def __init__(self, confidence: float=0.95):
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.count = 0
+        self._sum = 0.0
+        self._sum_squares = 0.0
+
+    def add(self, errors: np.ndarray):
+        self.count += len(errors)
+        self._sum += float(np.sum(errors))
+        self._sum_squares += float(np.sum(np.square(errors)))
+
+    @property
+    def mean(self) -> float:
+        return self._sum / self.count if self.count else float("nan")
+
+    def interval(self) -> tuple:
+        if self.count < 2:
+            return float("-inf"), float("inf")
+        variance = max(self._sum_squares / self.count - self.mean ** 2, 0) * self.count / (self.count - 1)
+        margin = self.z * float(np.sqrt(variance / self.count))
+        return self.mean - margin, self.mean + margin
+
+
+def estimate_mape(evaluated_chunks: Iterable[np.ndarray], threshold: float, confidence: float=0.95,
+                  min_rows: int=1000, on_stop: Optional[Callable[[], None]]=None) -> dict:
+    """
+    Estimates the MAPE of a model from the absolute percentage errors of
+    successive chunks of a stratified sample.
+
+    Stops consuming evaluated_chunks as soon as min_rows errors have been
+    seen and the confidence interval of the estimate no longer contains
+    threshold; on_stop is then called, e.g. to cancel the chunks still
+    being evaluated.
+    """
+    estimate = SequentialEstimate(confidence)
+    stopped_early = False
+    for errors in evaluated_chunks:
+        estimate.add(errors)
+        low, high = estimate.interval()
+        if estimate.count >= min_rows and (high < threshold or low > threshold):
+            stopped_early = True
+            if on_stop is not None:
+                on_stop()
+            break
+    low, high = estimate.interval()
+    return {"mape": estimate.mean, "mape_low": low, "mape_high": high,
+            "rows_evaluated": estimate.count, "stopped_early": stopped_early}
@@ -1,32 +1,120 @@
 """
-This is a one-tine use script that loads part of the data in a CSV
-file and inserts it into the database.
+Loads car listings from a CSV file and inserts them into the database.
+
+The CSV file is read in chunks and inserted with parameterized batches, so
+that files of any size can be loaded. Progress is saved after each commit
+and an interrupted load can be resumed with --resume:
+    python fill_db.py ./experiments/true_car_listings.csv --resume
 """
 import os
+import sys
+import argparse
 from datetime import date
+from time import perf_counter
 
 import mysql.connector
 import pandas as pd
 
-with mysql.connector.connect(
-        host=os.environ["MYSQL_HOST"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database=os.environ["MYSQL_DB_NAME"],
-    ) as db:
+
+CSV_COLUMNS = ["State", "Make", "Model", "Year", "Mileage", "Price"]
+INSERT_QUERY = """INSERT INTO car_details (state, make, model, year, mileage, price, date_added) VALUES (%s, %s, %s, %s, %s, %s, %s)"""
+
+
+def read_progress(progress_path: str) -> int:
+    """
+    Returns the number of CSV rows already committed by a previous run.
+    """
+    if not os.path.exists(progress_path):
+        return 0
+    with open(progress_path, "r") as progress_file:
+        return int(progress_file.read().strip() or 0)
+
+
+def write_progress(progress_path: str, rows_done: int):
+    """
+    Saves the number of CSV rows committed so far.
+    """
+    with open(progress_path + ".tmp", "w") as progress_file:
+        progress_file.write(str(rows_done))
+    os.replace(progress_path + ".tmp", progress_path)
+
+
+def iter_batches(csv_path: str, batch_size: int, skip_rows: int=0):
+    """
+    Reads the CSV file batch_size rows at a time and yields each batch as a
+    list of tuples ready to be inserted.
+    """
+    date_added = date.today().strftime("%Y-%m-%d")
+    chunks = pd.read_csv(csv_path,
+                         usecols=CSV_COLUMNS,
+                         chunksize=batch_size,
+                         # Skipping the rows already inserted, but not the header
+                         skiprows=range(1, skip_rows + 1))
+    for chunk in chunks:
+        chunk = chunk[CSV_COLUMNS]
+        for column in ["State", "Make", "Model"]:
+            chunk[column] = chunk[column].str.strip()
+        chunk["date_added"] = date_added
+        # mysql.connector cannot convert numpy types, hence the conversion
+        # to Python objects
+        yield [tuple(row) for row in chunk.astype(object).to_numpy().tolist()]
+
+
+def ingest(csv_path: str, batch_size: int, commit_every: int, limit: int=None, resume: bool=False):
+    """
+    Inserts the rows of the CSV file into the car_details table.
+    """
+    progress_path = csv_path + ".progress"
+    rows_done = read_progress(progress_path) if resume else 0
+    if rows_done > 0:
+        print(f"Resuming after {rows_done} rows")
+
+    start = perf_counter()
+    rows_inserted = 0
+    rows_since_commit = 0
+    with mysql.connector.connect(
+            host=os.environ["MYSQL_HOST"],
+            user=os.environ["MYSQL_USER"],
+            password=os.environ["MYSQL_PWD"],
+            database=os.environ["MYSQL_DB_NAME"],
+        ) as db:
         with db.cursor() as c:
-            current_date = date.today()
-
-            df = pd.read_csv("./experiments/true_car_listings.csv").sample(n=300000)
-            df = df[["State", "Make", "Model", "Year", "Mileage", "Price"]]
-            df["State"] = df["State"].str.strip()
-            df["Make"] = df["Make"].str.strip()
-            df["Model"] = df["Model"].str.strip()
-            df["current_date"] = current_date.strftime("%Y-%m-%d")
-            rows = list(df.itertuples(index=False, name=None))
-            rows=rows[:50000]
-            values = ', '.join(map(str, rows))
-            query = f"""INSERT INTO car_details (state, make, model, year, mileage, price, date_added) VALUES {values}"""
-            print(query[:500])
-            c.execute(query)
-            db.commit()
\ No newline at end of file
+            for rows in iter_batches(csv_path, batch_size, skip_rows=rows_done):
+                if limit is not None:
+                    rows = rows[:limit - rows_inserted]
+                    if len(rows) == 0:
+                        break
+                # executemany sends the batch as a single multi-row INSERT
+                c.executemany(INSERT_QUERY, rows)
+                rows_inserted += len(rows)
+                rows_since_commit += len(rows)
+
+                if rows_since_commit >= commit_every:
+                    db.commit()
+                    write_progress(progress_path, rows_done + rows_inserted)
+                    rows_since_commit = 0
+                    elapsed = perf_counter() - start
+                    print(f"{rows_done + rows_inserted} rows inserted ({rows_inserted / elapsed:.0f} rows/s)")
+
+            db.commit()
+            write_progress(progress_path, rows_done + rows_inserted)
+
+    elapsed = perf_counter() - start
+    print(f"Done: {rows_inserted} rows inserted in {elapsed:.1f} s ({rows_inserted / max(elapsed, 1e-9):.0f} rows/s)")
+    return rows_inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv_path", nargs="?", default="./experiments/true_car_listings.csv")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Rows sent per INSERT")
+    parser.add_argument("--commit-every", type=int, default=50000, help="Rows inserted between two commits")
+    parser.add_argument("--limit", type=int, help="Maximum number of rows to insert")
+    parser.add_argument("--resume", action="store_true", help="Skip the rows committed by a previous run")
+    args = parser.parse_args()
+
+    ingest(args.csv_path, args.batch_size, args.commit_every, limit=args.limit, resume=args.resume)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Gunicorn configuration used to serve the API with several worker processes:
+    gunicorn -c gunicorn.conf.py api:app
+
+Settings are read from the "serving" section of config.yml.
+
+With preload enabled, the master process imports the API and loads the
+model and the encoder once, before forking the workers. The workers then
+share the memory pages holding them (copy-on-write) instead of each loading
+its own copy. This is only done with the "numpy" inference backend:
+TensorFlow cannot be used in a process forked after it was initialized, so
+with the "keras" backend each worker loads its own model.
+
+With reload_on_new_version enabled, the master watches the version marker
+written by the monitoring script (or MLflow, every
+api.model_refresh_interval seconds, when there is no marker). When the
+version to serve changes, it loads it (if preloading) and gracefully
+replaces the workers with new ones: the old workers finish the requests
+they are handling before exiting.
+"""
+import os
+import gc
+import signal
+import threading
+
+import yaml
+
+
+# Names of settings known to gunicorn must not be used for anything else here
+with open("./config.yml", "r") as config_file:
+    iargus_config = yaml.safe_load(config_file)
+serving_config = iargus_config["serving"]
+
+bind = serving_config["bind"]
+workers = serving_config["workers"]
+worker_class = "uvicorn.workers.UvicornWorker"
+graceful_timeout = serving_config["graceful_timeout"]
+preload_app = serving_config["preload"] and iargus_config["api"]["inference_backend"] == "numpy"
+reload_on_new_version = serving_config["reload_on_new_version"]
+model_refresh_interval = iargus_config["api"]["model_refresh_interval"]
+model_version_marker = iargus_config["api"]["model_version_marker"]
+model_marker_poll_interval = iargus_config["api"]["model_marker_poll_interval"]
+
+if reload_on_new_version:
+    # Inherited by the workers: the master checks for new versions, so they
+    # must not refresh the model on their own
+    os.environ["IARGUS_MODEL_RELOAD"] = "master"
+
+
+def configure_model_cache(model_cache):
+    """
+    Applies the settings that api.startup() applies in the workers to a
+    model cache used by the master process.
+    """
+    model_cache.backend = iargus_config["api"]["inference_backend"]
+    model_cache.precision = iargus_config["api"]["model_precision"]["precision"]
+    model_cache.max_mape_increase = iargus_config["api"]["model_precision"]["max_mape_increase"]
+    model_cache.mape_threshold = iargus_config["monitoring"]["MAPE_threshold"]
+    model_cache.refresh_interval = model_refresh_interval
+    model_cache.marker_path = model_version_marker
+    model_cache.warmup_batch_sizes = sorted({1, iargus_config["api"]["batching"]["max_batch_size"],
+                                             iargus_config["api"]["batch_chunk_size"]})
+    return model_cache
+
+
+def preload_model(server) -> bool:
+    """
+    Loads the latest version of the model and its encoder in the API
+    imported by the master process. Returns False if it could not be
+    loaded, in which case the workers load it themselves.
+    """
+    import api
+
+    configure_model_cache(api.model_cache)
+    try:
+        loaded_model = api.model_cache.refresh()
+        api.encoder_cache.get()
+    except Exception as e:
+        server.log.warning(f"The model could not be preloaded: {e}")
+        return False
+    if loaded_model is not None:
+        server.log.info(f"Version {loaded_model.version} of the model preloaded")
+    # Objects created so far are moved out of reach of the garbage collector
+    # so that collections in the workers do not write to the shared pages
+    gc.collect()
+    gc.freeze()
+    return True
+
+
+def watch_model_versions(server):
+    """
+    Reloads the workers whenever the version of the model to serve
+    changes.
+    """
+    from model_cache import ModelCache
+
+    if preload_app:
+        import api
+        model_cache = configure_model_cache(api.model_cache)
+    else:
+        model_cache = configure_model_cache(ModelCache(model_name="iargus"))
+    current_version = None
+    while True:
+        try:
+            version = model_cache.target_version()
+            if current_version is None:
+                current_version = version
+            elif version != current_version:
+                server.log.info(f"Switching to version {version} of the model, reloading the workers")
+                if preload_app:
+                    preload_model(server)
+                current_version = version
+                # Handled by the master loop like "kill -HUP": new workers are
+                # started, then the old ones are stopped gracefully
+                os.kill(os.getpid(), signal.SIGHUP)
+        except Exception as e:
+            server.log.warning(f"Could not check for a new version of the model: {e}")
+        threading.Event().wait(model_marker_poll_interval if model_version_marker else model_refresh_interval)
+
+
+def when_ready(server):
+    if preload_app:
+        preload_model(server)
+    if reload_on_new_version:
+        threading.Thread(target=watch_model_versions, args=(server,),
+                         name="model-version-watcher", daemon=True).start()
@@ -0,0 +1,245 @@
+"""
+Metrics collected by the API and the monitoring script, in the Prometheus
+text format.
+
+Metrics are kept in memory by the process that records them. The API
+exposes them on /metrics, while the monitoring script writes them to a
+file when it exits, for the node exporter textfile collector. Recording a
+value only takes a lock and a few additions, so metrics can be left on in
+production.
+"""
+import os
+import math
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Sequence
+
+
+# Upper bounds, in seconds, of the buckets of duration histograms. They go
+# from the cached paths of the API (sub-millisecond) to training (minutes).
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str], extra: str="") -> str:
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base class of the metrics. Each combination of label values is stored
+    as a separate series.
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str]=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects the labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        """
+        Yields the (suffix, label values, extra label, value) of each sample
+        of the metric.
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.label_names, label_values, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, e.g. a number of requests.
+    """
+    type = "counter"
+
+    def inc(self, amount: float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            series = list(self._series.items())
+        for label_values, value in series:
+            yield "_total", label_values, "", value
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, e.g. a number of requests in progress.
+
+    The value can also be computed when the metrics are rendered, by a
+    function given to set_function.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str]=()):
+        super().__init__(name, documentation, label_names)
+        self._functions = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def inc(self, amount: float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount: float=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels):
+        self._functions[self._key(labels)] = function
+
+    def samples(self):
+        with self._lock:
+            series = dict(self._series)
+        for label_values, function in self._functions.items():
+            series[label_values] = function()
+        for label_values, value in series.items():
+            yield "", label_values, "", value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, e.g. durations, counted in buckets.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str]=(), buckets: Sequence[float]=DURATION_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # Buckets are cumulative when rendered, so only the first bucket
+        # containing the value is incremented here
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the time spent in the with block, in seconds.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items()]
+        for label_values, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", label_values, f'le="{_format_value(bound)}"', cumulative
+            yield "_sum", label_values, "", total
+            yield "_count", label_values, "", count
+
+
+class Registry:
+    """
+    The metrics of a process, rendered together.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Registers a metric and returns it. If a metric with the same name
+        was already registered, e.g. because a module was imported twice,
+        that one is returned instead.
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, label_names: Sequence[str]=()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, label_names))
+
+
+def gauge(name: str, documentation: str, label_names: Sequence[str]=()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, label_names))
+
+
+def histogram(name: str, documentation: str, label_names: Sequence[str]=(), buckets: Sequence[float]=DURATION_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, label_names, buckets))
+
+
+STAGE_DURATION = histogram("iargus_stage_duration_seconds",
+                           "Time spent in each stage of the API and of the monitoring script",
+                           ["stage"])
+
+
+def timed(stage: str):
+    """
+    Context manager recording the time spent in a stage, e.g.
+        with timed("preprocess_features"):
+            ...
+    """
+    return STAGE_DURATION.time(stage=stage)
+
+
+def render() -> str:
+    """
+    Returns all the metrics of the process in the Prometheus text format.
+    """
+    return REGISTRY.render()
+
+
+def write_textfile(path: str):
+    """
+    Writes the metrics to a file, replaced atomically so that the node
+    exporter never reads a partially written file.
+    """
+    with open(path + ".tmp", "w") as metrics_file:
+        metrics_file.write(render())
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,378 @@
+"""
+Process-wide cache for the model registered on MLflow.
+
+The API used to fetch the model from MLflow on every request. The cache
+loads it once, keeps it in memory along with its registered version and
+switches to a new version in the background when one is registered.
+
+New versions are announced by the monitoring script through a version
+marker file, checked with a cheap stat() call every few seconds. When the
+marker does not exist, e.g. because the monitoring script runs on another
+machine, MLflow is polled instead. The marker can also be written by hand
+to roll every API process back to an older version, without restarting
+them:
+    python model_cache.py --set-version 3
+
+As long as the marker exists, MLflow is not polled: the version it names
+is served until the monitoring script registers a new version and
+rewrites it, or until the marker is removed to go back to the latest
+registered version:
+    python model_cache.py --clear
+"""
+import os
+import sys
+import json
+import pickle
+import logging
+import argparse
+import threading
+from datetime import datetime
+from time import monotonic
+from typing import Optional
+
+import numpy as np
+import mlflow
+from mlflow import MlflowClient
+
+from numpy_model import NumpyPredictor, WEIGHTS_FILENAME
+from tflite_model import TFLitePredictor, tflite_filename
+from category_lookup import CategoryLookup
+from metrics import timed
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_MARKER_PATH = "./model_version.json"
+
+
+def write_version_marker(version: str, path: str=VERSION_MARKER_PATH, model_name: str="iargus"):
+    """
+    Tells the API processes watching path to use the given version of the
+    model. The file is replaced atomically so that they never read a
+    partially written marker.
+    """
+    with open(path + ".tmp", "w") as marker_file:
+        json.dump({"model_name": model_name,
+                   "version": str(version),
+                   "written_at": datetime.now().isoformat()}, marker_file)
+    os.replace(path + ".tmp", path)
+
+
+def clear_version_marker(path: str=VERSION_MARKER_PATH):
+    """
+    Removes the version marker, so that the API processes watching path go
+    back to serving the latest version registered on MLflow.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class LoadedModel:
+    """
+    A model loaded from the registry, along with its version, the time it
+    was loaded at and the lookup tables of the encoder it was trained with.
+
+    Instances are never modified once created: the cache replaces the
+    whole object when a new version is loaded. Callers encode the features
+    with the lookup of the LoadedModel that predicts, so that a request
+    served during a switch never mixes the encoder of one version with the
+    model of another.
+    """
+    def __init__(self, version: str, model, loaded_at: datetime, lookup: Optional[CategoryLookup]=None):
+        self.version = version
+        self.model = model
+        self.loaded_at = loaded_at
+        self.lookup = lookup
+
+    def predict(self, features):
+        """
+        Runs the model on the provided features.
+        """
+        return self.model.predict(features, verbose=0)
+
+    @property
+    def input_dim(self) -> int:
+        return self.model.input_shape[-1]
+
+
+class ModelCache:
+    """
+    Keeps a version of a model in memory, by default the latest one.
+
+    Readers call get() and use the LoadedModel they receive for the whole
+    request. A new version is fully loaded and warmed up with a few
+    predictions before being assigned to self._current, so in-flight
+    requests never see a half-loaded model and the first requests served
+    by the new version are not slower than the others.
+
+    The version served is the one written in the version marker if there
+    is one, the latest version registered on MLflow otherwise. The previous
+    version is kept in memory so that rolling back to it is immediate.
+
+    With the "numpy" backend, the model is loaded from the weights exported
+    at training time and run without Keras. Versions that were trained
+    without exporting their weights are loaded with Keras. The float16 or
+    int8 TensorFlow Lite export is used instead of the float32 weights if
+    precision asks for it and its MAPE, measured at training time, is at
+    most max_mape_increase above the float32 one and below mape_threshold.
+    """
+    def __init__(self, model_name: str="iargus", refresh_interval: float=300, encoder_cache=None, backend: str="keras",
+                 marker_path: Optional[str]=None, marker_poll_interval: float=2, warmup_batch_sizes: tuple=(1,),
+                 precision: str="float32", max_mape_increase: float=0, mape_threshold: float=float("inf")):
+        self.model_name = model_name
+        self.refresh_interval = refresh_interval
+        self.backend = backend
+        self.encoder_cache = encoder_cache
+        self.marker_path = marker_path
+        self.marker_poll_interval = marker_poll_interval
+        self.warmup_batch_sizes = warmup_batch_sizes
+        self.precision = precision
+        self.max_mape_increase = max_mape_increase
+        self.mape_threshold = mape_threshold
+        self._current = None
+        self._previous = None
+        self._marker_id = None
+        self._marker_version = None
+        self._registry_version = None
+        self._next_registry_check = 0
+        self._load_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._refresh_thread = None
+
+    def get(self) -> Optional[LoadedModel]:
+        """
+        Returns the model currently in memory, or None if no model has been
+        loaded yet.
+        """
+        return self._current
+
+    def latest_version(self) -> Optional[str]:
+        """
+        Looks up the latest registered version of the model on MLflow.
+        Returns None if the model has never been registered.
+        """
+        client = MlflowClient(tracking_uri=os.environ["MLFLOW_HOST"])
+        with timed("mlflow_version_search"):
+            model_versions = client.search_model_versions(f"name='{self.model_name}'")
+        if len(model_versions) == 0:
+            return None
+        return str(max(model_versions, key=lambda v: int(v.version)).version)
+
+    def target_version(self, force_registry_check: bool=False) -> Optional[str]:
+        """
+        Returns the version that should be served: the one written in the
+        version marker if there is one, which pins it, the latest one
+        registered on MLflow otherwise.
+
+        The version marker is only read again when it changes, and MLflow
+        is only queried every refresh_interval seconds unless
+        force_registry_check is set, so this can be called often.
+        """
+        if self.marker_path:
+            try:
+                marker_stat = os.stat(self.marker_path)
+            except FileNotFoundError:
+                marker_stat = None
+            if marker_stat is not None:
+                # The marker is replaced rather than rewritten, so a new inode
+                # also means a new marker when both were written within the
+                # resolution of the modification time
+                marker_id = (marker_stat.st_ino, marker_stat.st_mtime_ns)
+                if marker_id != self._marker_id:
+                    with open(self.marker_path, "r") as marker_file:
+                        self._marker_version = str(json.load(marker_file)["version"])
+                    self._marker_id = marker_id
+                return self._marker_version
+        if force_registry_check or monotonic() >= self._next_registry_check:
+            self._registry_version = self.latest_version()
+            self._next_registry_check = monotonic() + self.refresh_interval
+        return self._registry_version
+
+    def refresh(self) -> Optional[LoadedModel]:
+        """
+        Loads the version that should be served if it differs from the one
+        in memory. Returns the model in memory after the refresh.
+        """
+        version = self.target_version(force_registry_check=True)
+        current = self._current
+        if version is None or (current is not None and current.version == version):
+            return current
+        return self.load_version(version)
+
+    def load_version(self, version: str) -> LoadedModel:
+        """
+        Loads, warms up and starts serving the given version of the model.
+        The version in memory until then is kept in case of a rollback.
+        """
+        # Only one thread loads a model at a time, the others keep serving
+        # the current one
+        with self._load_lock:
+            current = self._current
+            if current is not None and current.version == version:
+                return current
+            if self._previous is not None and self._previous.version == version:
+                # Rolling back to the version served before does not need
+                # to download it again
+                self._activate(self._previous)
+                return self._current
+
+            logger.info(f"Loading version {version} of model {self.model_name}")
+            mlflow.set_tracking_uri(uri=os.environ["MLFLOW_HOST"])
+            with timed("model_load"):
+                model = self._load_model(version)
+            lookup = None
+            if self.encoder_cache is not None:
+                with timed("encoder_load"):
+                    lookup = self._load_lookup(version)
+            loaded_model = LoadedModel(version, model, datetime.now(), lookup)
+            with timed("model_warmup"):
+                self.warm_up(loaded_model)
+            self._activate(loaded_model)
+            logger.info(f"Version {version} of model {self.model_name} is now in use")
+            return loaded_model
+
+    def warm_up(self, loaded_model: LoadedModel):
+        """
+        Runs the model on dummy batches of each size in warmup_batch_sizes,
+        so that graphs are traced and buffers allocated before real
+        requests are served.
+        """
+        for batch_size in self.warmup_batch_sizes:
+            loaded_model.predict(np.zeros((batch_size, loaded_model.input_dim), dtype=np.float32))
+
+    def _activate(self, loaded_model: LoadedModel):
+        """
+        Switches to an already loaded model.
+        """
+        if self._current is not loaded_model:
+            self._previous = self._current
+        self._current = loaded_model
+
+    def _load_model(self, version: str):
+        """
+        Loads the given version of the model with the configured backend.
+        """
+        if self.backend == "numpy":
+            try:
+                precision = self._select_precision(version)
+                if precision == "float32":
+                    return NumpyPredictor.load(self._download_artifact(version, WEIGHTS_FILENAME))
+                return TFLitePredictor.load(self._download_artifact(version, tflite_filename(precision)))
+            except Exception:
+                logger.warning(f"Version {version} of model {self.model_name} has no exported weights, loading it with Keras")
+        return mlflow.keras.load_model(f"models:/{self.model_name}/{version}")
+
+    def _select_precision(self, version: str) -> str:
+        """
+        Returns the precision of the weights to load for the given version:
+        the configured one if its MAPE is close enough to the float32 one,
+        float32 otherwise.
+        """
+        if self.precision == "float32":
+            return "float32"
+        client = MlflowClient(tracking_uri=os.environ["MLFLOW_HOST"])
+        run_id = client.get_model_version(self.model_name, version).run_id
+        run_metrics = client.get_run(run_id).data.metrics
+        baseline_mape = run_metrics.get("MAPE_float32")
+        variant_mape = run_metrics.get(f"MAPE_{self.precision}")
+        if baseline_mape is None or variant_mape is None:
+            logger.warning(f"Version {version} of model {self.model_name} has no evaluated {self.precision} weights, using float32")
+            return "float32"
+        if variant_mape - baseline_mape > self.max_mape_increase or variant_mape > self.mape_threshold:
+            logger.warning(f"The {self.precision} weights of version {version} of model {self.model_name} have a MAPE of "
+                           f"{variant_mape} against {baseline_mape} in float32, using float32")
+            return "float32"
+        logger.info(f"Using the {self.precision} weights of version {version} of model {self.model_name}, "
+                    f"their MAPE is {variant_mape} against {baseline_mape} in float32")
+        return self.precision
+
+    def _download_artifact(self, version: str, artifact_path: str) -> str:
+        """
+        Downloads an artifact logged in the run that produced the given
+        version of the model and returns its local path.
+        """
+        client = MlflowClient(tracking_uri=os.environ["MLFLOW_HOST"])
+        run_id = client.get_model_version(self.model_name, version).run_id
+        return mlflow.artifacts.download_artifacts(run_id=run_id, artifact_path=artifact_path)
+
+    def _load_lookup(self, version: str) -> CategoryLookup:
+        """
+        Builds the lookup tables of the encoder stored with the given
+        version of the model. Versions trained before the encoder was stored
+        along with the model use the current encoder of encoder_cache.
+        """
+        try:
+            encoder_path = self._download_artifact(version, "features_encoder.pkl")
+        except Exception:
+            logger.warning(f"Version {version} of model {self.model_name} has no encoder, using the current one")
+            return self.encoder_cache.lookup()
+        with open(encoder_path, "rb") as encoder_file:
+            return CategoryLookup(pickle.load(encoder_file).categories_)
+
+    def start_background_refresh(self):
+        """
+        Starts a daemon thread that checks for a new version of the model
+        every marker_poll_interval seconds (every refresh_interval seconds
+        without a version marker) and loads it.
+        """
+        if self._refresh_thread is not None:
+            return
+        self._stop_event.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop,
+                                                name="model-refresh",
+                                                daemon=True)
+        self._refresh_thread.start()
+
+    def stop_background_refresh(self):
+        """
+        Stops the refresh thread started by start_background_refresh.
+        """
+        if self._refresh_thread is None:
+            return
+        self._stop_event.set()
+        self._refresh_thread.join()
+        self._refresh_thread = None
+
+    def _refresh_loop(self):
+        interval = self.marker_poll_interval if self.marker_path else self.refresh_interval
+        while not self._stop_event.wait(interval):
+            try:
+                version = self.target_version()
+                current = self._current
+                if version is not None and (current is None or current.version != version):
+                    self.load_version(version)
+            except Exception:
+                # A temporary MLflow outage must not stop the refresh loop,
+                # the current model is kept in the meantime
+                logger.exception(f"Could not refresh model {self.model_name}")
+
+    def status(self) -> dict:
+        """
+        Describes the model currently in memory.
+        """
+        current = self._current
+        previous = self._previous
+        if current is None:
+            return {"model_name": self.model_name, "model_version": None, "loaded_at": None,
+                    "previous_version": None}
+        return {"model_name": self.model_name,
+                "model_version": current.version,
+                "loaded_at": current.loaded_at.isoformat(),
+                "previous_version": previous.version if previous is not None else None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tells the API processes which version of the model to serve")
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("--set-version", help="Version of the model to serve")
+    action.add_argument("--clear", action="store_true",
+                        help="Removes the version marker to serve the latest registered version again")
+    parser.add_argument("--marker", default=VERSION_MARKER_PATH, help="Path of the version marker")
+    args = parser.parse_args()
+    if args.clear:
+        clear_version_marker(args.marker)
+    else:
+        write_version_marker(args.set_version, args.marker)
+    sys.exit(0)
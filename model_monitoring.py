@@ -1,31 +1,139 @@
 import os
 import sys
+import atexit
+import shutil
+import tempfile
 import logging
 import pickle
+import hashlib
+import resource
+import threading
+import multiprocessing
 import yaml
 import smtplib
 from datetime import date
+from dateutil.relativedelta import relativedelta
 from time import time
 from email.mime.text import MIMEText
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_absolute_percentage_error
 import pytest
 import mysql.connector
 import mlflow
 from mlflow import MlflowClient
 from mlflow.models import infer_signature
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense
-from tensorflow.keras.callbacks import EarlyStopping
+
+from numpy_model import export_weights, WEIGHTS_FILENAME, NumpyPredictor
+from tflite_model import export_tflite, tflite_filename, TFLitePredictor
+from snapshot import TrainingSnapshot
+from category_lookup import CategoryLookup
+from metrics import timed, write_textfile
+from evaluation import drift_statistics, stratified_order, estimate_mape
 
 
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', filename='monitoring.log', level=logging.INFO)
 logger = logging.getLogger()
 
+ENCODER_PATH = "./features_encoder.pkl"
+# Encoder built for a training that has not registered its model yet. It
+# keeps the name of the live one since it is logged along with the model
+STAGED_ENCODER_PATH = "./staged_encoder/features_encoder.pkl"
+
+# Set by apply_resource_limits: time() timestamp after which trainings
+# stop, and numbers of intra-op and inter-op threads of TensorFlow
+training_deadline = None
+tensorflow_threads = (0, 0)
+_tensorflow_configured = False
+
+
+class TrainingInterrupted(Exception):
+    """
+    Raised when a training is stopped before the end because of the
+    deadline. It resumes from its last checkpoint at the next run.
+    """
+
+
+class EncoderCache:
+    """
+    Keeps the features encoder in memory so that it is not unpickled on
+    every call to preprocess_features.
+
+    The encoder file is checked with a cheap stat() call: it is read again
+    only if its modification time changed, and unpickled again only if its
+    content changed too. The lookup tables used to encode the categories
+    are rebuilt along with the encoder.
+    """
+    def __init__(self, path: str=ENCODER_PATH):
+        self.path = path
+        self._encoder = None
+        self._lookup = None
+        self._mtime = None
+        self._digest = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the encoder, loading it from disk if needed.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            logger.error("No encoding model was found, please train the model to generate one")
+            raise
+        if self._encoder is not None and mtime == self._mtime:
+            return self._encoder
+
+        with self._lock:
+            if self._encoder is None or mtime != self._mtime:
+                self._load(mtime)
+            return self._encoder
+
+    def lookup(self) -> CategoryLookup:
+        """
+        Returns the lookup tables built from the categories of the encoder.
+        """
+        self.get()
+        return self._lookup
+
+    def use_file(self, path: str):
+        """
+        Switches to another encoder file and loads it right away.
+        """
+        with self._lock:
+            self.path = path
+            self._load(os.stat(path).st_mtime_ns)
+
+    @property
+    def digest(self) -> str:
+        """
+        Returns the SHA-256 digest of the current encoder file.
+        """
+        self.get()
+        return self._digest
+
+    def _load(self, mtime: int):
+        with open(self.path, "rb") as encoder_file:
+            content = encoder_file.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if digest != self._digest:
+            logger.info(f"Loading features encoder from {self.path}")
+            encoder = pickle.loads(content)
+            # The lookup tables are replaced first since get() may return
+            # the encoder without taking the lock
+            self._lookup = CategoryLookup(encoder.categories_)
+            self._encoder = encoder
+            self._digest = digest
+        self._mtime = mtime
+
+
+# Shared by every caller of preprocess_features in the process
+encoder_cache = EncoderCache()
+
 def should_run() -> bool:
     """
     Compares the current date with the last monitoring date stored in
@@ -40,7 +148,85 @@ def should_run() -> bool:
     return time_diff.days >= 30
 
 
-def get_data(most_recent_only: bool=False, last_training_date=date.today()):
+CAR_DETAILS_COLUMNS = ["id", "state", "model", "make", "year", "mileage", "price", "date_added"]
+# Columns needed to train and test the model
+TRAINING_COLUMNS = ["state", "make", "model", "year", "mileage", "price"]
+# Compact types for the car details: the categorical columns only have a
+# few thousand distinct values
+CAR_DETAILS_DTYPES = {
+    "state": "category",
+    "model": "category",
+    "make": "category",
+    "year": "int16",
+    "mileage": "float32",
+    "price": "float32",
+}
+DEFAULT_CHUNK_SIZE = 50000
+CATEGORICAL_FEATURES = ["state", "make", "model"]
+
+
+def iter_data(most_recent_only: bool=False, last_training_date=None, chunk_size: int=DEFAULT_CHUNK_SIZE,
+              until_date=None, sample_fraction: float=None, columns: list=TRAINING_COLUMNS, after_id: int=None):
+    """
+    Retrieves car data from the database chunk by chunk.
+
+    Rows are streamed from an unbuffered cursor and yielded as DataFrames
+    of at most chunk_size rows, so that the whole table is never held in
+    memory. Only the given columns are retrieved.
+
+    If most_recent_only is set to True, only the records added after
+    last_training_date are retrieved. If until_date is set, only the
+    records added on or before that date are retrieved. Both filters use
+    the index on date_added. If sample_fraction is set, a random sample of
+    about that fraction of the records is retrieved. If after_id is set,
+    only the records with a greater id are retrieved.
+    """
+    logger.info("Retrieving data from database")
+    # MYSQL username, password and database name need to be set as environment variables
+    with mysql.connector.connect(
+        host=os.environ["MYSQL_HOST"],
+        user=os.environ["MYSQL_USER"],
+        password=os.environ["MYSQL_PWD"],
+        database="iargus",
+    ) as db:
+        with db.cursor(buffered=False) as c:
+            conditions = []
+            query_vars = []
+            if most_recent_only:
+                conditions.append("date_added > %s")
+                query_vars.append(last_training_date)
+            if until_date is not None:
+                conditions.append("date_added <= %s")
+                query_vars.append(until_date)
+            if sample_fraction is not None:
+                conditions.append("RAND() < %s")
+                query_vars.append(sample_fraction)
+            if after_id is not None:
+                conditions.append("id > %s")
+                query_vars.append(after_id)
+            # The column names come from this module, never from the user
+            query = f"""SELECT {', '.join(columns)} FROM car_details"""
+            if len(conditions) > 0:
+                query += " WHERE " + " AND ".join(conditions)
+            c.execute(query, tuple(query_vars))
+
+            try:
+                while True:
+                    with timed("database_fetch"):
+                        rows = c.fetchmany(chunk_size)
+                    if len(rows) == 0:
+                        break
+                    car_details_df = pd.DataFrame(rows, columns=columns)
+                    yield car_details_df.astype({column: dtype for column, dtype in CAR_DETAILS_DTYPES.items()
+                                                 if column in columns})
+            finally:
+                # The cursor cannot be closed before all the rows have been
+                # read, e.g. if the caller stopped iterating early
+                if db.unread_result:
+                    db.consume_results()
+
+
+def get_data(most_recent_only: bool=False, last_training_date=date.today(), chunk_size: int=DEFAULT_CHUNK_SIZE):
     """
     Retrieves car data from the database.
 
@@ -48,8 +234,80 @@ def get_data(most_recent_only: bool=False, last_training_date=date.today()):
     added after the latest training only. The last training date is 
     specified by last_training_date.
     """
-    logger.info("Retrieving data from database")
-    # MYSQL username, password and database name need to be set as environment variables
+    columns = CAR_DETAILS_COLUMNS[1:]
+    chunks = list(iter_data(most_recent_only, last_training_date, chunk_size, columns=columns))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns).astype(CAR_DETAILS_DTYPES)
+    # Categories differ from one chunk to the other, they are merged again
+    # after concatenation
+    return pd.concat(chunks, ignore_index=True).astype(CAR_DETAILS_DTYPES)
+
+
+def load_training_snapshot(snapshot_dir: str, chunk_size: int=DEFAULT_CHUNK_SIZE) -> TrainingSnapshot:
+    """
+    Brings the local snapshot of the records stored in snapshot_dir up to
+    date with the database and returns it.
+
+    Only the records added since the snapshot was last updated are
+    downloaded. The snapshot is rebuilt from scratch if the encoder
+    changed since it was created.
+    """
+    snapshot = TrainingSnapshot(snapshot_dir)
+    if snapshot.encoder_digest != encoder_cache.digest:
+        logger.info("The features encoder changed, rebuilding the training data snapshot")
+        snapshot.reset(encoder_cache.digest)
+
+    rows_before = snapshot.rows
+    for car_data in iter_data(after_id=snapshot.max_id, chunk_size=chunk_size,
+                              columns=["id"] + TRAINING_COLUMNS + ["date_added"]):
+        snapshot.append(encode_categories(car_data),
+                        car_data[["year", "mileage"]].to_numpy(dtype=np.float32),
+                        car_data["price"].to_numpy(),
+                        max_id=car_data["id"].max(),
+                        max_date_added=str(car_data["date_added"].max()))
+    logger.info(f"{snapshot.rows - rows_before} new records added to the training data snapshot ({snapshot.rows} records)")
+    return snapshot
+
+def encode_records(car_data: pd.DataFrame) -> dict:
+    """
+    Returns car data in the compact form used to train and evaluate the
+    model: category codes, year, mileage and price.
+    """
+    return {"categories": encode_categories(car_data),
+            "year": car_data["year"].to_numpy(dtype=np.float32),
+            "mileage": car_data["mileage"].to_numpy(dtype=np.float32),
+            "price": car_data["price"].to_numpy(dtype=np.float32)}
+
+def load_records(chunk_size: int=DEFAULT_CHUNK_SIZE, **filters) -> dict:
+    """
+    Retrieves the records matching filters (see iter_data) in the compact
+    form returned by encode_records.
+    """
+    chunks = [encode_records(car_data) for car_data in iter_data(chunk_size=chunk_size, **filters)]
+    if len(chunks) == 0:
+        return {"categories": np.empty((0, 3), dtype=np.int32), "year": np.empty(0, dtype=np.float32),
+                "mileage": np.empty(0, dtype=np.float32), "price": np.empty(0, dtype=np.float32)}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+def load_reference_records(snapshot_dir: str, last_training_date, sample_fraction: float,
+                           chunk_size: int=DEFAULT_CHUNK_SIZE) -> dict:
+    """
+    Returns the records the new ones are compared with to detect drift:
+    the training data snapshot if it is up to date, otherwise a sample of
+    the records added before the last training.
+    """
+    if snapshot_dir:
+        snapshot = TrainingSnapshot(snapshot_dir)
+        if snapshot.rows > 0 and snapshot.encoder_digest == encoder_cache.digest:
+            return snapshot.records()
+    return load_records(chunk_size, until_date=last_training_date, sample_fraction=sample_fraction)
+
+def get_categories() -> dict:
+    """
+    Retrieves the distinct values of each categorical feature from the
+    database.
+    """
+    categories = {}
     with mysql.connector.connect(
         host=os.environ["MYSQL_HOST"],
         user=os.environ["MYSQL_USER"],
@@ -57,38 +315,163 @@ def get_data(most_recent_only: bool=False, last_training_date=date.today()):
         database="iargus",
     ) as db:
         with db.cursor() as c:
-            if most_recent_only:
-                query = f"""SELECT * FROM car_details WHERE date_added > '{last_training_date.strftime("%Y-%m-%d")}'"""
-            else:
-                query = """SELECT * FROM car_details"""
-            c.execute(query)
-            car_data = c.fetchall()
+            for column in CATEGORICAL_FEATURES:
+                c.execute(f"""SELECT DISTINCT {column} FROM car_details""")
+                categories[column] = [row[0] for row in c.fetchall()]
+    return categories
 
-            column_names = ["id", "state", "model", "make", "year", "mileage", "price", "date_added"]
-            car_details_df = pd.DataFrame(car_data, columns=column_names)
-            car_details_df.drop(columns=["id"], inplace=True)
-            return car_details_df
+def add_month_partition(month_start: date):
+    """
+    Creates the partition of car_details that holds the records added
+    during the month starting on month_start, if it does not exist yet.
 
-def preprocess_features(raw_data: pd.DataFrame):
+    Only applies to databases partitioned with db_partitioning.sql: the
+    new partition is split from the p_future catch-all partition.
+    """
+    next_month_start = month_start + relativedelta(months=1)
+    partition_name = f"p{month_start.strftime('%Y_%m')}"
+    with mysql.connector.connect(
+        host=os.environ["MYSQL_HOST"],
+        user=os.environ["MYSQL_USER"],
+        password=os.environ["MYSQL_PWD"],
+        database="iargus",
+    ) as db:
+        with db.cursor() as c:
+            c.execute("""SELECT COUNT(*) FROM information_schema.PARTITIONS
+                         WHERE TABLE_SCHEMA='iargus' AND TABLE_NAME='car_details' AND PARTITION_NAME=%s""",
+                      (partition_name,))
+            if c.fetchone()[0] > 0:
+                return
+            # Partition definitions cannot be passed as parameters, the values
+            # are built from dates only
+            c.execute(f"""ALTER TABLE car_details REORGANIZE PARTITION p_future INTO (
+                              PARTITION {partition_name} VALUES LESS THAN ('{next_month_start.strftime("%Y-%m-%d")}'),
+                              PARTITION p_future VALUES LESS THAN (MAXVALUE))""")
+    logger.info(f"Partition {partition_name} added to car_details")
+
+def count_unknown_categories(categories: np.ndarray) -> int:
+    """
+    Counts the records whose category codes, computed by
+    encode_categories, contain a category the encoder does not know.
+    """
+    return int(np.count_nonzero((categories < 0).any(axis=1)))
+
+def update_encoder(categories: dict):
+    """
+    Builds a features encoder that knows the provided categories in
+    addition to the current ones and uses it in this process.
+
+    The new encoder is written to STAGED_ENCODER_PATH. The live encoder is
+    only replaced by publish_encoder once a model trained with the new one
+    is registered, so that a failed or interrupted training leaves the
+    encoder matching the registered model in place.
+    """
+    from sklearn.preprocessing import OneHotEncoder
+
+    current_encoder = encoder_cache.get()
+    all_categories = [sorted(set(current) | set(categories[column]))
+                      for column, current in zip(CATEGORICAL_FEATURES, current_encoder.categories_)]
+    encoder = OneHotEncoder(categories=all_categories, handle_unknown="ignore")
+    encoder.fit(pd.DataFrame({column: [values[0]] for column, values in zip(CATEGORICAL_FEATURES, all_categories)}))
+
+    encoder_dir = os.path.dirname(os.path.abspath(STAGED_ENCODER_PATH))
+    os.makedirs(encoder_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile("wb", dir=encoder_dir, delete=False) as encoder_file:
+        pickle.dump(encoder, encoder_file)
+    os.replace(encoder_file.name, STAGED_ENCODER_PATH)
+    encoder_cache.use_file(STAGED_ENCODER_PATH)
+    logger.info(f"The staged features encoder knows {sum(len(c) for c in all_categories)} categories")
+
+def encoder_is_staged() -> bool:
+    """
+    Returns True if this process uses an encoder that is not live yet.
+    """
+    return os.path.abspath(encoder_cache.path) == os.path.abspath(STAGED_ENCODER_PATH)
+
+def publish_encoder():
+    """
+    Makes the staged encoder the live one, once the model trained with it
+    has been registered. The file is replaced atomically so that processes
+    reading it through encoder_cache never see a partially written file.
+    """
+    if not encoder_is_staged():
+        return
+    os.replace(STAGED_ENCODER_PATH, ENCODER_PATH)
+    encoder_cache.use_file(ENCODER_PATH)
+    logger.info("The staged features encoder is now the live one")
+
+def discard_staged_encoder():
+    """
+    Goes back to the live encoder when the model trained with the staged
+    one is not registered.
+    """
+    if not encoder_is_staged():
+        return
+    encoder_cache.use_file(ENCODER_PATH)
+    os.remove(STAGED_ENCODER_PATH)
+    logger.info("The staged features encoder has been discarded")
+
+def preprocess_features(raw_data: pd.DataFrame, sparse: bool=False, lookup: CategoryLookup=None):
     """
     Preprocess raw data in order to turn in into features usable by
     the model.
 
-    Preprocessing includes encoding categorical features using OHE.
-    Returns the features as a numpy array.
+    Preprocessing includes encoding categorical features using OHE, with
+    the lookup tables built from the encoder rather than the encoder
+    itself, which gives the same features much faster.
+    Returns the features as a numpy array, or as a float32 CSR matrix if
+    sparse is True. Each row only has a handful of non-zero values among
+    thousands of columns, so the sparse matrix is much smaller.
+
+    lookup defaults to the tables of the current encoder. The API passes
+    the ones of the model that will make the predictions.
     """
-    logger.info("Preprocessing data")
-    try:
-        with open("./features_encoder.pkl", "rb") as encoder_file:
-            encoder = pickle.load(encoder_file)
-    except FileNotFoundError:
-        logger.error("No encoding model was found, please train the model to generate one")
-        raise
+    # Called on every request by the API, hence the debug level
+    logger.debug("Preprocessing data")
+    if lookup is None:
+        lookup = encoder_cache.lookup()
+    with timed("preprocess_features"):
+        categories = encode_categories(raw_data, lookup)
+        if sparse:
+            return features_from_codes(categories, raw_data[["year", "mileage"]].to_numpy(dtype=np.float32), lookup)
+
+        X = np.zeros((len(raw_data), lookup.n_categories + 2))
+        # Unknown categories are left out, like the encoder does
+        known = categories >= 0
+        X[np.nonzero(known)[0], (categories + lookup.offsets)[known]] = 1
+        X[:, lookup.n_categories] = raw_data["year"].values
+        X[:, lookup.n_categories + 1] = raw_data["mileage"].values
+        return X
+
+def preprocess_car(car, lookup: CategoryLookup=None):
+    """
+    Same as preprocess_features for a single car, given as an object with
+    the same attributes as the columns of car_details. Skips building a
+    DataFrame, which costs more than the encoding itself.
+    """
+    if lookup is None:
+        lookup = encoder_cache.lookup()
+    with timed("preprocess_features"):
+        return lookup.row_features([getattr(car, column) for column in CATEGORICAL_FEATURES],
+                                   [car.year, car.mileage])
 
-    cat_values = raw_data[["state", "make", "model"]]
-    one_hot_vec = encoder.transform(cat_values).toarray()
-    X = np.hstack((one_hot_vec, raw_data["year"].values[:, None], raw_data["mileage"].values[:, None]))
-    return X
+def encode_categories(raw_data: pd.DataFrame, lookup: CategoryLookup=None) -> np.ndarray:
+    """
+    Returns the index of the category of each categorical feature among
+    the categories known by the encoder, or -1 for unknown categories.
+    """
+    if lookup is None:
+        lookup = encoder_cache.lookup()
+    return lookup.encode([raw_data[column].to_numpy() for column in CATEGORICAL_FEATURES])
+
+def features_from_codes(categories: np.ndarray, numeric: np.ndarray, lookup: CategoryLookup=None):
+    """
+    Builds the same sparse features as preprocess_features from category
+    codes computed by encode_categories and from the year and mileage.
+    """
+    if lookup is None:
+        lookup = encoder_cache.lookup()
+    return lookup.sparse_features(categories, numeric)
 
 def send_email_alert(subject: str, email: str):
     """
@@ -111,73 +494,539 @@ def send_email_alert(subject: str, email: str):
        smtp_server.sendmail(sender, recipients, msg.as_string())
     logger.info(f"Email alert sent to {recipient}")
 
-def train_model(X, y):
+def build_model(input_dim: int, hidden_layers: tuple=(100, 50), learning_rate: float=0.001):
+    """
+    Creates the DNN used to predict car prices, compiled with MAPE as loss.
+
+    hidden_layers gives the number of units of each hidden layer.
+    """
+    # TensorFlow is only imported when training so that the API, which
+    # imports this module, can run without it
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Dense
+    from tensorflow.keras.optimizers import Adam
+
+    model = Sequential()
+    model.add(Dense(hidden_layers[0], input_shape=(input_dim,), activation='relu'))
+    for units in hidden_layers[1:]:
+        model.add(Dense(units, activation='relu'))
+    model.add(Dense(1, activation='linear'))
+    model.compile(loss='mean_absolute_percentage_error', optimizer=Adam(learning_rate=learning_rate), metrics=['mean_absolute_percentage_error'])
+    return model
+
+def numpy_export_precisions() -> list:
+    """
+    Returns the precisions the weights of new models are exported with for
+    the "numpy" backend of the API, or an empty list if they are not
+    exported.
+    """
+    with open("./config.yml", "r") as config_file:
+        monitoring_config = yaml.safe_load(config_file)["monitoring"]
+    if not monitoring_config["export_numpy_weights"]:
+        return []
+    return monitoring_config["numpy_precisions"]
+
+def log_model_artifacts(model, numpy_precisions: list, eval_batches=None):
     """
-    Creates a DNN and trains it using the data provided.
+    Logs the files the API needs along with a model to the active run.
 
-    MAPE is used to measure loss and accuracy.
+    The weights are exported with each of numpy_precisions: to an .npz file
+    in float32, to a TensorFlow Lite model in float16 and int8. If
+    evaluation batches (training_data.FeatureBatches) are provided, the
+    MAPE of each exported variant is logged as MAPE_<precision>, so that
+    the API can check how much accuracy a variant loses before using it.
     """
+    # The encoder is stored with the model so that the API can use the
+    # one matching the version it serves
+    mlflow.log_artifact(encoder_cache.path)
+    # Lets the API make predictions without Keras
+    with tempfile.TemporaryDirectory() as export_dir:
+        for precision in numpy_precisions:
+            if precision == "float32":
+                weights_path = os.path.join(export_dir, WEIGHTS_FILENAME)
+                export_weights(model, weights_path)
+                predictor_class = NumpyPredictor
+            else:
+                weights_path = os.path.join(export_dir, tflite_filename(precision))
+                export_tflite(model, weights_path, precision)
+                predictor_class = TFLitePredictor
+            mlflow.log_artifact(weights_path)
+            if eval_batches is not None:
+                # The exported file is evaluated rather than the model, so
+                # that the metric matches what the API will serve
+                y_pred = eval_batches.predict(predictor_class.load(weights_path))
+                mlflow.log_metric(f"MAPE_{precision}", mean_absolute_percentage_error(eval_batches.targets(), y_pred))
+
+def record_training_date():
+    """
+    Updates the last training date in the config file.
+    """
+    with open("./config.yml", "r") as config_file:
+        config = yaml.safe_load(config_file)
+    config["monitoring"]["last_training"] = date.today()
+    # The config is replaced at once so that an interruption cannot leave
+    # it half written
+    with open("./config.yml.tmp", "w") as config_file:
+        yaml.dump(config, config_file)
+    os.replace("./config.yml.tmp", "./config.yml")
+
+def apply_resource_limits(resources: dict):
+    """
+    Applies the limits of the "resources" section of the monitoring config
+    to the script and to the processes it starts. Limits set to 0 are not
+    applied.
+    """
+    global training_deadline, tensorflow_threads
+    tensorflow_threads = (resources["intra_op_threads"], resources["inter_op_threads"])
+    if resources["max_memory_mb"]:
+        # Allocations beyond the limit fail with a MemoryError instead of
+        # making the host swap. The limit applies to each process: the
+        # search and evaluation workers inherit it, each with the same
+        # budget as the script
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (resources["max_memory_mb"] * 1024 * 1024, hard_limit))
+    if resources["max_runtime_minutes"]:
+        training_deadline = time() + resources["max_runtime_minutes"] * 60
+    if resources["nice"]:
+        os.nice(resources["nice"])
+
+def configure_tensorflow_threads():
+    """
+    Sets the number of threads TensorFlow uses to run each operation and to
+    run operations in parallel, as given by tensorflow_threads. 0 lets
+    TensorFlow use every core.
+
+    Called before TensorFlow is first used: the settings cannot be changed
+    once it has run an operation.
+    """
+    global _tensorflow_configured
+    if _tensorflow_configured:
+        return
+    import tensorflow as tf
+
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(tensorflow_threads[0])
+        tf.config.threading.set_inter_op_parallelism_threads(tensorflow_threads[1])
+    except RuntimeError:
+        logger.warning("TensorFlow was already initialized, its number of threads could not be set")
+    _tensorflow_configured = True
+
+def announce_model_version(version: str):
+    """
+    Writes the version marker watched by the API so that it switches to the
+    newly registered version without waiting for its next MLflow check.
+    """
+    from model_cache import write_version_marker
+
+    with open("./config.yml", "r") as config_file:
+        marker_path = yaml.safe_load(config_file)["api"]["model_version_marker"]
+    if marker_path:
+        write_version_marker(version, marker_path)
+        logger.info(f"The API has been told to use version {version} of the model")
+
+def train_model(records: dict, base_model=None, epochs: int=150):
+    """
+    Creates a DNN and trains it using the records provided.
+
+    If base_model is provided, it is trained further instead of a new
+    model. records are in the form returned by load_records or
+    TrainingSnapshot.records, and are split into training, validation and
+    test sets by training_data. The features are built batch by batch, so
+    memory maps of a snapshot are never copied whole. MAPE is used to
+    measure loss and accuracy.
+
+    The model is saved after every epoch. If the training is interrupted,
+    the next training of the same kind, with the same encoder and since the
+    same last training date, resumes from the last saved epoch, in the same
+    MLflow run. Raises TrainingInterrupted if training_deadline
+    is reached before the end, in which case nothing is registered.
+    """
+
+    from tensorflow.keras.callbacks import EarlyStopping
+    from checkpointing import training_key, load_checkpoint, clear_checkpoint, EpochCheckpoint, Deadline
+    from training_data import FeatureBatches, EVALUATION_BATCH_SIZE
 
     logger.info("Training model")
+    numpy_precisions = numpy_export_precisions()
+    with open("./config.yml", "r") as config_file:
+        monitoring_config = yaml.safe_load(config_file)["monitoring"]
+    resources = monitoring_config["resources"]
+    configure_tensorflow_threads()
+    checkpoint_dir = resources["checkpoint_dir"]
     callback = EarlyStopping(monitor='val_loss', patience=3)
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.33, random_state=42)
+    lookup = encoder_cache.lookup()
+    train_batches = FeatureBatches(records, "train", lookup, batch_size=100, shuffle=True)
+    val_batches = FeatureBatches(records, "val", lookup, batch_size=EVALUATION_BATCH_SIZE)
+    test_batches = FeatureBatches(records, "test", lookup, batch_size=EVALUATION_BATCH_SIZE)
+    # A few dense rows are enough to describe the model inputs on MLflow
+    X_example, y_example = train_batches.example()
 
-    model = Sequential()
-    model.add(Dense(100, input_shape=(X_train.shape[1],), activation='relu'))
-    model.add(Dense(50, activation='relu'))
-    model.add(Dense(1, activation='linear'))
-    model.compile(loss='mean_absolute_percentage_error', optimizer='adam', metrics=['mean_absolute_percentage_error'])
+    kind = "train" if base_model is None else "fine_tune"
+    checkpoint_key = training_key(kind, encoder_cache.digest, monitoring_config["last_training"])
+    checkpoint = load_checkpoint(checkpoint_dir, checkpoint_key)
+    if checkpoint is not None:
+        model, state = checkpoint
+        initial_epoch, run_id = state["epoch"], state["run_id"]
+        logger.info(f"Resuming the training from epoch {initial_epoch}")
+    else:
+        model = base_model if base_model is not None else build_model(lookup.n_categories + 2)
+        initial_epoch, run_id = 0, None
+    run_name = f'{kind}_{int(time())}' if run_id is None else None
     mlflow.set_experiment("IArgus")
     
     #mlflow.keras.log_model(model, 'car_price_predictor')
     #mlflow.keras.autolog()
-    with mlflow.start_run(run_name=f'train_{int(time())}'):
-        signature = infer_signature(X_train, y_train)
+    with mlflow.start_run(run_id=run_id, run_name=run_name) as run:
+        signature = infer_signature(X_example, y_example)
         mlflow.keras.autolog()
-        model.fit(X_train, y_train, validation_split=0.1, epochs=150, batch_size=100, callbacks=[callback])
+        callbacks = [callback, EpochCheckpoint(checkpoint_dir, checkpoint_key, run.info.run_id)]
+        deadline = None
+        if training_deadline is not None:
+            if time() >= training_deadline:
+                raise TrainingInterrupted("The deadline was reached before the training started")
+            deadline = Deadline(training_deadline)
+            callbacks.append(deadline)
+        with timed("training"):
+            model.fit(train_batches, validation_data=val_batches, epochs=epochs,
+                      callbacks=callbacks, initial_epoch=initial_epoch)
+        if deadline is not None and deadline.reached:
+            logger.warning(f"The training was stopped by the deadline, it will resume from its checkpoint in {checkpoint_dir} at the next run")
+            raise TrainingInterrupted("The deadline was reached during the training")
         
-        model_info = mlflow.keras.log_model(
-            model=model,
-            artifact_path="iargus",
-            signature=signature,
-            input_example=X_train,
-            registered_model_name="iargus"
-        )
+        with timed("model_registration"):
+            model_info = mlflow.keras.log_model(
+                model=model,
+                artifact_path="iargus",
+                signature=signature,
+                input_example=X_example,
+                registered_model_name="iargus"
+            )
+            log_model_artifacts(model, numpy_precisions, test_batches)
         
 
+    clear_checkpoint(checkpoint_dir)
     logger.info("The model has been trained. Metrics related to it are available on MLflow")
+    publish_encoder()
+    announce_model_version(model_info.registered_model_version)
     # We update the config file to change the last training date
-    with open("./config.yml", "r") as config_file:
-        config = yaml.safe_load(config_file)
-    with open("./config.yml", "w") as config_file:
-        config["monitoring"]["last_training"] = date.today()
-        yaml.dump(config, config_file)
+    record_training_date()
     
-    return test_model(X_test, y_test)
+    return test_model(test_batches, test_batches.targets())
 
-@pytest.mark.skip(reason="This is NOT a unit test")
-def test_model(X_test, y_test):
+def latest_registered_version(model_versions) -> str:
     """
-    Evaluates the model with the provided data and returns the 
-    mean absolute percentage error.
+    Returns the highest of the given registered versions. MLflow does not
+    guarantee the order of search_model_versions, and the API serves the
+    highest version too.
     """
+    return max(model_versions, key=lambda version: int(version.version)).version
 
-    logger.info("Testing model")
-    mlflow.set_experiment("IArgus")
-    
+def load_latest_model():
+    """
+    Loads the latest registered version of the model from MLflow.
+    """
+    configure_tensorflow_threads()
     client = MlflowClient()
     model_versions = client.search_model_versions(f"name='iargus'")
     if len(model_versions) == 0:
         raise ValueError("No model has been trained. Call train_model first")
 
-    last_version = model_versions[0].version
+    last_version = latest_registered_version(model_versions)
     model_uri = f"models:/iargus/{last_version}"
-    model = mlflow.keras.load_model(model_uri)
+    with timed("model_load"):
+        return mlflow.keras.load_model(model_uri)
+
+def fine_tune_model(new_records: dict, replay_records: dict=None, epochs: int=20):
+    """
+    Trains the latest registered model further on new records instead of
+    training a new model on the whole database.
+
+    A sample of older records (replay_records) can be mixed with the new
+    ones so that the model does not forget them. Returns the MAPE of the
+    fine-tuned model, like train_model.
+    """
+    from training_data import concatenate_records
+
+    logger.info("Fine-tuning the latest model with new data")
+    model = load_latest_model()
+    records = new_records
+    if replay_records is not None:
+        records = concatenate_records(new_records, replay_records)
+    return train_model(records, base_model=model, epochs=epochs)
+
+# Records of the training data snapshot the candidates of a search are
+# trained on, mapped once per search worker process by _init_search_worker
+_search_records = None
+
+def _init_search_worker(snapshot_dir: str, threads: int, encoder_path: str):
+    """
+    Maps the training data snapshot in a search worker process and limits
+    the number of threads TensorFlow uses, so that the workers running at
+    the same time do not compete for the same cores. The worker uses the
+    encoder the snapshot was built with, which may be the staged one.
+    """
+    import tensorflow as tf
+
+    global _search_records
+    encoder_cache.use_file(encoder_path)
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    # The workers share the pages of the snapshot instead of each holding a
+    # copy of the features
+    _search_records = TrainingSnapshot(snapshot_dir).records()
+
+def train_candidate(candidate: dict, tracking_uri: str, experiment_id: str, parent_run_id: str,
+                    epochs: int, numpy_precisions: list, deadline: float=None) -> dict:
+    """
+    Trains the model described by candidate in a search worker process and
+    logs it as a run nested in the search run. Returns the id of the run
+    and the MAPE of the model on the validation set.
+
+    candidate gives the hidden_layers, learning_rate and batch_size of the
+    model. If deadline is set, the training stops after the last epoch that
+    ends before it and the candidate is compared as it is.
+    """
+    from tensorflow.keras.callbacks import EarlyStopping
+    from checkpointing import Deadline
+    from training_data import FeatureBatches, EVALUATION_BATCH_SIZE
+
+    mlflow.set_tracking_uri(tracking_uri)
+    lookup = encoder_cache.lookup()
+    train_batches = FeatureBatches(_search_records, "train", lookup, batch_size=candidate["batch_size"], shuffle=True)
+    val_batches = FeatureBatches(_search_records, "val", lookup, batch_size=EVALUATION_BATCH_SIZE)
+    X_example, y_example = train_batches.example()
+
+    model = build_model(lookup.n_categories + 2, tuple(candidate["hidden_layers"]), candidate["learning_rate"])
+    run_name = "candidate_" + "_".join(str(units) for units in candidate["hidden_layers"])
+    with mlflow.start_run(experiment_id=experiment_id, run_name=run_name,
+                          tags={"mlflow.parentRunId": parent_run_id}) as run:
+        mlflow.log_params(candidate)
+        callbacks = [EarlyStopping(monitor='val_loss', patience=3)]
+        if deadline is not None:
+            callbacks.append(Deadline(deadline))
+        model.fit(train_batches, validation_data=val_batches, epochs=epochs, callbacks=callbacks, verbose=0)
+        val_mape = mean_absolute_percentage_error(val_batches.targets(), val_batches.predict(model))
+        mlflow.log_metric("val_MAPE", val_mape)
+        mlflow.keras.log_model(model=model, artifact_path="iargus",
+                               signature=infer_signature(X_example, y_example))
+        log_model_artifacts(model, numpy_precisions, val_batches)
+    return {"run_id": run.info.run_id, "val_mape": float(val_mape), "candidate": candidate}
+
+def search_model(records: dict, candidates: list, processes: int, epochs: int=150, mape_threshold: float=None,
+                 snapshot_dir: str=None) -> float:
+    """
+    Trains several candidate models in parallel and registers the best one
+    if it beats the latest registered version.
+
+    Each candidate is trained in its own process, with its share of the CPU
+    cores, and logged as a run nested in a search run. The candidates are
+    compared on the validation set, then the best one and the latest
+    registered version are compared on the test set. If mape_threshold is
+    set, the candidates that have not started yet are skipped as soon as
+    one of them reaches it.
+
+    records are in the form returned by load_records or
+    TrainingSnapshot.records. If they are the records of the training data
+    snapshot stored in snapshot_dir, the workers map its files instead of a
+    copy of the records.
+
+    Returns the MAPE, on the test set, of the latest registered version
+    after the search.
+    """
+    from training_data import FeatureBatches, EVALUATION_BATCH_SIZE
+
+    logger.info(f"Searching among {len(candidates)} candidate models with {processes} processes")
+    numpy_precisions = numpy_export_precisions()
+    test_batches = FeatureBatches(records, "test", encoder_cache.lookup(), batch_size=EVALUATION_BATCH_SIZE)
+    y_test = test_batches.targets()
+    mlflow.set_experiment("IArgus")
+
+    with timed("model_search"), tempfile.TemporaryDirectory() as data_dir, \
+            mlflow.start_run(run_name=f"search_{int(time())}") as search_run:
+        if snapshot_dir is None:
+            # The records are written once and mapped by each worker process
+            # instead of being sent along with every candidate
+            snapshot_dir = data_dir
+            snapshot = TrainingSnapshot(snapshot_dir)
+            snapshot.reset(encoder_cache.digest)
+            snapshot.append(records["categories"], np.column_stack((records["year"], records["mileage"])),
+                            records["price"], max_id=0, max_date_added="")
+
+        results = []
+        # The cores allowed to TensorFlow are shared between the workers
+        threads = max(1, (tensorflow_threads[0] or os.cpu_count() or 1) // processes)
+        # TensorFlow cannot be used in forked processes
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_search_worker,
+                                 initargs=(snapshot_dir, threads, encoder_cache.path)) as executor:
+            futures = [executor.submit(train_candidate, candidate, mlflow.get_tracking_uri(),
+                                       search_run.info.experiment_id, search_run.info.run_id,
+                                       epochs, numpy_precisions, training_deadline)
+                       for candidate in candidates]
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    result = future.result()
+                except Exception:
+                    logger.exception("A candidate model could not be trained")
+                    continue
+                logger.info(f"Candidate {result['candidate']} has a validation MAPE of {result['val_mape']}")
+                results.append(result)
+                if mape_threshold is not None and result["val_mape"] <= mape_threshold:
+                    for other_future in futures:
+                        other_future.cancel()
+
+        if len(results) == 0:
+            raise RuntimeError("None of the candidate models could be trained")
+        best = min(results, key=lambda result: result["val_mape"])
+        best_model = mlflow.keras.load_model(f"runs:/{best['run_id']}/iargus")
+        best_mape = mean_absolute_percentage_error(y_test, test_batches.predict(best_model))
+        try:
+            current_mape = mean_absolute_percentage_error(y_test, test_batches.predict(load_latest_model()))
+        except Exception:
+            # No version has been registered yet, or it was trained with
+            # another encoder and cannot use the same features
+            logger.warning("The latest registered model cannot be evaluated on the new test set")
+            current_mape = float("inf")
+        mlflow.log_params({"best_run_id": best["run_id"], "candidates_trained": len(results)})
+        mlflow.log_metric("best_MAPE", best_mape)
+        if np.isfinite(current_mape):
+            mlflow.log_metric("current_MAPE", current_mape)
+
+    if best_mape >= current_mape:
+        logger.info(f"The best candidate does not beat the latest registered version ({best_mape} >= {current_mape}), it is not registered")
+        discard_staged_encoder()
+        return current_mape
+
+    model_version = mlflow.register_model(f"runs:/{best['run_id']}/iargus", "iargus")
+    logger.info(f"Candidate {best['candidate']} registered, its MAPE is {best_mape}")
+    publish_encoder()
+    announce_model_version(model_version.version)
+    record_training_date()
+    return best_mape
+
+# Model evaluated by an evaluation worker process, loaded once per process
+# by _init_evaluation_worker
+_evaluation_model = None
+
+def _init_evaluation_worker(model_version: str):
+    """
+    Loads the given version of the model in an evaluation worker process,
+    from its NumPy weights when they were exported.
+    """
+    from model_cache import ModelCache
+
+    global _evaluation_model
+    _evaluation_model = ModelCache(model_name="iargus", backend="numpy")._load_model(model_version)
+
+def evaluate_chunk(categories: np.ndarray, numeric: np.ndarray, price: np.ndarray) -> np.ndarray:
+    """
+    Returns the absolute percentage error of the model on each record of a
+    chunk, in an evaluation worker process.
+    """
+    y_pred = np.asarray(_evaluation_model.predict(features_from_codes(categories, numeric), verbose=0)).ravel()
+    # Same as mean_absolute_percentage_error, record by record
+    return np.abs(price - y_pred) / np.maximum(np.abs(price), np.finfo(np.float64).eps)
+
+def estimate_model_mape(records: dict, model_version: str, mape_threshold: float, processes: int,
+                        chunk_size: int, confidence: float=0.95, min_rows: int=1000) -> dict:
+    """
+    Estimates the MAPE of the given version of the model on records.
+
+    Records are evaluated in chunks by worker processes, in an order that
+    keeps every prefix stratified by make, and the estimation stops once
+    the MAPE is known to be above or below mape_threshold with the given
+    confidence. Returns the estimate, its confidence interval and the
+    number of records evaluated.
+    """
+    order = stratified_order(records["categories"][:, CATEGORICAL_FEATURES.index("make")] + 1)
+    numeric = np.column_stack((records["year"], records["mileage"]))
+    max_pending = 2 * processes
+    # TensorFlow cannot be used in forked processes
+    executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_evaluation_worker, initargs=(model_version,))
+
+    def evaluated_chunks():
+        # Chunks are submitted a few at a time and their results used in
+        # order, so that the records evaluated always form a prefix
+        pending = deque()
+        for start in range(0, len(order), chunk_size):
+            indices = np.sort(order[start:start + chunk_size])
+            pending.append(executor.submit(evaluate_chunk, records["categories"][indices],
+                                           numeric[indices], records["price"][indices]))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    with timed("evaluation"):
+        try:
+            return estimate_mape(evaluated_chunks(), mape_threshold, confidence=confidence, min_rows=min_rows,
+                                 on_stop=lambda: executor.shutdown(wait=False, cancel_futures=True))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+def check_model(new_records: dict, reference_records: dict, model_version: str, mape_threshold: float,
+                evaluation_config: dict):
+    """
+    Checks the given version of the model against the records added since
+    it was trained, logging the results as a run on MLflow.
+
+    Drift statistics are computed first. If none of them exceeds the drift
+    threshold and skip_without_drift is set, the model is not evaluated and
+    None is returned. Otherwise, returns the estimated MAPE of the model.
+    Without reference records, e.g. when the sample of the records added
+    before the last training is empty, the model is always evaluated.
+    """
+    encoder = encoder_cache.get()
+    mlflow.set_experiment("IArgus")
+    with mlflow.start_run(run_name=f'check_{int(time())}'):
+        if len(reference_records["price"]) == 0:
+            logger.warning("No reference records to compare the new records with, the drift statistics are skipped")
+        else:
+            with timed("drift_statistics"):
+                drift = drift_statistics(reference_records, new_records, CATEGORICAL_FEATURES,
+                                         [len(categories) for categories in encoder.categories_],
+                                         ["year", "mileage", "price"])
+            mlflow.log_metrics(drift)
+            logger.info(f"Drift statistics of the new records: {drift}")
+            max_psi = max(value for name, value in drift.items() if name.endswith("_psi"))
+            if (evaluation_config["skip_without_drift"] and max_psi < evaluation_config["drift_threshold"]
+                    and drift["unknown_categories_share"] == 0):
+                logger.info("The new records are distributed like the training records, the model is not evaluated")
+                return None
+
+        estimate = estimate_model_mape(new_records, model_version, mape_threshold,
+                                       processes=evaluation_config["processes"],
+                                       chunk_size=evaluation_config["chunk_size"],
+                                       confidence=evaluation_config["confidence"],
+                                       min_rows=evaluation_config["min_rows"])
+        mlflow.log_metrics({"MAPE": estimate["mape"],
+                            "MAPE_low": estimate["mape_low"],
+                            "MAPE_high": estimate["mape_high"],
+                            "rows_evaluated": estimate["rows_evaluated"]})
+        logger.info(f"MAPE estimated on {estimate['rows_evaluated']} of {len(new_records['price'])} new records: "
+                    f"{estimate['mape']} ({estimate['mape_low']} - {estimate['mape_high']})")
+        return estimate["mape"]
+
+@pytest.mark.skip(reason="This is NOT a unit test")
+def test_model(X_test, y_test):
+    """
+    Evaluates the model with the provided data and returns the 
+    mean absolute percentage error. X_test can be features or
+    training_data.FeatureBatches.
+    """
+
+    logger.info("Testing model")
+    mlflow.set_experiment("IArgus")
+    model = load_latest_model()
 
     # Calculer la métrique "manuellement"
     with mlflow.start_run(run_name=f'test_{int(time())}'):
         mlflow.keras.autolog()
-        y_pred = model.predict(X_test)
+        with timed("evaluation"):
+            y_pred = model.predict(X_test)
         mape = mean_absolute_percentage_error(y_test, y_pred)
         mlflow.log_metric("MAPE", mape)
 
@@ -191,45 +1040,106 @@ if __name__ == "__main__":
     if not should_run():
         sys.exit(0)
 
+    with open("./config.yml") as config_file:
+        config = yaml.safe_load(config_file)
+        last_training_date = config["monitoring"]["last_training"]
+        mape_threshold = config["monitoring"]["MAPE_threshold"]
+        chunk_size = config["monitoring"]["chunk_size"]
+        retraining_config = config["monitoring"]["retraining"]
+        partition_by_month = config["monitoring"]["partition_by_month"]
+        snapshot_dir = config["monitoring"]["snapshot_dir"]
+        evaluation_config = config["monitoring"]["evaluation"]
+        metrics_path = config["monitoring"]["metrics_path"]
+        resources = config["monitoring"]["resources"]
+
+    apply_resource_limits(resources)
+
+    if metrics_path:
+        # The script exits in many places, the metrics are written whatever
+        # the outcome of the run
+        atexit.register(write_textfile, metrics_path)
+
+    def load_all_records() -> tuple:
+        """
+        Brings the training data snapshot up to date and returns its
+        directory and its records. Without a configured snapshot, the
+        records are streamed chunk by chunk to a temporary one, removed at
+        the end of the run, so that they are never all held in memory.
+        """
+        directory = snapshot_dir
+        if not directory:
+            directory = tempfile.mkdtemp(prefix="iargus_records_")
+            atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        return directory, load_training_snapshot(directory, chunk_size=chunk_size).records()
+
+    if partition_by_month:
+        # Records of the current and next month go to their own partitions
+        # so that the monthly check only scans the most recent ones
+        current_month_start = date.today().replace(day=1)
+        add_month_partition(current_month_start)
+        add_month_partition(current_month_start + relativedelta(months=1))
+
     # If no model has been trained, we train one now
     mlflow.set_tracking_uri(uri=os.environ["MLFLOW_HOST"])
     client = MlflowClient()
     model_versions = client.search_model_versions(f"name='iargus'")
     if len(model_versions) == 0:
         logger.warning("No model found, training one now")
-        car_data = get_data(most_recent_only=False)
-        if len(car_data) == 0:
+        _, records = load_all_records()
+        if len(records["price"]) == 0:
             logger.warning("The database is empty")
             logger.warning("Exiting")
             sys.exit(0)
-        X = preprocess_features(car_data)
-        y = car_data["price"].values
-        train_model(X, y)
+        try:
+            train_model(records)
+        except TrainingInterrupted as e:
+            logger.warning(f"{e}, the training will resume at the next run")
         sys.exit(0)
 
-    # Retrieving all the records added after the last training
-    with open("./config.yml") as config_file:
-        config = yaml.safe_load(config_file)
-        last_training_date = config["monitoring"]["last_training"]
-        mape_threshold = config["monitoring"]["MAPE_threshold"]
-
-    # Testing the model with these data
-    car_data = get_data(most_recent_only=True, last_training_date=last_training_date)
-    if len(car_data) == 0:
+    # Testing the model with the records added after the last training
+    new_records = load_records(chunk_size, most_recent_only=True, last_training_date=last_training_date)
+    if len(new_records["price"]) == 0:
         logger.warning("No new data has been added since last training")
         logger.warning("Exiting")
         sys.exit(0)
-    X_test = preprocess_features(car_data)
-    y_test = car_data["price"].values
-    mape = test_model(X_test, y_test)
+    reference_records = load_reference_records(snapshot_dir, last_training_date,
+                                               evaluation_config["reference_fraction"], chunk_size=chunk_size)
+    latest_version = latest_registered_version(model_versions)
+    mape = check_model(new_records, reference_records, latest_version, mape_threshold, evaluation_config)
+    if mape is None:
+        sys.exit(0)
 
     if mape > mape_threshold:
         logger.warning(f"Mean Absolute Percentage Error is too high after testing the model with new data. {mape} exceeds threshold of {mape_threshold}. Model will be retrained using the new data")
-        # Retrieving ALL data in the database
-        all_car_data = get_data()
-        X = preprocess_features(all_car_data)
-        y = all_car_data["price"].values
-        new_mape = train_model(X, y)
+        unknown_rows = count_unknown_categories(new_records["categories"])
+        try:
+            if retraining_config["mode"] == "incremental" and unknown_rows == 0:
+                # The model is trained further on the new data, mixed with a
+                # sample of the data it was trained on
+                replay_records = load_records(chunk_size, until_date=last_training_date,
+                                              sample_fraction=retraining_config["replay_fraction"])
+                new_mape = fine_tune_model(new_records, replay_records,
+                                           epochs=retraining_config["fine_tune_epochs"])
+            else:
+                if unknown_rows > 0:
+                    # The number of features changes with the vocabulary, so a
+                    # new model has to be trained
+                    logger.warning(f"{unknown_rows} new records contain unknown categories. The encoder will be updated and a new model trained from scratch")
+                    update_encoder(get_categories())
+                # Retrieving ALL data in the database
+                records_dir, records = load_all_records()
+                if retraining_config["mode"] == "search":
+                    search_config = retraining_config["search"]
+                    new_mape = search_model(records, search_config["candidates"],
+                                            processes=search_config["processes"],
+                                            epochs=search_config["epochs"],
+                                            mape_threshold=mape_threshold,
+                                            snapshot_dir=records_dir)
+                else:
+                    new_mape = train_model(records)
+        except TrainingInterrupted as e:
+            logger.warning(f"{e}, the training will resume at the next run")
+            sys.exit(0)
 
         if new_mape > mape_threshold:
             subject = "Your model performance is getting low!"
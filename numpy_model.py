@@ -0,0 +1,79 @@
+"""
+Pure-NumPy implementation of the forward pass of the IArgus network.
+
+The network trained by model_monitoring.train_model is a stack of Dense
+layers. Its weights are exported to a small .npz file at training time so
+that the API can make predictions without importing TensorFlow, which
+makes workers start faster and use much less memory. The float16 and int8
+variants are served with TensorFlow Lite instead, see tflite_model.py.
+"""
+import numpy as np
+
+
+WEIGHTS_FILENAME = "iargus_weights.npz"
+
+ACTIVATIONS = {
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "linear": lambda x: x,
+}
+
+
+def export_weights(model, path: str):
+    """
+    Writes the weights and activations of a Keras model made of Dense
+    layers to an .npz file.
+    """
+    arrays = {}
+    activations = []
+    for i, layer in enumerate(model.layers):
+        kernel, bias = layer.get_weights()
+        activation = layer.get_config()["activation"]
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Activation {activation} of layer {layer.name} is not supported")
+        arrays[f"kernel_{i}"] = kernel.astype(np.float32)
+        arrays[f"bias_{i}"] = bias.astype(np.float32)
+        activations.append(activation)
+    np.savez(path, activations=np.array(activations), **arrays)
+
+
+class NumpyPredictor:
+    """
+    Runs the forward pass of a stack of Dense layers with NumPy.
+
+    predict() has the same interface as the one of Keras models so that
+    both can be used interchangeably.
+    """
+    def __init__(self, layers: list):
+        self.layers = layers
+
+    @classmethod
+    def load(cls, path: str) -> "NumpyPredictor":
+        """
+        Loads the weights written by export_weights.
+        """
+        with np.load(path) as weights:
+            activations = [str(activation) for activation in weights["activations"]]
+            layers = [(weights[f"kernel_{i}"], weights[f"bias_{i}"], activation)
+                      for i, activation in enumerate(activations)]
+        return cls(layers)
+
+    @property
+    def input_shape(self) -> tuple:
+        """
+        Shape of the inputs, like the input_shape of Keras models.
+        """
+        return (None, self.layers[0][0].shape[0])
+
+    def predict(self, X, verbose: int=0) -> np.ndarray:
+        """
+        Returns the output of the network for each row of X, which can be a
+        dense array or a scipy sparse matrix.
+        """
+        output = X
+        for kernel, bias, activation in self.layers:
+            # X @ kernel also works when X is a scipy sparse matrix, and
+            # always returns a dense array
+            output = np.asarray(output @ kernel, dtype=np.float32)
+            output += bias
+            output = ACTIVATIONS[activation](output)
+        return output
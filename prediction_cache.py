@@ -0,0 +1,177 @@
+"""
+Cache of the predictions made by the API.
+
+A large share of the requests ask for the price of the same cars over and
+over. Predictions are cached under the normalized details of the car and
+the version of the model that made them, so that loading a new version of
+the model invalidates them automatically.
+"""
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+from typing import Optional
+
+
+class MemoryBackend:
+    """
+    Stores the predictions in an LRU dictionary private to the process.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, ttl: float) -> Optional[float]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if time() - stored_at > ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: float) -> int:
+        """
+        Stores a value and returns the number of entries evicted to make
+        room for it.
+        """
+        with self._lock:
+            self._entries[key] = (value, time())
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """
+    Stores the predictions in a local SQLite database so that they are
+    shared by all the workers running on the same machine.
+
+    Evicting the least recently used entries requires a scan, so it is only
+    done once every evict_every insertions.
+    """
+    def __init__(self, path: str, max_size: int, evict_every: int=1000):
+        self.max_size = max_size
+        self.evict_every = evict_every
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        # WAL lets the workers read while another one writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                                key TEXT PRIMARY KEY,
+                                value REAL NOT NULL,
+                                stored_at REAL NOT NULL,
+                                accessed_at REAL NOT NULL)""")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS idx_accessed_at ON predictions (accessed_at)""")
+
+    def get(self, key: str, ttl: float) -> Optional[float]:
+        now = time()
+        with self._lock:
+            row = self._db.execute("""SELECT value, stored_at FROM predictions WHERE key=?""", (key,)).fetchone()
+            if row is None:
+                return None
+            value, stored_at = row
+            if now - stored_at > ttl:
+                self._db.execute("""DELETE FROM predictions WHERE key=?""", (key,))
+                return None
+            self._db.execute("""UPDATE predictions SET accessed_at=? WHERE key=?""", (now, key))
+            return value
+
+    def put(self, key: str, value: float) -> int:
+        """
+        Stores a value and returns the number of entries evicted.
+        """
+        now = time()
+        with self._lock:
+            self._db.execute("""INSERT OR REPLACE INTO predictions (key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?)""",
+                             (key, value, now, now))
+            self._inserts += 1
+            if self._inserts % self.evict_every != 0:
+                return 0
+            cursor = self._db.execute("""DELETE FROM predictions WHERE key IN (
+                                             SELECT key FROM predictions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""",
+                                      (self.max_size,))
+            return cursor.rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("""SELECT COUNT(*) FROM predictions""").fetchone()[0]
+
+
+class PredictionCache:
+    """
+    LRU cache of predicted prices with a time to live.
+
+    Mileages are rounded to the nearest multiple of mileage_bucket (if it
+    is not 0) so that cars with almost the same mileage share an entry.
+    """
+    def __init__(self, max_size: int=100000, ttl: float=3600, mileage_bucket: float=0,
+                 backend: str="memory", sqlite_path: str="./prediction_cache.sqlite"):
+        self.ttl = ttl
+        self.mileage_bucket = mileage_bucket
+        if backend == "sqlite":
+            self.backend = SQLiteBackend(sqlite_path, max_size)
+        else:
+            self.backend = MemoryBackend(max_size)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, car, model_version: str) -> str:
+        """
+        Builds the key under which the prediction made for car by the given
+        version of the model is stored.
+        """
+        mileage = float(car.mileage)
+        if self.mileage_bucket:
+            mileage = round(mileage / self.mileage_bucket) * self.mileage_bucket
+        # The categories are used as they are: the API normalizes them when
+        # validating the request, before both building the key and encoding
+        # the car, so that two keys never differ for the same features
+        return "|".join([str(model_version),
+                         car.state,
+                         car.make,
+                         car.model,
+                         str(int(car.year)),
+                         repr(mileage)])
+
+    def get(self, key: str) -> Optional[float]:
+        """
+        Returns the cached prediction, or None if there is none.
+        """
+        value = self.backend.get(key, self.ttl)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: float):
+        """
+        Caches a prediction.
+        """
+        self.evictions += self.backend.put(key, value)
+
+    def status(self) -> dict:
+        """
+        Returns the hit, miss and eviction counters of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {"size": len(self.backend),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0}
@@ -7,16 +7,15 @@ import pandas as pd
 import mlflow
 from mlflow import MlflowClient
 
-from model_monitoring import preprocess_features, train_model
+from model_monitoring import encode_records, train_model
 
 
 testing_data = pd.read_csv("./test/testing_data.csv")
-X = preprocess_features(testing_data)
-y = testing_data["price"].values
+records = encode_records(testing_data)
 
 # If no model has been trained, we train one quickly.
 mlflow.set_tracking_uri(uri=os.environ["MLFLOW_HOST"])
 client = MlflowClient()
 model_versions = client.search_model_versions(f"name='iargus'")
 if len(model_versions) == 0:
-    train_model(X, y)
\ No newline at end of file
+    train_model(records)
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+Local snapshot of the training data, kept between two monitoring runs.
+
+Retraining used to download the whole car_details table. The snapshot
+stores the encoded records as raw NumPy arrays on disk, along with the
+highest id and date_added they contain, so that each run only downloads
+the records added since the previous one. Arrays are appended to in place
+and read back through memory maps, without being copied in memory.
+"""
+import os
+import json
+from typing import Optional
+
+import numpy as np
+
+
+# Name, dtype and number of columns of each array
+ARRAYS = {
+    "categories": (np.int32, 3),
+    "numeric": (np.float32, 2),
+    "price": (np.float32, 1),
+}
+
+
+class TrainingSnapshot:
+    """
+    Encoded training records stored in a directory.
+
+    Category codes depend on the encoder they were computed with, so the
+    digest of that encoder is stored too: the snapshot has to be rebuilt
+    when the encoder changes.
+
+    meta.json is written after the arrays: if a run stops while appending,
+    the extra bytes are ignored and overwritten by the next append.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.meta = {"rows": 0, "max_id": 0, "max_date_added": None, "encoder_digest": None}
+        meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as meta_file:
+                self.meta = json.load(meta_file)
+
+    @property
+    def rows(self) -> int:
+        return self.meta["rows"]
+
+    @property
+    def max_id(self) -> int:
+        return self.meta["max_id"]
+
+    @property
+    def encoder_digest(self) -> Optional[str]:
+        return self.meta["encoder_digest"]
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.bin")
+
+    def _write_meta(self):
+        meta_path = os.path.join(self.directory, "meta.json")
+        with open(meta_path + ".tmp", "w") as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def reset(self, encoder_digest: str):
+        """
+        Empties the snapshot, e.g. because the encoder changed.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for name in ARRAYS:
+            open(self._path(name), "wb").close()
+        self.meta = {"rows": 0, "max_id": 0, "max_date_added": None, "encoder_digest": encoder_digest}
+        self._write_meta()
+
+    def append(self, categories: np.ndarray, numeric: np.ndarray, price: np.ndarray, max_id: int, max_date_added: str):
+        """
+        Appends encoded records to the snapshot.
+        """
+        values = {"categories": categories, "numeric": numeric, "price": price}
+        for name, (dtype, _) in ARRAYS.items():
+            with open(self._path(name), "r+b") as array_file:
+                # Overwrites anything written after the last complete append
+                array_file.seek(self.rows * np.dtype(dtype).itemsize * ARRAYS[name][1])
+                array_file.truncate()
+                array_file.write(np.ascontiguousarray(values[name], dtype=dtype).tobytes())
+
+        self.meta["rows"] += len(price)
+        self.meta["max_id"] = max(self.max_id, int(max_id))
+        if self.meta["max_date_added"] is None or max_date_added > self.meta["max_date_added"]:
+            self.meta["max_date_added"] = max_date_added
+        self._write_meta()
+
+    def arrays(self) -> tuple:
+        """
+        Returns the category codes, numeric features and prices of the
+        records as read-only memory maps.
+        """
+        if self.rows == 0:
+            return tuple(np.empty((0, columns) if columns > 1 else 0, dtype=dtype)
+                         for dtype, columns in ARRAYS.values())
+        return tuple(np.memmap(self._path(name), dtype=dtype, mode="r",
+                               shape=(self.rows, columns) if columns > 1 else (self.rows,))
+                     for name, (dtype, columns) in ARRAYS.items())
+
+    def records(self) -> dict:
+        """
+        Returns the records in the form returned by
+        model_monitoring.load_records, backed by the memory maps.
+        """
+        categories, numeric, price = self.arrays()
+        return {"categories": categories, "year": numeric[:, 0], "mileage": numeric[:, 1], "price": price}
@@ -3,15 +3,20 @@ Tests for the API.
 Note that the MLflow server needs to be running for these tests to work.
 """
 import sys
-from datetime import date
+import json
+from datetime import date, datetime
 
+import numpy as np
 import pandas as pd
 from fastapi.testclient import TestClient
 
 # Adding the parent directory to the system path so we can import the API
 
 sys.path.append(".")
-from api import app
+import api
+from api import app, CarDetails, prediction_cache
+from model_cache import LoadedModel
+from token_writer import TokenWriter
 
 client = TestClient(app)
 
@@ -61,3 +66,82 @@ def test_get_token():
 
 
     
+
+def test_health():
+    """
+    Test for /health/live and /health/ready
+    """
+    response = client.get("/health/live")
+    assert response.status_code == 200
+
+    # The startup of the API has not been run by this client
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+
+
+def test_car_normalization():
+    """
+    Makes sure a car is normalized once, so that the prediction cache and
+    the encoder see the same categories.
+    """
+    car = CarDetails(state=" TX ", make="Acura ", model="ILX", year=2014, mileage=35725, security_token="test")
+    assert (car.state, car.make) == ("TX", "Acura")
+    same_car = CarDetails(state="TX", make="Acura", model="ILX", year=2014, mileage=35725, security_token="test")
+    assert prediction_cache.make_key(car, "1") == prediction_cache.make_key(same_car, "1")
+
+
+class ConstantModel:
+    """
+    Stands for a trained model, predicting the same price for every car.
+    """
+    def predict(self, features, verbose=0):
+        return np.full((features.shape[0], 1), 10000.0)
+
+
+def test_predict_batch_mixed_rows(monkeypatch):
+    """
+    Makes sure invalid cars of a batch are reported on their own line,
+    whether the batch is sent as JSON, NDJSON or CSV.
+    """
+    monkeypatch.setattr(api, "check_token", lambda token: token == "valid")
+    monkeypatch.setattr(api.model_cache, "_current", LoadedModel("1", ConstantModel(), datetime.now()))
+    car = {"state": "TX", "make": "Acura", "model": "ILX", "year": 2014, "mileage": 35725}
+
+    def read_lines(response):
+        assert response.status_code == 200
+        return [json.loads(line) for line in response.text.splitlines()]
+
+    response = client.post("/predict_batch", json={"security_token": "valid",
+                                                   "cars": [car, "not a car", {**car, "year": "old"}, 3, car]})
+    lines = read_lines(response)
+    assert [line["index"] for line in lines] == [0, 1, 2, 3, 4]
+    assert [("predicted_price" in line) for line in lines] == [True, False, False, False, True]
+
+    ndjson = "\n".join([json.dumps(car), "{not json", json.dumps([1, 2]), json.dumps(car)])
+    response = client.post("/predict_batch/upload", params={"security_token": "valid"}, content=ndjson,
+                           headers={"content-type": "application/x-ndjson"})
+    assert [("predicted_price" in line) for line in read_lines(response)] == [True, False, False, True]
+
+    csv_body = "state,make,model,year,mileage\nTX,Acura,ILX,2014,35725\nTX,Acura,ILX,unknown,35725\nTX,Acura\n"
+    response = client.post("/predict_batch/upload", params={"security_token": "valid"}, content=csv_body,
+                           headers={"content-type": "text/csv"})
+    assert [("predicted_price" in line) for line in read_lines(response)] == [True, False, False]
+
+
+def test_unstored_token_is_forgotten(monkeypatch):
+    """
+    Makes sure a token is valid as soon as it is issued, and stops being
+    valid if its batch cannot be stored.
+    """
+    def write_rows(rows):
+        raise ConnectionError("The database is unavailable")
+
+    writer = TokenWriter(write_rows, max_wait_ms=60000)
+    monkeypatch.setattr(api, "token_writer", writer)
+    user_details = api.UserDetails(first_name="test", surname="test", email="test@mail.com")
+    api.store_token(user_details, "unstored_token")
+    assert api.token_cache.get("unstored_token") is not None
+    assert writer.pending("unstored_token") is not None
+
+    writer.stop()
+    assert api.token_cache.get("unstored_token") is None
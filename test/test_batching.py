@@ -0,0 +1,85 @@
+"""
+Unit tests for the micro-batching of the predictions.
+"""
+import sys
+import asyncio
+
+import numpy as np
+
+sys.path.append(".")
+from batching import PredictionBatcher, QueueFullError
+
+
+async def sum_rows(features, key):
+    return features.sum(axis=1).tolist()
+
+
+def test_batcher_coalesces_rows():
+    """
+    Makes sure concurrent rows are predicted in a single batch and that each
+    request gets its own result.
+    """
+    async def run():
+        batcher = PredictionBatcher(sum_rows, max_batch_size=8, max_wait_ms=50)
+        results = await asyncio.gather(*[batcher.submit(np.full((1, 3), i, dtype=float)) for i in range(4)])
+        await batcher.stop()
+        return results, batcher.status()
+
+    results, status = asyncio.run(run())
+    assert results == [0, 3, 6, 9]
+    assert status["batches"] == 1
+
+
+def test_batcher_separates_keys():
+    """
+    Makes sure rows submitted with different keys, e.g. for two versions of
+    the model, are never predicted in the same batch.
+    """
+    batches = []
+    async def record_rows(features, key):
+        batches.append((key, len(features)))
+        return [key] * len(features)
+
+    async def run():
+        batcher = PredictionBatcher(record_rows, max_batch_size=8, max_wait_ms=50)
+        results = await asyncio.gather(*[batcher.submit(np.ones((1, 3)), key) for key in ["1", "2", "1", "2", "1"]])
+        await batcher.stop()
+        return results
+
+    assert asyncio.run(run()) == ["1", "2", "1", "2", "1"]
+    assert sorted(batches) == [("1", 3), ("2", 2)]
+
+
+def test_batcher_survives_invalid_batch():
+    """
+    Makes sure rows that cannot be stacked fail their requests without
+    blocking the batcher.
+    """
+    async def run():
+        batcher = PredictionBatcher(sum_rows, max_batch_size=8, max_wait_ms=50, max_concurrent_batches=1)
+        for _ in range(2):
+            outcomes = await asyncio.wait_for(asyncio.gather(batcher.submit(np.ones((1, 5))),
+                                                             batcher.submit(np.ones((1, 7))),
+                                                             return_exceptions=True), 5)
+            assert all(isinstance(outcome, ValueError) for outcome in outcomes)
+        result = await asyncio.wait_for(batcher.submit(np.ones((1, 5))), 5)
+        await batcher.stop()
+        return result
+
+    assert asyncio.run(run()) == 5
+
+
+def test_batcher_stop_rejects_collected_rows():
+    """
+    Makes sure stopping the batcher fails the requests whose rows were
+    already taken off the queue for a batch that was not run yet.
+    """
+    async def run():
+        batcher = PredictionBatcher(sum_rows, max_batch_size=8, max_wait_ms=10000)
+        requests = [asyncio.ensure_future(batcher.submit(np.ones((1, 3)))) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        await batcher.stop()
+        return await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), 5)
+
+    outcomes = asyncio.run(run())
+    assert all(isinstance(outcome, QueueFullError) for outcome in outcomes)
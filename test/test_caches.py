@@ -0,0 +1,155 @@
+"""
+Unit tests for the caches used by the API.
+"""
+import os
+import sys
+from datetime import date
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.append(".")
+from token_cache import TokenCache
+from prediction_cache import PredictionCache
+from model_cache import ModelCache, write_version_marker, clear_version_marker
+from numpy_model import NumpyPredictor
+
+
+def test_token_cache():
+    """
+    Makes sure the token cache evicts the least recently used tokens and
+    forgets revoked ones.
+    """
+    cache = TokenCache(max_size=2, ttl=60)
+    cache.put("a", date(2030, 1, 1))
+    cache.put("b", date(2030, 1, 2))
+    assert cache.get("a") == date(2030, 1, 1)
+
+    # "b" is now the least recently used token
+    cache.put("c", date(2030, 1, 3))
+    assert cache.get("b") is None
+    assert cache.get("a") == date(2030, 1, 1)
+    assert len(cache) == 2
+
+    cache.invalidate("a")
+    assert cache.get("a") is None
+
+
+def test_token_cache_ttl():
+    """
+    Makes sure cached tokens expire after the TTL.
+    """
+    cache = TokenCache(max_size=10, ttl=0)
+    cache.put("a", date(2030, 1, 1))
+    assert cache.get("a") is None
+
+
+def test_prediction_cache(tmp_path):
+    """
+    Makes sure predictions are cached per model version, with both
+    backends.
+    """
+    car = SimpleNamespace(state="TX", make="Acura", model="ILX", year=2014, mileage=35725)
+    for backend in ["memory", "sqlite"]:
+        cache = PredictionCache(max_size=10, ttl=60, mileage_bucket=1000,
+                                backend=backend, sqlite_path=str(tmp_path / "cache.sqlite"))
+        key = cache.make_key(car, "1")
+        assert cache.get(key) is None
+        cache.put(key, 8995.0)
+        assert cache.get(key) == 8995.0
+
+        # Mileages in the same bucket share the same entry
+        close_car = SimpleNamespace(state="TX", make="Acura", model="ILX", year=2014, mileage=36100)
+        assert cache.make_key(close_car, "1") == key
+        # A new version of the model does not use the predictions of the
+        # previous one
+        assert cache.get(cache.make_key(car, "2")) is None
+
+        assert cache.status()["hits"] == 1
+        assert cache.status()["misses"] == 2
+
+
+def test_model_cache_version_marker(tmp_path):
+    """
+    Makes sure the model cache switches to the version written in the
+    marker, warms it up, and goes back to the previous version without
+    loading it again.
+    """
+    loads = []
+    class FakeModelCache(ModelCache):
+        def _load_model(self, version):
+            loads.append(version)
+            return NumpyPredictor([(np.ones((3, 1)), np.zeros(1), "linear")])
+
+    os.environ.setdefault("MLFLOW_HOST", "http://localhost:5000")
+    marker_path = str(tmp_path / "model_version.json")
+    cache = FakeModelCache(marker_path=marker_path, warmup_batch_sizes=(1, 4))
+    write_version_marker("1", marker_path)
+    assert cache.refresh().version == "1"
+    write_version_marker("2", marker_path)
+    assert cache.refresh().version == "2"
+    assert cache.status()["previous_version"] == "1"
+
+    write_version_marker("1", marker_path)
+    assert cache.refresh().version == "1"
+    assert loads == ["1", "2"]
+
+
+def test_model_cache_clear_version_marker(tmp_path):
+    """
+    Makes sure a version marker pins the version served even when a newer
+    one is registered, and that the cache goes back to the latest
+    registered version once the marker is cleared.
+    """
+    class FakeModelCache(ModelCache):
+        def latest_version(self):
+            return "3"
+
+        def _load_model(self, version):
+            return NumpyPredictor([(np.ones((3, 1)), np.zeros(1), "linear")])
+
+    os.environ.setdefault("MLFLOW_HOST", "http://localhost:5000")
+    marker_path = str(tmp_path / "model_version.json")
+    cache = FakeModelCache(marker_path=marker_path)
+    write_version_marker("1", marker_path)
+    assert cache.refresh().version == "1"
+    assert cache.refresh().version == "1"
+
+    clear_version_marker(marker_path)
+    assert not os.path.exists(marker_path)
+    assert cache.refresh().version == "3"
+    # Clearing a marker that does not exist does nothing
+    clear_version_marker(marker_path)
+
+
+def test_model_cache_select_precision(monkeypatch):
+    """
+    Makes sure the configured precision is only used when its MAPE is
+    close enough to the float32 one and below the threshold.
+    """
+    import model_cache
+
+    run_metrics = {}
+    class FakeClient:
+        def __init__(self, tracking_uri):
+            pass
+
+        def get_model_version(self, name, version):
+            return SimpleNamespace(run_id="run")
+
+        def get_run(self, run_id):
+            return SimpleNamespace(data=SimpleNamespace(metrics=run_metrics))
+
+    monkeypatch.setattr(model_cache, "MlflowClient", FakeClient)
+    monkeypatch.setenv("MLFLOW_HOST", "http://localhost:5000")
+    cache = ModelCache(precision="int8", max_mape_increase=0.005, mape_threshold=0.2)
+    # Versions whose int8 variant was not evaluated use float32
+    run_metrics.update({"MAPE_float32": 0.1})
+    assert cache._select_precision("1") == "float32"
+    run_metrics.update({"MAPE_int8": 0.104})
+    assert cache._select_precision("1") == "int8"
+    run_metrics.update({"MAPE_int8": 0.11})
+    assert cache._select_precision("1") == "float32"
+    run_metrics.update({"MAPE_float32": 0.198, "MAPE_int8": 0.201})
+    assert cache._select_precision("1") == "float32"
+    assert ModelCache(precision="float32")._select_precision("1") == "float32"
@@ -0,0 +1,42 @@
+"""
+Unit tests for checkpointing.py.
+"""
+import sys
+from datetime import date
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+pytest.importorskip("tensorflow")
+from checkpointing import training_key, load_checkpoint, clear_checkpoint, EpochCheckpoint, Deadline
+
+
+def test_training_resumes_from_checkpoint(tmp_path):
+    """
+    Makes sure a training stopped by the deadline can be resumed from the
+    epoch it was stopped at, by the same training only.
+    """
+    from tensorflow import keras
+
+    rng = np.random.default_rng(42)
+    X, y = rng.random((100, 5)), rng.random(100)
+    key = training_key("train", "encoder", date(2024, 1, 1))
+    assert key != training_key("train", "encoder", date(2024, 2, 1))
+    assert key != training_key("train", "new_encoder", date(2024, 1, 1))
+
+    model = keras.models.Sequential([keras.Input(shape=(5,)), keras.layers.Dense(1)])
+    model.compile(loss="mse", optimizer="adam")
+    deadline = Deadline(0)
+    checkpoint_dir = str(tmp_path)
+    model.fit(X, y, epochs=10, verbose=0,
+              callbacks=[EpochCheckpoint(checkpoint_dir, key, "run"), deadline])
+    assert deadline.reached
+
+    assert load_checkpoint(checkpoint_dir, training_key("fine_tune", "encoder", date(2024, 1, 1))) is None
+    resumed_model, state = load_checkpoint(checkpoint_dir, key)
+    assert state["epoch"] == 1 and state["run_id"] == "run"
+    assert np.allclose(resumed_model.predict(X, verbose=0), model.predict(X, verbose=0))
+
+    clear_checkpoint(checkpoint_dir)
+    assert load_checkpoint(checkpoint_dir, key) is None
@@ -0,0 +1,53 @@
+"""
+Unit tests for the drift statistics and the MAPE estimation used by the
+monitoring script.
+"""
+import sys
+
+import numpy as np
+
+sys.path.append(".")
+from evaluation import category_drift, numeric_drift, stratified_order, estimate_mape
+
+
+def test_drift():
+    """
+    Makes sure the PSI is close to 0 for identical distributions and high
+    for shifted ones.
+    """
+    rng = np.random.default_rng(0)
+    reference = rng.normal(size=10000)
+    assert numeric_drift(reference, rng.normal(size=5000)) < 0.05
+    assert numeric_drift(reference, rng.normal(1, size=5000)) > 0.25
+
+    codes = rng.integers(0, 10, size=10000)
+    assert category_drift(codes, rng.integers(0, 10, size=5000), 10) < 0.05
+    # Unknown categories have their own bin
+    assert category_drift(codes, np.full(5000, -1), 10) > 0.25
+
+
+def test_stratified_order():
+    """
+    Makes sure the order covers every record and that its first records
+    contain each stratum in the same proportion as the whole set.
+    """
+    strata = np.array([0] * 900 + [1] * 90 + [2] * 10)
+    order = stratified_order(strata)
+    assert sorted(order) == list(range(len(strata)))
+    assert list(np.bincount(strata[order[:100]])) == [90, 9, 1]
+
+
+def test_estimate_mape():
+    """
+    Makes sure the estimation stops as soon as the MAPE is clearly below
+    the threshold, and goes through all the chunks when it is not.
+    """
+    rng = np.random.default_rng(0)
+    chunks = [np.abs(rng.normal(0.1, 0.05, size=500)) for _ in range(10)]
+    estimate = estimate_mape(iter(chunks), threshold=0.2, min_rows=1000)
+    assert estimate["stopped_early"]
+    assert estimate["rows_evaluated"] == 1000
+    assert estimate["mape_low"] < estimate["mape"] < estimate["mape_high"] < 0.2
+
+    estimate = estimate_mape(iter(chunks), threshold=0.1, min_rows=1000)
+    assert estimate["rows_evaluated"] == 5000
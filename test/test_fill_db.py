@@ -0,0 +1,76 @@
+"""
+Unit tests for the loading of the car listings into the database.
+"""
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.append(".")
+import fill_db
+
+
+class FakeDatabase:
+    """
+    Stands in for the MySQL connection: inserted rows are only kept once
+    committed, and the connection fails after max_inserts INSERTs.
+    """
+    def __init__(self, max_inserts: int=None):
+        self.committed = []
+        self.uncommitted = []
+        self.max_inserts = max_inserts
+        self.inserts = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Closing the connection rolls back what was not committed
+        self.uncommitted = []
+
+    def cursor(self):
+        return self
+
+    def executemany(self, query, rows):
+        if self.max_inserts is not None and self.inserts >= self.max_inserts:
+            raise ConnectionError("Lost connection to MySQL server")
+        self.inserts += 1
+        self.uncommitted.extend(rows)
+
+    def commit(self):
+        self.committed.extend(self.uncommitted)
+        self.uncommitted = []
+
+
+def test_resume(tmp_path, monkeypatch):
+    """
+    Makes sure a resumed load skips the rows committed by the interrupted
+    one and inserts each row exactly once.
+    """
+    csv_path = str(tmp_path / "listings.csv")
+    pd.DataFrame({"Price": range(100),
+                  "Year": 2014,
+                  "Mileage": range(1000, 1100),
+                  "City": "Houston",
+                  "State": " TX",
+                  "Vin": "19VDE2E53EE000083",
+                  "Make": "Acura",
+                  "Model": "ILX6-Speed"}).to_csv(csv_path, index=False)
+    for variable in ["MYSQL_HOST", "MYSQL_USER", "MYSQL_PWD", "MYSQL_DB_NAME"]:
+        monkeypatch.setenv(variable, "test")
+
+    # The first run commits every 20 rows and fails after 50 rows
+    interrupted_db = FakeDatabase(max_inserts=5)
+    monkeypatch.setattr(fill_db.mysql.connector, "connect", lambda **kwargs: interrupted_db)
+    with pytest.raises(ConnectionError):
+        fill_db.ingest(csv_path, batch_size=10, commit_every=20)
+    assert len(interrupted_db.committed) == 40
+    assert fill_db.read_progress(csv_path + ".progress") == 40
+
+    resumed_db = FakeDatabase()
+    monkeypatch.setattr(fill_db.mysql.connector, "connect", lambda **kwargs: resumed_db)
+    assert fill_db.ingest(csv_path, batch_size=10, commit_every=20, resume=True) == 60
+    prices = [row[5] for row in interrupted_db.committed + resumed_db.committed]
+    assert prices == list(range(100))
+    assert resumed_db.committed[0][0] == "TX"
+    assert fill_db.read_progress(csv_path + ".progress") == 100
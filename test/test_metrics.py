@@ -0,0 +1,37 @@
+"""
+Unit tests for the metrics exposed by the API.
+"""
+import sys
+
+sys.path.append(".")
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_metrics_rendering():
+    """
+    Makes sure metrics are rendered in the Prometheus text format, with
+    cumulative histogram buckets.
+    """
+    registry = Registry()
+    requests = registry.register(Counter("requests", "Requests received", ["path"]))
+    in_progress = registry.register(Gauge("in_progress", "Requests in progress"))
+    duration = registry.register(Histogram("duration_seconds", "Request duration", buckets=(0.1, 1)))
+
+    requests.inc(path="/predict")
+    requests.inc(2, path="/predict")
+    in_progress.set_function(lambda: 4)
+    duration.observe(0.05)
+    duration.observe(0.5)
+    duration.observe(5)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE requests counter" in lines
+    assert 'requests_total{path="/predict"} 3.0' in lines
+    assert "in_progress 4.0" in lines
+    assert 'duration_seconds_bucket{le="0.1"} 1.0' in lines
+    assert 'duration_seconds_bucket{le="1.0"} 2.0' in lines
+    assert 'duration_seconds_bucket{le="+Inf"} 3.0' in lines
+    assert "duration_seconds_count 3.0" in lines
+
+    # Registering a metric twice returns the first one
+    assert registry.register(Counter("requests", "Requests received", ["path"])) is requests
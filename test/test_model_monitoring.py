@@ -4,12 +4,18 @@ order for these tests to run.
 """
 
 import sys
+import shutil
+from types import SimpleNamespace
+
+import pytest
 import pandas as pd
 import numpy as np
 import mlflow
+import mlflow.keras
 from mlflow import MlflowClient
 
-from model_monitoring import preprocess_features, test_model, train_model
+from model_monitoring import preprocess_features, preprocess_car, test_model, train_model, encode_categories, features_from_codes, encoder_cache, EncoderCache
+import model_monitoring
 
 sys.path.append(".")
 
@@ -33,6 +39,92 @@ def test_preprocessing():
         assert np.count_nonzero(X_test[row_index,:] == 0) >= minimum_zeros_count
         assert np.count_nonzero(X_test[row_index,:] == 1) <= 5
 
+def test_features_from_codes():
+    """
+    Makes sure the features built from category codes, which are stored in
+    the training data snapshot, match the ones built by preprocess_features.
+    """
+    testing_data = pd.read_csv("./test/testing_data.csv")
+    testing_data.loc[0, "model"] = "An unknown model"
+    X_expected = preprocess_features(testing_data, sparse=True)
+
+    codes = encode_categories(testing_data)
+    assert codes[0, 2] == -1
+    X = features_from_codes(codes, testing_data[["year", "mileage"]].values)
+    assert X.shape == X_expected.shape
+    assert abs(X - X_expected).max() == 0
+
+def test_preprocessing_matches_encoder():
+    """
+    Makes sure the lookup tables used by preprocess_features give the same
+    features as the encoder they were built from, unknown categories
+    included, for batches and for single cars.
+    """
+    testing_data = pd.read_csv("./test/testing_data.csv")
+    testing_data.loc[0, "state"] = "An unknown state"
+    one_hot_vec = encoder_cache.get().transform(testing_data[["state", "make", "model"]]).toarray()
+    X_expected = np.hstack((one_hot_vec, testing_data[["year", "mileage"]].values))
+
+    assert np.array_equal(preprocess_features(testing_data), X_expected)
+    for row_index in range(3):
+        car = testing_data.iloc[row_index]
+        assert np.array_equal(preprocess_car(car), X_expected[row_index:row_index + 1])
+
+def test_staged_encoder(tmp_path, monkeypatch):
+    """
+    Makes sure an updated encoder only replaces the live one when it is
+    published, and that a discarded one leaves it untouched.
+    """
+    live_path = tmp_path / "features_encoder.pkl"
+    shutil.copy(encoder_cache.path, live_path)
+    monkeypatch.setattr(model_monitoring, "ENCODER_PATH", str(live_path))
+    monkeypatch.setattr(model_monitoring, "STAGED_ENCODER_PATH", str(tmp_path / "staged" / "features_encoder.pkl"))
+    cache = EncoderCache(str(live_path))
+    monkeypatch.setattr(model_monitoring, "encoder_cache", cache)
+    live_digest = cache.digest
+    new_categories = {"state": ["A new state"], "make": [], "model": []}
+
+    model_monitoring.update_encoder(new_categories)
+    assert cache.digest != live_digest
+    assert EncoderCache(str(live_path)).digest == live_digest
+    model_monitoring.discard_staged_encoder()
+    assert cache.digest == live_digest
+
+    model_monitoring.update_encoder(new_categories)
+    staged_digest = cache.digest
+    model_monitoring.publish_encoder()
+    assert EncoderCache(str(live_path)).digest == staged_digest
+    assert not model_monitoring.encoder_is_staged()
+
+def test_check_model_without_reference(tmp_path, monkeypatch):
+    """
+    Makes sure the model is still evaluated when there are no reference
+    records to compute the drift statistics with.
+    """
+    mlflow.set_tracking_uri(f"sqlite:///{tmp_path}/mlflow.db")
+    monkeypatch.setattr(model_monitoring, "estimate_model_mape",
+                        lambda *args, **kwargs: {"mape": 0.1, "mape_low": 0.05, "mape_high": 0.15, "rows_evaluated": 3})
+    new_records = {"categories": np.zeros((3, 3), dtype=np.int32), "year": np.full(3, 2014),
+                   "mileage": np.full(3, 35725.0), "price": np.full(3, 9000.0)}
+    reference_records = {"categories": np.zeros((0, 3), dtype=np.int32), "year": np.zeros(0),
+                         "mileage": np.zeros(0), "price": np.zeros(0)}
+    evaluation_config = {"skip_without_drift": True, "drift_threshold": 0.1, "processes": 1,
+                         "chunk_size": 2000, "confidence": 0.95, "min_rows": 2000}
+    try:
+        assert model_monitoring.check_model(new_records, reference_records, "1", 0.2, evaluation_config) == 0.1
+    finally:
+        mlflow.set_tracking_uri(None)
+
+def test_latest_registered_version():
+    """
+    Makes sure the latest version is the highest one, whatever the order
+    MLflow returns the versions in.
+    """
+    from types import SimpleNamespace
+
+    model_versions = [SimpleNamespace(version=version) for version in ["2", "10", "9"]]
+    assert model_monitoring.latest_registered_version(model_versions) == "10"
+
 def test_test():
     """
     Test for the test_model function.
@@ -43,3 +135,142 @@ def test_test():
     mape = test_model(X_test, y_test)
     assert isinstance(mape, float) and 0 <= mape <=1
     
+
+def test_load_training_snapshot(tmp_path, monkeypatch):
+    """
+    Makes sure the records are streamed chunk by chunk to the snapshot,
+    and that only the records added since the last update are downloaded.
+    """
+    testing_data = pd.read_csv("./test/testing_data.csv")
+    testing_data["id"] = np.arange(1, len(testing_data) + 1)
+    testing_data["date_added"] = "2024-06-01"
+    # Rows stored in the database so far
+    stored_rows = [8]
+    queries = []
+    def iter_data(after_id=None, chunk_size=None, columns=None):
+        queries.append(after_id)
+        new_data = testing_data.iloc[after_id:stored_rows[0]]
+        for start in range(0, len(new_data), chunk_size):
+            yield new_data.iloc[start:start + chunk_size]
+    monkeypatch.setattr(model_monitoring, "iter_data", iter_data)
+
+    model_monitoring.load_training_snapshot(str(tmp_path), chunk_size=3)
+    stored_rows[0] = len(testing_data)
+    records = model_monitoring.load_training_snapshot(str(tmp_path), chunk_size=3).records()
+    assert queries == [0, 8]
+    expected = model_monitoring.encode_records(testing_data)
+    for name in expected:
+        assert np.array_equal(records[name], expected[name])
+
+class InlineExecutor:
+    """
+    Runs the tasks submitted to it in the calling process, in place of the
+    ProcessPoolExecutor of search_model.
+    """
+    def __init__(self, max_workers, mp_context, initializer, initargs):
+        self.initargs = initargs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, fn, *args):
+        from concurrent.futures import Future
+
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class ConstantModel:
+    """
+    Predicts the same price for every car.
+    """
+    def __init__(self, price: float):
+        self.price = price
+
+    def predict(self, X, verbose=0):
+        return np.full((X.shape[0], 1), self.price, dtype=np.float32)
+
+
+def search_records(n_rows: int=30) -> dict:
+    """
+    Returns records that all have a price of 10000.
+    """
+    testing_data = pd.read_csv("./test/testing_data.csv").sample(n_rows, replace=True, random_state=0)
+    testing_data["price"] = 10000
+    return model_monitoring.encode_records(testing_data)
+
+
+def test_search_model(tmp_path, monkeypatch):
+    """
+    Makes sure the search registers the candidate with the lowest
+    validation MAPE when it beats the latest registered version, that the
+    deadline is passed on to the candidates, and that the staged encoder is
+    discarded when nothing is registered.
+    """
+    monkeypatch.setenv("MLFLOW_TRACKING_URI", f"sqlite:///{tmp_path}/mlflow.db")
+    monkeypatch.setattr(model_monitoring, "ProcessPoolExecutor", InlineExecutor)
+    monkeypatch.setattr(model_monitoring, "training_deadline", 12345.0)
+    deadlines = []
+    def train_candidate(candidate, tracking_uri, experiment_id, parent_run_id, epochs, numpy_precisions, deadline):
+        deadlines.append(deadline)
+        if candidate["name"] == "broken":
+            raise ValueError("The candidate could not be trained")
+        return {"run_id": candidate["name"], "val_mape": candidate["val_mape"], "candidate": candidate}
+    monkeypatch.setattr(model_monitoring, "train_candidate", train_candidate)
+    # Each candidate predicts its own price, the best one being off by 10%
+    candidate_prices = {"runs:/good/iargus": 9000, "runs:/bad/iargus": 5000}
+    monkeypatch.setattr(mlflow.keras, "load_model", lambda uri: ConstantModel(candidate_prices[uri]))
+    registered = []
+    monkeypatch.setattr(mlflow, "register_model",
+                        lambda uri, name: registered.append(uri) or SimpleNamespace(version=str(len(registered))))
+    events = []
+    for name in ["publish_encoder", "discard_staged_encoder", "announce_model_version", "record_training_date"]:
+        monkeypatch.setattr(model_monitoring, name, lambda *args, name=name: events.append(name))
+    candidates = [{"name": "bad", "val_mape": 0.5}, {"name": "broken"}, {"name": "good", "val_mape": 0.1}]
+
+    # The latest registered version is off by 20%
+    monkeypatch.setattr(model_monitoring, "load_latest_model", lambda: ConstantModel(8000))
+    mape = model_monitoring.search_model(search_records(), candidates, processes=2, epochs=1)
+    assert mape == pytest.approx(0.1)
+    assert registered == ["runs:/good/iargus"]
+    assert events == ["publish_encoder", "announce_model_version", "record_training_date"]
+    assert deadlines == [12345.0] * 3
+
+    # The latest registered version is off by 5%
+    events.clear()
+    monkeypatch.setattr(model_monitoring, "load_latest_model", lambda: ConstantModel(9500))
+    mape = model_monitoring.search_model(search_records(), candidates, processes=2, epochs=1)
+    assert mape == pytest.approx(0.05)
+    assert registered == ["runs:/good/iargus"]
+    assert events == ["discard_staged_encoder"]
+
+
+def test_train_candidate_deadline(tmp_path, monkeypatch):
+    """
+    Makes sure a candidate stops training at the deadline and is still
+    evaluated.
+    """
+    from time import time
+
+    monkeypatch.setenv("MLFLOW_TRACKING_URI", f"sqlite:///{tmp_path}/mlflow.db")
+    monkeypatch.setattr(model_monitoring, "_search_records", search_records(60))
+    monkeypatch.setattr(mlflow.keras, "log_model", lambda **kwargs: None)
+    monkeypatch.setattr(model_monitoring, "log_model_artifacts", lambda *args: None)
+    models = []
+    build_model = model_monitoring.build_model
+    monkeypatch.setattr(model_monitoring, "build_model", lambda *args: models.append(build_model(*args)) or models[-1])
+    experiment_id = mlflow.create_experiment("search")
+    candidate = {"hidden_layers": [4], "learning_rate": 0.001, "batch_size": 10}
+
+    result = model_monitoring.train_candidate(candidate, f"sqlite:///{tmp_path}/mlflow.db", experiment_id, None,
+                                              epochs=50, numpy_precisions=[], deadline=time())
+    assert models[0].history.epoch == [0]
+    assert 0 <= result["val_mape"]
+    assert mlflow.get_run(result["run_id"]).data.metrics["val_MAPE"] == pytest.approx(result["val_mape"])
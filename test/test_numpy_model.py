@@ -0,0 +1,44 @@
+"""
+Unit tests for numpy_model.py.
+"""
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+from numpy_model import export_weights, NumpyPredictor
+
+
+def test_numpy_predictor_matches_keras(tmp_path):
+    """
+    Makes sure the NumPy forward pass gives the same predictions as the
+    Keras model it was exported from.
+    """
+    keras = pytest.importorskip("tensorflow.keras")
+    model = keras.models.Sequential()
+    model.add(keras.layers.Dense(100, input_shape=(20,), activation='relu'))
+    model.add(keras.layers.Dense(50, activation='relu'))
+    model.add(keras.layers.Dense(1, activation='linear'))
+
+    weights_path = str(tmp_path / "weights.npz")
+    export_weights(model, weights_path)
+    predictor = NumpyPredictor.load(weights_path)
+
+    X = np.random.default_rng(42).random((64, 20))
+    expected = model.predict(X, verbose=0)
+    assert predictor.predict(X).shape == expected.shape
+    assert np.allclose(predictor.predict(X), expected, rtol=1e-4, atol=1e-4)
+
+
+def test_numpy_predictor_sparse_input():
+    """
+    Makes sure dense and sparse features give the same predictions.
+    """
+    sparse = pytest.importorskip("scipy.sparse")
+    rng = np.random.default_rng(42)
+    predictor = NumpyPredictor([(rng.random((10, 4), dtype=np.float32), rng.random(4, dtype=np.float32), "relu"),
+                                (rng.random((4, 1), dtype=np.float32), rng.random(1, dtype=np.float32), "linear")])
+    X = np.zeros((3, 10))
+    X[0, 1] = X[1, 5] = X[2, 9] = 1
+    assert np.allclose(predictor.predict(X), predictor.predict(sparse.csr_matrix(X)))
@@ -0,0 +1,75 @@
+"""
+Unit tests for tflite_model.py.
+"""
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+from tflite_model import export_tflite, tflite_filename, TFLitePredictor
+
+
+def build_model(input_dim: int):
+    keras = pytest.importorskip("tensorflow.keras")
+    model = keras.models.Sequential()
+    model.add(keras.layers.Dense(100, input_shape=(input_dim,), activation='relu'))
+    model.add(keras.layers.Dense(50, activation='relu'))
+    model.add(keras.layers.Dense(1, activation='linear'))
+    return model
+
+
+def one_hot_features(n_rows: int, input_dim: int) -> np.ndarray:
+    """
+    Returns features shaped like the ones of the API: a few one-hot encoded
+    categories followed by a year and a mileage.
+    """
+    rng = np.random.default_rng(42)
+    X = np.zeros((n_rows, input_dim), dtype=np.float32)
+    X[np.arange(n_rows)[:, None], rng.integers(0, input_dim - 2, (n_rows, 3))] = 1
+    X[:, -2] = rng.integers(2000, 2021, n_rows)
+    X[:, -1] = rng.integers(0, 200000, n_rows)
+    return X
+
+
+def test_tflite_export(tmp_path):
+    """
+    Makes sure the float16 and int8 variants give predictions close to the
+    Keras model, the categories not being rounded away next to the year and
+    mileage.
+    """
+    model = build_model(300)
+    X = one_hot_features(64, 300)
+    expected = model.predict(X, verbose=0)
+    for precision, tolerance in [("float16", 1e-2), ("int8", 5e-2)]:
+        model_path = str(tmp_path / tflite_filename(precision))
+        export_tflite(model, model_path, precision)
+        predictor = TFLitePredictor.load(model_path)
+        assert predictor.input_shape == (None, 300)
+        assert predictor.predict(X).shape == expected.shape
+        assert np.allclose(predictor.predict(X), expected, rtol=tolerance, atol=tolerance * np.abs(expected).max())
+        # Single rows, as sent by /predict, get the same predictions
+        assert np.allclose(predictor.predict(X[:1]), predictor.predict(X)[:1], rtol=1e-2)
+
+    with pytest.raises(ValueError):
+        export_tflite(model, str(tmp_path / "model.tflite"), "float32")
+
+
+def test_tflite_predictor_sparse_input_and_threads(tmp_path):
+    """
+    Makes sure dense and sparse features give the same predictions, and
+    that several threads can predict at once.
+    """
+    sparse = pytest.importorskip("scipy.sparse")
+    model_path = str(tmp_path / tflite_filename("int8"))
+    export_tflite(build_model(30), model_path, "int8")
+    predictor = TFLitePredictor.load(model_path)
+    X = one_hot_features(2500, 30)
+    expected = predictor.predict(X[:10])
+    assert np.allclose(predictor.predict(sparse.csr_matrix(X))[:10], expected)
+    assert predictor.predict(X[:0]).shape == (0, 1)
+
+    with ThreadPoolExecutor(4) as executor:
+        predictions = list(executor.map(lambda n_rows: predictor.predict(X[:n_rows])[:1], [1, 10, 1, 10] * 5))
+    assert all(np.allclose(prediction, expected[:1]) for prediction in predictions)
@@ -0,0 +1,73 @@
+"""
+Unit tests for the write-behind storage of the tokens.
+"""
+import sys
+
+import pytest
+
+sys.path.append(".")
+from token_writer import TokenWriter, token_row
+
+
+def test_token_writer_batches():
+    """
+    Makes sure queued tokens are stored in batches, as soon as a batch is
+    full or when the writer stops, and that each token is told when its
+    batch is stored.
+    """
+    batches = []
+    def write_rows(rows):
+        batches.append([row[3] for row in rows])
+
+    writer = TokenWriter(write_rows, max_batch_size=3, max_wait_ms=60000)
+    futures = [writer.add(token_row("test", "test", "test@mail.com", token)) for token in ["a", "b", "c"]]
+    for future in futures:
+        future.result(timeout=5)
+    last_future = writer.add(token_row("test", "test", "test@mail.com", "d"))
+    assert not last_future.done()
+    writer.stop()
+    assert last_future.result(timeout=0) is None
+    assert batches == [["a", "b", "c"], ["d"]]
+
+
+def test_token_writer_failure():
+    """
+    Makes sure the tokens of a failed batch get the error, and that the
+    next batches are still stored.
+    """
+    batches = []
+    def write_rows(rows):
+        batches.append([row[3] for row in rows])
+        if len(batches) == 1:
+            raise ConnectionError("The database is unavailable")
+
+    writer = TokenWriter(write_rows, max_wait_ms=100)
+    futures = [writer.add(token_row("test", "test", "test@mail.com", token)) for token in ["a", "b"]]
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result(timeout=5)
+    writer.add(token_row("test", "test", "test@mail.com", "c")).result(timeout=5)
+    writer.stop()
+    assert batches == [["a", "b"], ["c"]]
+    assert writer.status()["pending_tokens"] == 0
+
+
+def test_token_writer_pending_and_discard():
+    """
+    Makes sure queued tokens can be looked up before they are stored, and
+    that a discarded token is never stored.
+    """
+    batches = []
+    writer = TokenWriter(lambda rows: batches.append([row[3] for row in rows]), max_wait_ms=60000)
+    row = token_row("test", "test", "test@mail.com", "a")
+    future = writer.add(row)
+    writer.add(token_row("test", "test", "test@mail.com", "b"))
+    assert writer.pending("a") == row
+    assert writer.pending("c") is None
+
+    assert writer.discard("a")
+    assert future.cancelled()
+    assert writer.pending("a") is None
+    assert not writer.discard("a")
+    writer.stop()
+    assert batches == [["b"]]
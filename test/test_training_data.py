@@ -0,0 +1,51 @@
+"""
+Unit tests for the batches the models are trained on.
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(".")
+from model_monitoring import encode_records, encoder_cache, features_from_codes
+from training_data import FeatureBatches, subset_size, subset_rows
+
+
+def test_split():
+    """
+    Makes sure every record belongs to exactly one set, in the expected
+    proportions.
+    """
+    for n_rows in [0, 7, 15, 31, 1000]:
+        rows = np.concatenate([subset_rows(np.arange(subset_size(n_rows, subset)), subset)
+                               for subset in ["train", "val", "test"]])
+        assert np.array_equal(np.sort(rows), np.arange(n_rows))
+    assert [subset_size(1500, subset) for subset in ["train", "val", "test"]] == [900, 100, 500]
+
+
+def test_feature_batches():
+    """
+    Makes sure the batches hold the features and prices of the records of
+    their set, in order or shuffled.
+    """
+    testing_data = pd.read_csv("./test/testing_data.csv")
+    testing_data = pd.concat([testing_data] * 5, ignore_index=True)
+    testing_data["price"] = np.arange(len(testing_data), dtype=np.float32)
+    records = encode_records(testing_data)
+    lookup = encoder_cache.lookup()
+
+    batches = FeatureBatches(records, "train", lookup, batch_size=4)
+    rows = subset_rows(np.arange(batches.size), "train")
+    assert np.array_equal(batches.targets(), rows)
+    X_expected = features_from_codes(records["categories"][rows],
+                                     np.column_stack((records["year"][rows], records["mileage"][rows])))
+    X = np.vstack([batches.batch(index)[0].toarray() for index in range(len(batches))])
+    assert np.array_equal(X, X_expected.toarray())
+
+    X, y = batches[0]
+    assert X.shape == (4, lookup.n_categories + 2)
+    assert np.array_equal(y, rows[:4])
+
+    shuffled = FeatureBatches(records, "train", lookup, batch_size=4, shuffle=True)
+    prices = np.concatenate([shuffled.batch(index)[1] for index in range(len(shuffled))])
+    assert np.array_equal(np.sort(prices), rows)
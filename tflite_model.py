@@ -0,0 +1,169 @@
+"""
+Reduced-precision variants of the IArgus network, served with TensorFlow
+Lite.
+
+NumPy has no fast matrix product in float16 or int8, so these variants are
+exported to TensorFlow Lite models, whose interpreter has kernels for
+them. The int8 variant uses dynamic-range quantization: the kernels are
+stored in int8 with one scale per output unit, and the inputs of each
+layer are quantized on the fly so that the products are computed in int8.
+The float16 variant only halves the file: its kernels are converted back
+to float32 when the interpreter loads them.
+
+Quantizing the inputs of the first layer would round the one-hot encoded
+categories away next to the year and mileage, which are thousands of times
+larger. The first layer is therefore split in two before the export: the
+categories go through the int8 kernel, and the year and mileage, the last
+NUMERIC_COLUMNS features, through a float32 kernel too small to be
+quantized.
+
+Exporting imports TensorFlow. Loading uses the interpreter of the
+ai_edge_litert package if it is installed, which is much lighter, and the
+one of TensorFlow otherwise.
+"""
+import threading
+
+import numpy as np
+
+
+TFLITE_FILENAME = "iargus_model.tflite"
+PRECISIONS = ("float16", "int8")
+NUMERIC_COLUMNS = 2
+# Sparse inputs are made dense this many rows at a time
+MAX_DENSE_ROWS = 1000
+
+
+def tflite_filename(precision: str) -> str:
+    """
+    Returns the name of the file holding the model exported with the given
+    precision.
+    """
+    return TFLITE_FILENAME.replace(".tflite", f"_{precision}.tflite")
+
+
+def split_first_layer(model, numeric_columns: int=NUMERIC_COLUMNS):
+    """
+    Returns a Keras model computing the same function as model, a stack of
+    Dense layers, whose first layer is split between the category features
+    and the last numeric_columns features.
+    """
+    from tensorflow import keras
+
+    first_layer, other_layers = model.layers[0], model.layers[1:]
+    kernel, bias = first_layer.get_weights()
+    inputs = keras.Input(shape=(kernel.shape[0],))
+    categories = keras.layers.Dense(kernel.shape[1], use_bias=False)
+    numeric = keras.layers.Dense(kernel.shape[1])
+    outputs = keras.layers.Add()([categories(inputs[:, :-numeric_columns]),
+                                  numeric(inputs[:, -numeric_columns:])])
+    outputs = keras.layers.Activation(first_layer.get_config()["activation"])(outputs)
+    for layer in other_layers:
+        outputs = layer(outputs)
+    categories.set_weights([kernel[:-numeric_columns]])
+    numeric.set_weights([kernel[-numeric_columns:], bias])
+    return keras.Model(inputs, outputs)
+
+
+def export_tflite(model, path: str, precision: str):
+    """
+    Writes a Keras model made of Dense layers to a TensorFlow Lite file,
+    with its kernels stored with the given precision.
+    """
+    import tensorflow as tf
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"Precision {precision} is not supported")
+    converter = tf.lite.TFLiteConverter.from_keras_model(split_first_layer(model))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    with open(path, "wb") as model_file:
+        model_file.write(converter.convert())
+
+
+def interpreter_class():
+    """
+    Returns the TensorFlow Lite interpreter class of ai_edge_litert if it is
+    installed, the one of TensorFlow otherwise.
+    """
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite.python.interpreter import Interpreter
+    return Interpreter
+
+
+class TFLitePredictor:
+    """
+    Runs a model exported by export_tflite with the TensorFlow Lite
+    interpreter.
+
+    predict() has the same interface as the one of Keras models so that
+    both can be used interchangeably. Interpreters cannot be shared between
+    threads, so each thread that predicts gets its own, resized to the
+    number of rows it is given.
+    """
+    def __init__(self, model_content: bytes, num_threads: int=1):
+        self.model_content = model_content
+        self.num_threads = num_threads
+        self._interpreter_class = interpreter_class()
+        self._local = threading.local()
+        self._input_dim = int(self._interpreter().get_input_details()[0]["shape"][-1])
+
+    @classmethod
+    def load(cls, path: str) -> "TFLitePredictor":
+        """
+        Loads a model written by export_tflite.
+        """
+        with open(path, "rb") as model_file:
+            return cls(model_file.read())
+
+    @property
+    def input_shape(self) -> tuple:
+        """
+        Shape of the inputs, like the input_shape of Keras models.
+        """
+        return (None, self._input_dim)
+
+    def _interpreter(self):
+        """
+        Returns the interpreter of the calling thread, created on first use.
+        """
+        interpreter = getattr(self._local, "interpreter", None)
+        if interpreter is None:
+            interpreter = self._interpreter_class(model_content=self.model_content, num_threads=self.num_threads)
+            interpreter.allocate_tensors()
+            self._local.interpreter = interpreter
+            self._local.input_index = interpreter.get_input_details()[0]["index"]
+            self._local.output_index = interpreter.get_output_details()[0]["index"]
+            self._local.n_rows = interpreter.get_input_details()[0]["shape"][0]
+        return interpreter
+
+    def predict(self, X, verbose: int=0) -> np.ndarray:
+        """
+        Returns the output of the network for each row of X, which can be a
+        dense array or a scipy sparse matrix.
+        """
+        if not hasattr(X, "toarray"):
+            return self._predict_dense(np.ascontiguousarray(X, dtype=np.float32))
+        outputs = [self._predict_dense(X[start:start + MAX_DENSE_ROWS].toarray().astype(np.float32, copy=False))
+                   for start in range(0, X.shape[0], MAX_DENSE_ROWS)]
+        if len(outputs) == 0:
+            return np.empty((0, 1), dtype=np.float32)
+        return np.concatenate(outputs)
+
+    def _predict_dense(self, X: np.ndarray) -> np.ndarray:
+        """
+        Runs the interpreter of the calling thread on a dense float32 array.
+        """
+        if len(X) == 0:
+            return np.empty((0, 1), dtype=np.float32)
+        interpreter = self._interpreter()
+        if self._local.n_rows != len(X):
+            # Resizing takes a few microseconds, much less than a prediction
+            interpreter.resize_tensor_input(self._local.input_index, X.shape)
+            interpreter.allocate_tensors()
+            self._local.n_rows = len(X)
+        interpreter.set_tensor(self._local.input_index, X)
+        interpreter.invoke()
+        return interpreter.get_tensor(self._local.output_index)
@@ -0,0 +1,58 @@
+"""
+In-memory cache of the security tokens validated by the API.
+"""
+import threading
+from collections import OrderedDict
+from datetime import date
+from time import monotonic
+from typing import Optional
+
+
+class TokenCache:
+    """
+    LRU cache mapping tokens to their expiry date.
+
+    At most max_size tokens are kept, the least recently used ones being
+    evicted first. Entries are dropped after ttl seconds so that a token
+    revoked by another process is not accepted for longer than that.
+    """
+    def __init__(self, max_size: int=10000, ttl: float=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[date]:
+        """
+        Returns the expiry date of the token, or None if it is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expiry_date, cached_at = entry
+            if monotonic() - cached_at > self.ttl:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return expiry_date
+
+    def put(self, token: str, expiry_date: date):
+        """
+        Caches the expiry date of a valid token.
+        """
+        with self._lock:
+            self._entries[token] = (expiry_date, monotonic())
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token: str):
+        """
+        Removes a token from the cache, e.g. because it has been revoked.
+        """
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def __len__(self):
+        return len(self._entries)
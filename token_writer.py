@@ -0,0 +1,249 @@
+"""
+Write-behind storage of the tokens issued by the API.
+
+Committing one INSERT per token makes bursts of /get_token requests slow
+and keeps the database busy. The writer queues the new tokens and inserts
+them with a single multi-row INSERT, as soon as max_batch_size tokens are
+queued or max_wait_ms milliseconds after the first one was, whichever
+comes first. Queued tokens are handed out right away: the worker that
+issued them finds them in its token cache, or with pending(), while the
+other workers find them in the database once their batch is stored. Each
+row comes with a future resolved once its batch is stored, which tells
+the API to forget the token if the batch could not be.
+
+Tokens can also be issued in bulk, in a single transaction, e.g. for a
+partner provisioning many integrations at once:
+    python token_writer.py --count 500 --first-name Partner --surname Inc --email it@partner.com > tokens.csv
+"""
+import sys
+import csv
+import logging
+import argparse
+import threading
+from concurrent.futures import Future
+from datetime import date, timedelta
+from secrets import token_hex
+from time import monotonic
+from typing import Callable, Optional, Sequence
+
+from dateutil.relativedelta import relativedelta
+
+from metrics import timed, histogram
+
+
+logger = logging.getLogger(__name__)
+
+# Number of days a token stays valid after the date stored with it
+TOKEN_VALIDITY_DAYS = 180
+
+INSERT_BATCH_SIZE = histogram("iargus_token_insert_rows", "Number of tokens stored by each INSERT",
+                              buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+
+
+def generate_token() -> str:
+    """
+    Generates a random token.
+    """
+    return str(token_hex(32))
+
+
+def token_row(first_name: str, surname: str, email: str, token: str) -> tuple:
+    """
+    Returns the values stored in the tokens table for a new token.
+    """
+    expiration_date = date.today() + relativedelta(months=6)
+    return (first_name, surname, email, token, expiration_date.strftime("%Y-%m-%d"))
+
+
+def row_expiry_date(row: tuple) -> date:
+    """
+    Returns the date a token stored with the given values expires at, as
+    computed by check_token from the database.
+    """
+    return date.fromisoformat(row[-1]) + timedelta(days=TOKEN_VALIDITY_DAYS)
+
+
+def insert_tokens(db, rows: Sequence[tuple]):
+    """
+    Inserts the given token rows with a single parameterized INSERT. The
+    caller commits.
+    """
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+    query = f"""INSERT INTO tokens (first_name, surname, email, token, creation_date) VALUES {placeholders}"""
+    with db.cursor() as c:
+        c.execute(query, [value for row in rows for value in row])
+    INSERT_BATCH_SIZE.observe(len(rows))
+
+
+class TokenWriter:
+    """
+    Queues token rows and stores them in batches from a background thread.
+
+    write_fn receives a list of rows and must store them, raising an
+    exception if it could not. The futures of the rows of a failed batch
+    are given the exception and the rows are dropped.
+    """
+    def __init__(self, write_fn: Callable[[list], None], max_batch_size: int=100, max_wait_ms: float=20):
+        self.write_fn = write_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        # Token -> (row, future), in the order the tokens were issued
+        self._pending = {}
+        self._first_queued_at = None
+        self._condition = threading.Condition()
+        # Held while a batch is being written
+        self._flush_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+
+    def add(self, row: tuple) -> Future:
+        """
+        Queues a token row, the token being the fourth value of the row.
+        Returns a future resolved once the row is stored, or given the
+        exception raised while storing it. Starts the writing thread if
+        needed.
+        """
+        if self._thread is None:
+            self.start()
+        future = Future()
+        with self._condition:
+            if not self._pending:
+                self._first_queued_at = monotonic()
+            self._pending[row[3]] = (row, future)
+            # The thread waits without a timeout while the queue is empty,
+            # so it is woken up by the first row to start the max_wait_ms
+            # countdown, and by the row that fills the batch
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch_size:
+                self._condition.notify()
+        return future
+
+    def pending(self, token: str) -> Optional[tuple]:
+        """
+        Returns the row of a token that is queued but not stored yet, or
+        None.
+        """
+        with self._condition:
+            entry = self._pending.get(token)
+        return entry[0] if entry is not None else None
+
+    def discard(self, token: str) -> bool:
+        """
+        Removes a token that is not stored yet from the queue and cancels
+        its future. Returns False if the token is not queued.
+
+        Waits for the batch being written, if any, so that the token can be
+        deleted from the database afterwards if it was part of it.
+        """
+        with self._flush_lock, self._condition:
+            entry = self._pending.pop(token, None)
+        if entry is None:
+            return False
+        entry[1].cancel()
+        return True
+
+    def flush(self):
+        """
+        Stores the queued rows right away.
+        """
+        with self._flush_lock:
+            with self._condition:
+                batch = list(self._pending.values())
+                self._pending.clear()
+                self._first_queued_at = None
+            if not batch:
+                return
+            try:
+                with timed("token_db_insert"):
+                    self.write_fn([row for row, _ in batch])
+            except Exception as e:
+                logger.exception(f"Could not store {len(batch)} tokens")
+                for _, future in batch:
+                    future.set_exception(e)
+                raise
+            for _, future in batch:
+                future.set_result(None)
+
+    def start(self):
+        """
+        Starts the thread that writes the batches.
+        """
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="token-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the writing thread once the queued rows are stored.
+        """
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping and not self._batch_ready():
+                    if self._pending:
+                        remaining = self._first_queued_at + self.max_wait_ms / 1000 - monotonic()
+                        self._condition.wait(max(remaining, 0))
+                    else:
+                        self._condition.wait()
+                stopping = self._stopping
+            try:
+                self.flush()
+            except Exception:
+                # The futures of the failed rows were given the error
+                pass
+            if stopping:
+                return
+
+    def _batch_ready(self) -> bool:
+        if not self._pending:
+            return False
+        return (len(self._pending) >= self.max_batch_size
+                or monotonic() - self._first_queued_at >= self.max_wait_ms / 1000)
+
+    def status(self) -> dict:
+        """
+        Returns the number of tokens waiting to be stored.
+        """
+        with self._condition:
+            return {"pending_tokens": len(self._pending)}
+
+
+def provision_tokens(count: int, first_name: str, surname: str, email: str) -> list:
+    """
+    Issues count tokens for the same user and stores them in a single
+    transaction. Returns the new tokens.
+    """
+    from database import get_connection
+
+    rows = [token_row(first_name, surname, email, generate_token()) for _ in range(count)]
+    with get_connection("iargus_api") as db:
+        # Keeping each INSERT to a reasonable size for the server
+        for start in range(0, len(rows), 1000):
+            insert_tokens(db, rows[start:start + 1000])
+        db.commit()
+    return [row[3] for row in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Issues many tokens for the same user in a single transaction")
+    parser.add_argument("--count", type=int, required=True, help="Number of tokens to issue")
+    parser.add_argument("--first-name", required=True)
+    parser.add_argument("--surname", required=True)
+    parser.add_argument("--email", required=True)
+    args = parser.parse_args()
+    tokens = provision_tokens(args.count, args.first_name, args.surname, args.email)
+    # The tokens are written as CSV on the standard output
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["token", "expiry_date"])
+    expiry_date = row_expiry_date(token_row(args.first_name, args.surname, args.email, "")).isoformat()
+    for token in tokens:
+        writer.writerow([token, expiry_date])
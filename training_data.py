@@ -0,0 +1,147 @@
+"""
+Feeds the training records to Keras one batch at a time.
+
+Training used to build the sparse features of every record at once, then
+to copy them again to split them into training, validation and test sets.
+The records are now kept in the compact form of the training data
+snapshot (category codes, year, mileage and price), usually as memory
+maps, and the features of a batch are only built when Keras asks for it.
+
+The sets are split by row position instead of being drawn at random: out
+of every SPLIT_BLOCK consecutive records, the first 9 go to the training
+set, the next one to the validation set and the last 5 to the test set.
+Each set spans the whole table, in the same proportions as the random
+split used before.
+
+Importing this module imports TensorFlow.
+"""
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.utils import PyDataset
+
+from category_lookup import CategoryLookup
+
+
+SPLIT_BLOCK = 15
+# First and last position, in each block, of the records of each set
+SPLIT_POSITIONS = {"train": (0, 9), "val": (9, 10), "test": (10, 15)}
+# Threads building the next batches while Keras trains on the current one
+LOADING_THREADS = 4
+# Rows per batch when the model is evaluated rather than trained
+EVALUATION_BATCH_SIZE = 10000
+
+
+def subset_size(n_rows: int, subset: str) -> int:
+    """
+    Returns the number of the first n_rows records that belong to the
+    given set.
+    """
+    start, end = SPLIT_POSITIONS[subset]
+    full_blocks, remaining = divmod(n_rows, SPLIT_BLOCK)
+    return full_blocks * (end - start) + min(max(remaining - start, 0), end - start)
+
+
+def subset_rows(positions: np.ndarray, subset: str) -> np.ndarray:
+    """
+    Returns the row of the records found at the given positions of a set.
+    """
+    start, end = SPLIT_POSITIONS[subset]
+    blocks, offsets = np.divmod(positions, end - start)
+    return blocks * SPLIT_BLOCK + start + offsets
+
+
+def concatenate_records(*records: dict) -> dict:
+    """
+    Concatenates records returned by model_monitoring.load_records or
+    TrainingSnapshot.records.
+    """
+    return {name: np.concatenate([r[name] for r in records]) for name in records[0]}
+
+
+class FeatureBatches(PyDataset):
+    """
+    Sparse features and prices of the records of one set, built one batch
+    at a time.
+
+    records holds the category codes, years, mileages and prices of the
+    records, as returned by model_monitoring.load_records or
+    TrainingSnapshot.records. Only the rows of a batch are read from them.
+    If shuffle is set, the records of the set are drawn in a new order
+    every epoch.
+    """
+    def __init__(self, records: dict, subset: str, lookup: CategoryLookup, batch_size: int, shuffle: bool=False):
+        super().__init__(workers=LOADING_THREADS)
+        self.records = records
+        self.subset = subset
+        self.lookup = lookup
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.size = subset_size(len(records["price"]), subset)
+        self._order = None
+        if shuffle:
+            self.on_epoch_end()
+
+    def __len__(self) -> int:
+        return -(-self.size // self.batch_size)
+
+    def __getitem__(self, index: int) -> tuple:
+        rows = self._rows(index)
+        entry_rows, entry_columns, values = self.lookup.sparse_entries(*self._codes(rows))
+        # Keras takes TensorFlow sparse tensors, whose entries are sorted
+        # row by row, as sparse_entries returns them
+        X = tf.SparseTensor(np.column_stack((entry_rows, entry_columns)), values,
+                            (len(rows), self.lookup.n_categories + 2))
+        return X, self._prices(rows)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            # 4 bytes per record, whereas the features take about 40
+            self._order = np.random.permutation(np.arange(self.size, dtype=np.int32))
+
+    def batch(self, index: int) -> tuple:
+        """
+        Returns the features, as a CSR matrix, and the prices of a batch.
+        """
+        rows = self._rows(index)
+        return self.lookup.sparse_features(*self._codes(rows)), self._prices(rows)
+
+    def _rows(self, index: int) -> np.ndarray:
+        positions = np.arange(index * self.batch_size, min((index + 1) * self.batch_size, self.size))
+        if self._order is not None:
+            # Sorted rows are read from the memory maps in a single pass
+            positions = np.sort(self._order[positions])
+        return subset_rows(positions, self.subset)
+
+    def _codes(self, rows: np.ndarray) -> tuple:
+        return (self.records["categories"][rows],
+                np.column_stack((self.records["year"][rows], self.records["mileage"][rows])))
+
+    def _prices(self, rows: np.ndarray) -> np.ndarray:
+        return np.asarray(self.records["price"][rows], dtype=np.float32)
+
+    def example(self, n_rows: int=5) -> tuple:
+        """
+        Returns the dense features and prices of the first rows of the set,
+        to describe the inputs of the model.
+        """
+        X, y = FeatureBatches(self.records, self.subset, self.lookup, n_rows).batch(0)
+        return X.toarray(), y
+
+    def targets(self) -> np.ndarray:
+        """
+        Returns the prices of all the records of the set, in the order of
+        the batches when they are not shuffled.
+        """
+        return self._prices(subset_rows(np.arange(self.size), self.subset))
+
+    def predict(self, model) -> np.ndarray:
+        """
+        Runs model, a Keras model or a numpy_model.NumpyPredictor, on every
+        batch and returns its predictions, in the same order as targets
+        when the batches are not shuffled.
+        """
+        predictions = [np.asarray(model.predict(self.batch(index)[0], verbose=0)).ravel()
+                       for index in range(len(self))]
+        if len(predictions) == 0:
+            return np.empty(0, dtype=np.float32)
+        return np.concatenate(predictions)
@@ -0,0 +1,59 @@
+"""
+Thread pools used by the API to run blocking code outside of the event
+loop.
+
+Database queries and MLflow calls run on the "io" pool, model predictions
+on the "inference" pool. TensorFlow and NumPy release the GIL while
+computing, so predictions running on the inference pool do not stall the
+requests being handled by the event loop.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+pool_sizes = {"io": 16, "inference": 2}
+_executors = {}
+
+
+def configure(io_workers: int, inference_workers: int):
+    """
+    Sets the size of the pools. Must be called before they are first used.
+    """
+    pool_sizes["io"] = io_workers
+    pool_sizes["inference"] = inference_workers
+
+
+def get_executor(name: str) -> ThreadPoolExecutor:
+    """
+    Returns the pool with the given name, creating it if needed.
+    """
+    if name not in _executors:
+        _executors[name] = ThreadPoolExecutor(max_workers=pool_sizes[name],
+                                              thread_name_prefix=f"iargus-{name}")
+    return _executors[name]
+
+
+async def run_io(func, *args, **kwargs):
+    """
+    Runs a blocking I/O call (database, MLflow...) on the io pool.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor("io"), partial(func, *args, **kwargs))
+
+
+async def run_inference(func, *args, **kwargs):
+    """
+    Runs a CPU-bound call (preprocessing, prediction) on the inference pool.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor("inference"), partial(func, *args, **kwargs))
+
+
+def shutdown():
+    """
+    Waits for the running tasks and stops the pools.
+    """
+    for executor in _executors.values():
+        executor.shutdown(wait=True)
+    _executors.clear()